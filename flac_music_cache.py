@@ -0,0 +1,510 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit, parse_qs
+
+from flac_music_core import APP_DATA_DIR, logger, metrics, setup_logging, unused_path
+
+# 默认的本地缓存目录和容量上限（字节）
+TRACK_CACHE_DIR = os.path.join(APP_DATA_DIR, "track_cache")
+TRACK_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# 缓存服务默认只监听本机，局域网共用时显式指定监听地址并设置令牌
+CACHE_HOST = '127.0.0.1'
+CACHE_PORT = 8766
+
+# 复制、校验和传输文件的块大小
+CACHE_CHUNK_SIZE = 256 * 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CACHE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_with_hash(source, target):
+    """从文件对象 source 复制到 target，返回 (字节数, SHA-256)"""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: source.read(CACHE_CHUNK_SIZE), b''):
+        digest.update(chunk)
+        target.write(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class TrackCache:
+    """按内容寻址的本地曲目缓存：文件以 SHA-256 命名存放，索引记录歌曲ID到内容的映射
+
+    总大小超过上限时按最近访问时间淘汰；取出时边复制边校验，内容损坏的条目直接删除。
+    同一内容对应多个歌曲ID时只存一份。可供本机多个进程共用，也可由 make_cache_server 提供给局域网。
+    """
+
+    def __init__(self, root=TRACK_CACHE_DIR, max_bytes=TRACK_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(root, "index.db"), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                song_id TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                filename TEXT,
+                added REAL,
+                last_access REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_sha256 ON tracks (sha256)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_last_access ON tracks (last_access)")
+        self.conn.commit()
+        self.update_size_metric()
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256 + ".flac")
+
+    def lookup(self, song_id):
+        """返回缓存条目 {'sha256', 'size', 'filename'}，没有或文件已丢失时返回 None"""
+        with self.lock:
+            row = self.conn.execute("SELECT sha256, size, filename FROM tracks WHERE song_id = ?",
+                                    (str(song_id),)).fetchone()
+        if row is None:
+            return None
+        sha256, size, filename = row
+        try:
+            if os.path.getsize(self.object_path(sha256)) != size:
+                raise OSError("大小不符")
+        except OSError:
+            self.discard(song_id, sha256)
+            return None
+        return {'sha256': sha256, 'size': size, 'filename': filename}
+
+    def touch(self, song_id):
+        with self.lock:
+            self.conn.execute("UPDATE tracks SET last_access = ? WHERE song_id = ?", (time.time(), str(song_id)))
+            self.conn.commit()
+
+    def open(self, song_id):
+        """打开缓存的文件，返回 (条目, 文件对象)；没有时返回 (None, None)"""
+        entry = self.lookup(song_id)
+        if entry is None:
+            return None, None
+        try:
+            f = open(self.object_path(entry['sha256']), 'rb')
+        except OSError:
+            self.discard(song_id, entry['sha256'])
+            return None, None
+        self.touch(song_id)
+        return entry, f
+
+    def fetch(self, song_id, save_dir, filename=None):
+        """缓存命中时复制到下载目录并校验内容，返回保存路径；未命中或内容损坏时返回 None
+
+        filename 为空时使用缓存中记录的文件名。
+        """
+        entry, source = self.open(song_id)
+        if entry is None:
+            metrics.inc('flac_cache_lookups_total', result='miss')
+            return None
+        # 与下载时相同，不覆盖下载目录中已有的同名文件
+        path = unused_path(save_dir, filename or entry['filename'] or f"{song_id}.flac")
+        part_path = path + ".part"
+        try:
+            with source, open(part_path, 'wb') as target:
+                size, sha256 = copy_with_hash(source, target)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        if sha256 != entry['sha256'] or size != entry['size']:
+            os.remove(part_path)
+            self.discard(song_id, entry['sha256'])
+            logger.warning(f"缓存的 {song_id} 内容损坏，已删除", extra={'phase': 'cache'})
+            metrics.inc('flac_cache_lookups_total', result='corrupt')
+            return None
+        os.replace(part_path, path)
+        metrics.inc('flac_cache_lookups_total', result='hit')
+        metrics.inc('flac_cache_bytes_total', size, direction='fetched')
+        return path
+
+    def put(self, song_id, path, filename=None):
+        """把下载完成的文件存入缓存（复制一份），返回内容的 SHA-256"""
+        with open(path, 'rb') as source:
+            return self.put_stream(song_id, source, filename or os.path.basename(path))
+
+    def put_stream(self, song_id, source, filename, expected_sha256=None):
+        """从文件对象存入缓存：先写临时文件再按内容改名，expected_sha256 不符时拒绝"""
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.objects_dir)
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                size, sha256 = copy_with_hash(source, target)
+            if expected_sha256 and expected_sha256 != sha256:
+                raise ValueError(f"内容校验失败: 期望 {expected_sha256}，实际 {sha256}")
+            object_path = self.object_path(sha256)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            if os.path.exists(object_path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        now = time.time()
+        with self.lock:
+            previous = self.conn.execute("SELECT sha256 FROM tracks WHERE song_id = ?", (str(song_id),)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO tracks (song_id, sha256, size, filename, added, last_access) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (str(song_id), sha256, size, filename, now, now))
+            self.conn.commit()
+        if previous and previous[0] != sha256:
+            self.remove_object_if_unused(previous[0])
+        self.update_size_metric()
+        metrics.inc('flac_cache_bytes_total', size, direction='stored')
+        self.evict()
+        return sha256
+
+    def discard(self, song_id, sha256):
+        """删除条目，内容不再被其他条目引用时删除文件"""
+        with self.lock:
+            self.conn.execute("DELETE FROM tracks WHERE song_id = ?", (str(song_id),))
+            self.conn.commit()
+        self.remove_object_if_unused(sha256)
+
+    def remove_object_if_unused(self, sha256):
+        with self.lock:
+            used = self.conn.execute("SELECT 1 FROM tracks WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        if not used:
+            try:
+                os.remove(self.object_path(sha256))
+            except FileNotFoundError:
+                pass
+        self.update_size_metric()
+
+    def total_size(self):
+        """缓存占用的字节数（相同内容只计一次）"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM tracks)").fetchone()[0]
+
+    def update_size_metric(self):
+        metrics.set('flac_cache_size_bytes', self.total_size())
+
+    def evict(self):
+        """超过容量上限时淘汰最久未访问的条目，返回淘汰的条目数"""
+        evicted = 0
+        while self.total_size() > self.max_bytes:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT song_id, sha256 FROM tracks ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.discard(*row)
+            evicted += 1
+        if evicted:
+            metrics.inc('flac_cache_evictions_total', evicted)
+            logger.info(f"缓存超过上限，淘汰 {evicted} 首", extra={'phase': 'cache'})
+        return evicted
+
+    def verify(self):
+        """校验全部缓存文件，删除丢失或损坏的条目，返回 (检查数, 删除数)"""
+        with self.lock:
+            rows = self.conn.execute("SELECT song_id, sha256 FROM tracks").fetchall()
+        checked = removed = 0
+        hashes = {}
+        for song_id, sha256 in rows:
+            checked += 1
+            if sha256 not in hashes:
+                try:
+                    hashes[sha256] = file_sha256(self.object_path(sha256))
+                except OSError:
+                    hashes[sha256] = None
+            if hashes[sha256] != sha256:
+                self.discard(song_id, sha256)
+                removed += 1
+        # 清理索引中已没有条目的孤立文件和残留的临时文件
+        for directory, _, files in os.walk(self.objects_dir):
+            for name in files:
+                sha256 = name.split('.')[0]
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(directory, name))
+                elif name.endswith('.flac'):
+                    self.remove_object_if_unused(sha256)
+        return checked, removed
+
+    def stats(self):
+        with self.lock:
+            count, objects = self.conn.execute("SELECT COUNT(*), COUNT(DISTINCT sha256) FROM tracks").fetchone()
+        return {'tracks': count, 'objects': objects, 'bytes': self.total_size(), 'max_bytes': self.max_bytes}
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    """局域网缓存服务：GET/HEAD 取文件，PUT 存文件，响应头带内容的 SHA-256 供客户端校验"""
+
+    server_version = "FlacMusicCache/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("HTTP %s " + format, self.client_address[0], *args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def authorized(self, query):
+        """设置了令牌时，请求须带 Authorization: Bearer <令牌> 或 ?token=<令牌>"""
+        token = self.server.token
+        if not token:
+            return True
+        return self.headers.get('Authorization', '') == f"Bearer {token}" or query.get('token', [None])[0] == token
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        if not self.authorized(parse_qs(url.query)):
+            self.send_json({'error': "未授权"}, 401)
+            return
+        try:
+            if method in ('GET', 'HEAD') and parts == ['metrics']:
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if method == 'GET':
+                    self.wfile.write(body)
+            elif method in ('GET', 'HEAD') and parts == ['stats']:
+                self.send_json(self.server.cache.stats())
+            elif len(parts) == 2 and parts[0] == 'tracks' and method in ('GET', 'HEAD'):
+                self.send_track(parts[1], method == 'GET')
+            elif len(parts) == 2 and parts[0] == 'tracks' and method == 'PUT':
+                self.receive_track(parts[1])
+            else:
+                self.send_json({'error': "没有这个接口"}, 404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except ValueError as e:
+            self.send_json({'error': str(e)}, 400)
+        except Exception as e:
+            logger.exception("处理缓存请求出错")
+            self.send_json({'error': str(e)}, 500)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def send_track(self, song_id, with_body):
+        cache = self.server.cache
+        entry, source = cache.open(song_id)
+        if entry is None:
+            metrics.inc('flac_cache_requests_total', result='miss')
+            self.send_json({'error': "未缓存"}, 404)
+            return
+        with source:
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/flac')
+            self.send_header('Content-Length', str(entry['size']))
+            self.send_header('X-Content-SHA256', entry['sha256'])
+            self.send_header('X-Filename', quote(entry['filename'] or ''))
+            self.end_headers()
+            if not with_body:
+                return
+            # 发送的同时计算哈希：内容已损坏时删除条目（客户端按响应头校验也会丢弃这次传输）
+            size, sha256 = copy_with_hash(source, self.wfile)
+        if sha256 != entry['sha256']:
+            logger.warning(f"缓存的 {song_id} 内容损坏，已删除", extra={'phase': 'cache'})
+            cache.discard(song_id, entry['sha256'])
+            metrics.inc('flac_cache_requests_total', result='corrupt')
+            return
+        metrics.inc('flac_cache_requests_total', result='hit')
+        metrics.inc('flac_cache_bytes_total', size, direction='served')
+
+    def receive_track(self, song_id):
+        length = int(self.headers['Content-Length'])
+        source = LimitedReader(self.rfile, length)
+        filename = unquote(self.headers.get('X-Filename', '')) or f"{song_id}.flac"
+        sha256 = self.server.cache.put_stream(song_id, source, os.path.basename(filename),
+                                              self.headers.get('X-Content-SHA256'))
+        self.send_json({'sha256': sha256}, 201)
+
+
+class LimitedReader:
+    """只读取请求体的前 length 个字节（连接保持打开时 rfile 不会结束）"""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size):
+        if self.remaining <= 0:
+            return b''
+        chunk = self.stream.read(min(size, self.remaining))
+        self.remaining -= len(chunk)
+        return chunk
+
+
+def make_cache_server(cache, host=CACHE_HOST, port=CACHE_PORT, token=None):
+    server = ThreadingHTTPServer((host, port), CacheRequestHandler)
+    server.daemon_threads = True
+    server.cache = cache
+    server.token = token
+    return server
+
+
+class RemoteTrackCache:
+    """局域网缓存服务的客户端，接口与 TrackCache 的 fetch/put 相同"""
+
+    def __init__(self, base_url, token=None, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, method, song_id, data=None, headers=None):
+        import urllib.request
+
+        req = urllib.request.Request(f"{self.base_url}/tracks/{quote(str(song_id), safe='')}", data=data,
+                                     method=method, headers=headers or {})
+        if self.token:
+            req.add_header('Authorization', f"Bearer {self.token}")
+        return urllib.request.urlopen(req, timeout=self.timeout)
+
+    def fetch(self, song_id, save_dir, filename=None):
+        """从缓存服务下载并按响应头的 SHA-256 校验，返回保存路径；未命中、损坏或服务不可用时返回 None"""
+        import urllib.error
+
+        try:
+            response = self.request('GET', song_id)
+        except urllib.error.HTTPError as e:
+            e.close()
+            metrics.inc('flac_cache_lookups_total', result='miss' if e.code == 404 else 'error')
+            return None
+        except OSError as e:
+            logger.warning(f"缓存服务不可用: {e}", extra={'phase': 'cache'})
+            metrics.inc('flac_cache_lookups_total', result='error')
+            return None
+
+        with response:
+            expected = response.headers.get('X-Content-SHA256')
+            name = filename or unquote(response.headers.get('X-Filename', '')) or f"{song_id}.flac"
+            path = unused_path(save_dir, os.path.basename(name))
+            part_path = path + ".part"
+            try:
+                with open(part_path, 'wb') as target:
+                    size, sha256 = copy_with_hash(response, target)
+            except OSError as e:
+                logger.warning(f"从缓存服务下载 {song_id} 失败: {e}", extra={'phase': 'cache'})
+                metrics.inc('flac_cache_lookups_total', result='error')
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                return None
+        if sha256 != expected:
+            os.remove(part_path)
+            logger.warning(f"缓存服务返回的 {song_id} 校验失败，改为从站点下载", extra={'phase': 'cache'})
+            metrics.inc('flac_cache_lookups_total', result='corrupt')
+            return None
+        os.replace(part_path, path)
+        metrics.inc('flac_cache_lookups_total', result='hit')
+        metrics.inc('flac_cache_bytes_total', size, direction='fetched')
+        return path
+
+    def put(self, song_id, path, filename=None):
+        """上传到缓存服务，返回内容的 SHA-256"""
+        sha256 = file_sha256(path)
+        headers = {'Content-Length': str(os.path.getsize(path)), 'Content-Type': 'audio/flac',
+                   'X-Content-SHA256': sha256, 'X-Filename': quote(filename or os.path.basename(path))}
+        with open(path, 'rb') as f, self.request('PUT', song_id, f, headers):
+            pass
+        metrics.inc('flac_cache_bytes_total', os.path.getsize(path), direction='stored')
+        return sha256
+
+
+def open_track_cache(spec, token=None, max_bytes=TRACK_CACHE_MAX_BYTES):
+    """按参数打开缓存：http(s):// 开头为局域网缓存服务，否则为本地缓存目录"""
+    if spec.startswith(('http://', 'https://')):
+        return RemoteTrackCache(spec, token)
+    return TrackCache(os.path.abspath(os.path.expanduser(spec)), max_bytes)
+
+
+def add_cache_arguments(parser):
+    """下载前端共用的缓存参数"""
+    parser.add_argument('--cache', default=os.environ.get('FLAC_TRACK_CACHE'), metavar='DIR_OR_URL',
+                        help="曲目缓存：本地目录或局域网缓存服务地址（也可用环境变量 FLAC_TRACK_CACHE）")
+    parser.add_argument('--cache-token', default=os.environ.get('FLAC_CACHE_TOKEN'),
+                        help="缓存服务的访问令牌（也可用环境变量 FLAC_CACHE_TOKEN）")
+
+
+def track_cache_from_args(args):
+    """按参数打开曲目缓存，未设置或打开失败时返回 None（不影响下载）"""
+    if not args.cache:
+        return None
+    try:
+        return open_track_cache(args.cache, args.cache_token)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"曲目缓存不可用: {e}")
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="无损音乐下载器曲目缓存：按内容寻址存放已下载的曲目，供局域网内其他机器直接取用")
+    parser.add_argument('command', choices=('serve', 'stats', 'verify'),
+                        help="serve 提供局域网缓存服务，stats 查看占用，verify 校验全部文件并删除损坏的条目")
+    parser.add_argument('-d', '--dir', default=TRACK_CACHE_DIR, help="缓存目录（默认 %(default)s）")
+    parser.add_argument('--max-size', type=float, default=TRACK_CACHE_MAX_BYTES / 1024 ** 3, metavar='GB',
+                        help="容量上限（GB，默认 %(default)s）")
+    parser.add_argument('--host', default=CACHE_HOST, help="监听地址（默认 %(default)s，局域网共用时设为 0.0.0.0）")
+    parser.add_argument('--port', type=int, default=CACHE_PORT, help="监听端口（默认 %(default)s）")
+    parser.add_argument('--token', default=os.environ.get('FLAC_CACHE_TOKEN'),
+                        help="访问令牌（也可用环境变量 FLAC_CACHE_TOKEN）")
+    args = parser.parse_args(argv)
+
+    setup_logging(level=logging.INFO, stream=sys.stderr)
+    cache = TrackCache(os.path.abspath(os.path.expanduser(args.dir)), int(args.max_size * 1024 ** 3))
+    if args.command == 'stats':
+        print(json.dumps(cache.stats(), ensure_ascii=False))
+        return 0
+    if args.command == 'verify':
+        checked, removed = cache.verify()
+        print(json.dumps({'checked': checked, 'removed': removed, **cache.stats()}, ensure_ascii=False))
+        return 0
+
+    metrics.set('flac_info', 1, mode='cache')
+    cache.evict()
+    server = make_cache_server(cache, args.host, args.port, args.token)
+    if args.host not in ('127.0.0.1', 'localhost', '::1') and not args.token:
+        logger.warning("监听非本机地址且未设置访问令牌，局域网内任何人都可以读取和写入缓存")
+    logger.info(f"缓存服务已启动: http://{args.host}:{server.server_address[1]}/stats，缓存目录 {cache.root}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
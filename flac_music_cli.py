@@ -0,0 +1,280 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from flac_music_cache import add_cache_arguments, track_cache_from_args
+from flac_music_core import (
+    DEFAULT_DOWNLOAD_DIR, DOWNLOAD_WORKERS, IMPORT_CONCURRENCY, IMPORT_RATE_LIMIT, SONG_INDEX_PATH,
+    DownloadCancelled, DownloadScheduler, DownloadService, MetricsExporter, MusicClient, PlaylistImporter,
+    RateLimiter, SongIndex, SongRecord, TaskControl, add_quality_arguments, add_schedule_arguments,
+    default_source_providers, logger, metrics, quality_policy_from_args, schedule_windows_from_args, setup_logging,
+)
+
+# 同一任务的下载进度事件最小间隔（秒）
+PROGRESS_EVENT_INTERVAL = 1.0
+
+# 退出码：全部成功、部分失败或未匹配、会话初始化失败、被中断
+EXIT_OK = 0
+EXIT_INCOMPLETE = 1
+EXIT_SESSION_FAILED = 2
+EXIT_INTERRUPTED = 130
+
+
+class JsonLinesWriter:
+    """进度和结果事件：每行一个 JSON 对象写到标准输出（多线程安全）"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        line = json.dumps({'event': event, 'time': round(time.time(), 3), **fields},
+                          ensure_ascii=False, default=str)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+def song_fields(song):
+    """事件中的歌曲信息"""
+    return {'song_id': song.id, 'name': song.name, 'artist': song.artist, 'album': song.album_name}
+
+
+class HeadlessDownloader:
+    """无界面批量下载：解析查询、歌曲ID和歌单文件后交给下载服务并发下载，以 JSON 行输出进度和结果"""
+
+    def __init__(self, client, output_dir, workers=DOWNLOAD_WORKERS, rate_limit=0, events=None, quality_policy=None,
+                 windows=()):
+        self.client = client
+        self.output_dir = output_dir
+        self.events = events or JsonLinesWriter()
+        # 所有下载共享的带宽令牌桶（字节/秒），桶容量不小于一个数据块
+        self.limiter = RateLimiter(rate_limit, max(rate_limit, 64 * 1024)) if rate_limit > 0 else None
+        self.control = TaskControl()  # 中断时取消全部任务
+        self.service = DownloadService(self.run_job, workers, prepare_job=self.prepare_job, on_idle=self.on_idle,
+                                       bulk_rate_while_interactive=0)
+        # 音质策略按下载队列中尚未开始的任务数分配剩余时间
+        self.quality_policy = quality_policy
+        if quality_policy is not None:
+            quality_policy.remaining = lambda: sum(self.service.totals()['pending'].values())
+        # 下载时段：按时段调整并发数和带宽上限（不在任何时段内时排队等待）
+        self.scheduler = DownloadScheduler(self.service, windows, self.on_schedule_change) if windows else None
+        self.finished = threading.Event()
+        self.totals = {'total': 0, 'done': 0, 'succeeded': 0}
+        self.queued = 0
+        self.unmatched = 0
+        self.source = None  # 正在加入的歌曲来源（只在主线程加入）
+        self.started = time.monotonic()
+
+    def search(self, keywords, page_size):
+        return self.client.search_music_with_session(
+            keywords, self.client.sl_session, self.client.sl_jwt_session, 1, page_size)[0]
+
+    def enqueue(self, song, source):
+        """加入下载队列，已在队列中的歌曲跳过"""
+        self.source = source
+        if self.service.submit([song], self.output_dir):
+            self.queued += 1
+        else:
+            self.events.emit('skipped', reason='duplicate', source=source, song_id=song.id)
+
+    def add_ids(self, song_ids):
+        """按歌曲ID加入：本地索引中有记录时带上 sign/time"""
+        for song_id in song_ids:
+            song = self.client.song_index.get_song(song_id) if self.client.song_index is not None else None
+            self.enqueue(song or SongRecord(song_id), 'id')
+
+    def add_queries(self, queries, per_query):
+        """按关键词搜索，下载排名前 per_query 的结果"""
+        for keywords in queries:
+            songs = self.search(keywords, per_query)[:per_query]
+            if not songs:
+                self.unmatched += 1
+                self.events.emit('unmatched', source='query', query=keywords)
+            for song in songs:
+                self.enqueue(song, 'query')
+
+    def add_playlist(self, path, concurrency, search_rate):
+        """解析歌单文件（文本/CSV/M3U），每行取最佳匹配"""
+        importer = PlaylistImporter(self.search, self.client.song_index, concurrency, search_rate, self.client.log)
+        entries = importer.parse_file(path)
+        self.events.emit('playlist', path=path, entries=len(entries))
+        for result in importer.resolve(entries):
+            entry = result['entry']
+            if result['song'] is None:
+                self.unmatched += 1
+                self.events.emit('unmatched', source='file', line=entry['line'], raw=entry['raw'],
+                                 status=result['status'], candidates=result['candidates'])
+            else:
+                self.enqueue(result['song'], f"file:{entry['line']}")
+
+    def prepare_job(self, job):
+        """任务入队前回调（持有下载服务的锁，先于工作线程开始下载）"""
+        job.control = TaskControl(self.control)
+        self.events.emit('queued', task=job.index, source=self.source, **song_fields(job.song))
+
+    def run_job(self, job):
+        """下载服务工作线程执行一项任务"""
+        song = job.song
+        filename = self.client.song_filename(song)
+        started = time.monotonic()
+        last_event = [0.0]
+
+        def on_progress(tracker):
+            now = time.monotonic()
+            if now - last_event[0] >= PROGRESS_EVENT_INTERVAL:
+                last_event[0] = now
+                self.events.emit('progress', task=job.index, song_id=song.id, bytes=tracker.downloaded,
+                                 total=tracker.total_size, percent=round(tracker.progress, 1),
+                                 speed=round(tracker.speed))
+
+        def throttle(nbytes):
+            self.service.throttle(job, nbytes)
+            if self.limiter is not None:
+                self.limiter.acquire(nbytes)
+
+        self.events.emit('start', task=job.index, song_id=song.id)
+        try:
+            job.control.check()
+            path = self.client.download_song(song, job.download_dir, filename, job.index, job.control,
+                                             throttle=throttle, on_progress=on_progress,
+                                             policy=self.quality_policy)
+        except DownloadCancelled:
+            self.events.emit('cancelled', task=job.index, song_id=song.id)
+            return False
+        except Exception as e:
+            self.events.emit('failed', task=job.index, song_id=song.id, error=str(e),
+                             duration=round(time.monotonic() - started, 3))
+            return False
+
+        self.events.emit('done', task=job.index, song_id=song.id, path=path, bytes=os.path.getsize(path),
+                         duration=round(time.monotonic() - started, 3))
+        return True
+
+    def on_schedule_change(self, window):
+        self.events.emit('schedule', **self.scheduler.status())
+
+    def on_idle(self, totals):
+        self.totals = totals
+        self.finished.set()
+
+    def run(self, song_ids=(), queries=(), playlist=None, per_query=1, concurrency=IMPORT_CONCURRENCY,
+            search_rate=IMPORT_RATE_LIMIT, songs=(), song_source='song'):
+        """加入全部输入并等待下载结束，返回退出码；解析期间已匹配的歌曲即开始下载
+
+        songs 为已解析好的歌曲（可以是边产出边下载的生成器），事件中的来源记为 song_source。
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.quality_policy is not None:
+            self.quality_policy.begin()
+        if self.scheduler is not None:
+            self.scheduler.start()
+        self.service.hold()
+        try:
+            self.add_ids(song_ids)
+            self.add_queries(queries, per_query)
+            if playlist:
+                self.add_playlist(playlist, concurrency, search_rate)
+            for song in songs:
+                self.enqueue(song, song_source)
+        finally:
+            self.service.release()
+
+        if self.queued:
+            self.finished.wait()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        succeeded = self.totals['succeeded']
+        failed = self.queued - succeeded
+        quality = dict(self.quality_policy.chosen) if self.quality_policy is not None else None
+        self.events.emit('summary', queued=self.queued, succeeded=succeeded, failed=failed,
+                         unmatched=self.unmatched, elapsed=round(time.monotonic() - self.started, 3),
+                         quality=quality)
+        return EXIT_OK if failed == 0 and self.unmatched == 0 else EXIT_INCOMPLETE
+
+    def cancel(self, timeout=5):
+        """取消全部任务，等待正在下载的任务清理临时文件"""
+        self.control.cancel()
+        self.service.discard_cancelled()
+        self.finished.wait(timeout)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="无损音乐下载器（无界面模式）：进度和结果以 JSON 行输出到标准输出，日志输出到标准错误")
+    parser.add_argument('queries', nargs='*', metavar='QUERY', help="搜索关键词，下载排名靠前的结果")
+    parser.add_argument('--id', dest='song_ids', action='append', default=[], metavar='SONG_ID',
+                        help="按歌曲ID下载（可重复）")
+    parser.add_argument('-i', '--input', metavar='FILE', help="歌单文件（每行 \"歌手 - 歌名\"，或 CSV/M3U）")
+    parser.add_argument('-o', '--output', default=DEFAULT_DOWNLOAD_DIR, help="下载目录（默认 %(default)s）")
+    parser.add_argument('-j', '--concurrency', type=int, default=DOWNLOAD_WORKERS,
+                        help="并发下载数（默认 %(default)s）")
+    parser.add_argument('--rate-limit', type=float, default=0, metavar='KBPS',
+                        help="全部下载合计的带宽上限（KB/s，0 表示不限制）")
+    parser.add_argument('--per-query', type=int, default=1, metavar='N', help="每个关键词下载的结果数（默认 1）")
+    parser.add_argument('--search-concurrency', type=int, default=IMPORT_CONCURRENCY,
+                        help="歌单解析的并发搜索数（默认 %(default)s）")
+    parser.add_argument('--search-rate', type=float, default=IMPORT_RATE_LIMIT,
+                        help="歌单解析每秒最多搜索次数（默认 %(default)s）")
+    parser.add_argument('--no-index', action='store_true', help="不读写本地歌曲索引")
+    parser.add_argument('--source-dir', dest='source_dirs', action='append', default=[], metavar='DIR',
+                        help="额外的本地目录来源（可重复，也可用环境变量 FLAC_SOURCE_DIRS），站点没有或失败时使用")
+    add_cache_arguments(parser)
+    add_quality_arguments(parser)
+    add_schedule_arguments(parser)
+    parser.add_argument('-q', '--quiet', action='store_true', help="标准错误只输出警告和错误日志")
+    args = parser.parse_args(argv)
+    if not (args.queries or args.song_ids or args.input):
+        parser.error("需要至少一个关键词、--id 或 --input")
+    if args.concurrency < 1:
+        parser.error("--concurrency 至少为 1")
+    try:
+        args.quality_policy = quality_policy_from_args(args)
+        args.schedule_windows = schedule_windows_from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(level=logging.WARNING if args.quiet else logging.INFO, stream=sys.stderr)
+
+    metrics.set('flac_info', 1, mode='headless')
+    try:
+        MetricsExporter(metrics).start()
+    except OSError as e:
+        logger.warning(f"指标导出不可用: {e}")
+
+    song_index = None
+    if not args.no_index:
+        try:
+            song_index = SongIndex(SONG_INDEX_PATH)
+        except Exception as e:
+            logger.warning(f"本地歌曲索引不可用: {e}")
+
+    events = JsonLinesWriter()
+    client = MusicClient(song_index, providers=default_source_providers(directories=args.source_dirs))
+    client.track_cache = track_cache_from_args(args)
+    if not client.init_session():
+        events.emit('session', status='failed')
+        return EXIT_SESSION_FAILED
+    events.emit('session', status='ok')
+
+    downloader = HeadlessDownloader(client, os.path.abspath(os.path.expanduser(args.output)), args.concurrency,
+                                    int(args.rate_limit * 1024), events, args.quality_policy, args.schedule_windows)
+    try:
+        return downloader.run(args.song_ids, args.queries, args.input, args.per_query,
+                              args.search_concurrency, args.search_rate)
+    except KeyboardInterrupt:
+        downloader.cancel()
+        events.emit('interrupted', queued=downloader.queued)
+        return EXIT_INTERRUPTED
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,599 @@
+import argparse
+import itertools
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from flac_music_cache import add_cache_arguments, track_cache_from_args
+from flac_music_cli import JsonLinesWriter, song_fields
+from flac_music_core import (
+    DEFAULT_DOWNLOAD_DIR, DOWNLOAD_WORKERS, IMPORT_CONCURRENCY, IMPORT_RATE_LIMIT, SONG_INDEX_PATH,
+    DownloadCancelled, MetricsExporter, MusicClient, PlaylistImporter, RateLimiter, SongIndex, SongRecord,
+    TaskControl, logger, metrics, setup_logging,
+)
+
+# 任务租约：有效期（秒）和续约间隔（秒，不超过有效期的 1/3），工作节点停止续约后任务在租约到期时被其他节点收回
+CLUSTER_LEASE_SECONDS = 90
+CLUSTER_HEARTBEAT_INTERVAL = 20
+
+# 同一首歌最多尝试的次数（含租约过期被收回的次数），超过后标记为失败
+CLUSTER_MAX_ATTEMPTS = 3
+
+# 没有可领取的任务但仍有其他节点在下载时，重新检查的间隔（秒）
+CLUSTER_POLL_INTERVAL = 5
+
+# 汇总吞吐量时统计最近多少秒内完成的任务
+CLUSTER_THROUGHPUT_WINDOW = 60
+
+# 退出码：队列全部完成、有失败的任务、被中断
+EXIT_OK = 0
+EXIT_INCOMPLETE = 1
+EXIT_SESSION_FAILED = 2
+EXIT_INTERRUPTED = 130
+
+
+class WorkQueue:
+    """多节点共享的任务队列（SQLite 文件，可放在共享目录中）
+
+    工作节点领取任务时获得带有效期的租约，下载期间定时续约；
+    节点退出或失联后租约到期，任务由其他节点重新领取。
+    网络文件系统上不使用 WAL（需要共享内存），写事务依赖文件锁串行化。
+    """
+
+    SONG_COLUMNS = ('song_id', 'name', 'artist', 'album_name', 'duration', 'format', 'sign', 'time')
+
+    def __init__(self, db_path, lease_seconds=CLUSTER_LEASE_SECONDS, max_attempts=CLUSTER_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.create_schema()
+
+    def create_schema(self):
+        with self.lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY,
+                    song_id TEXT UNIQUE NOT NULL,
+                    name TEXT,
+                    artist TEXT,
+                    album_name TEXT,
+                    duration TEXT,
+                    format TEXT,
+                    sign TEXT,
+                    time TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    path TEXT,
+                    error TEXT,
+                    added REAL,
+                    started REAL,
+                    finished REAL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    worker_id TEXT PRIMARY KEY,
+                    host TEXT,
+                    pid INTEGER,
+                    started REAL,
+                    last_seen REAL,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    bytes INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+
+    def transaction(self, func, *args):
+        """在写事务中执行 func(conn, *args)：BEGIN IMMEDIATE 立即取得写锁，多个节点同时领取时不会拿到同一任务"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self.conn, *args)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def add_songs(self, songs):
+        """加入歌曲，已在队列中的歌曲跳过，返回新加入的数量"""
+        now = time.time()
+        rows = [(song.id, song.name, song.artist, song.album_name, song.duration, song.format, song.sign,
+                 song.time, now) for song in songs]
+
+        def insert(conn):
+            before = conn.total_changes
+            conn.executemany(
+                f"INSERT OR IGNORE INTO jobs ({', '.join(self.SONG_COLUMNS)}, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows)
+            return conn.total_changes - before
+
+        return self.transaction(insert)
+
+    def register_worker(self, worker_id):
+        now = time.time()
+        self.transaction(lambda conn: conn.execute(
+            "INSERT INTO workers (worker_id, host, pid, started, last_seen) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(worker_id) DO UPDATE SET host = excluded.host, pid = excluded.pid, "
+            "started = excluded.started, last_seen = excluded.last_seen",
+            (worker_id, socket.gethostname(), os.getpid(), now, now)))
+
+    def claim(self, worker_id):
+        """领取一项任务：待下载的任务优先，其次是租约已过期的任务；没有可领取的任务时返回 None"""
+        def take(conn):
+            now = time.time()
+            row = conn.execute(
+                f"SELECT seq, status, worker, attempts, {', '.join(self.SONG_COLUMNS)} FROM jobs "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) ORDER BY status = 'leased', seq LIMIT 1",
+                (now,)).fetchone()
+            if row is None:
+                return None
+            seq, status, previous_worker, attempts = row[:4]
+            song = SongRecord(*row[4:])
+            reclaimed = status == 'leased'
+            if reclaimed and attempts >= self.max_attempts:
+                # 多次在下载中途失联的任务不再重试
+                conn.execute("UPDATE jobs SET status = 'failed', worker = NULL, lease_until = NULL, error = ?, "
+                             "finished = ? WHERE seq = ?", (f"租约多次过期（最后由 {previous_worker} 领取）", now, seq))
+                return take(conn)
+            conn.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                         "started = ?, error = NULL WHERE seq = ?", (worker_id, now + self.lease_seconds, now, seq))
+            conn.execute("UPDATE workers SET last_seen = ? WHERE worker_id = ?", (now, worker_id))
+            return song, previous_worker if reclaimed else None
+
+        claimed = self.transaction(take)
+        if claimed is None:
+            return None
+        song, previous_worker = claimed
+        if previous_worker:
+            metrics.inc('flac_cluster_jobs_total', result='reclaimed')
+            logger.info(f"收回租约已过期的任务 {song.id}（原节点 {previous_worker}）", extra={'phase': 'cluster'})
+        return song
+
+    def heartbeat(self, worker_id, song_ids):
+        """续约本节点正在下载的任务，返回仍由本节点持有的歌曲ID（其余已被收回，应停止下载）"""
+        song_ids = list(song_ids)
+
+        def renew(conn):
+            now = time.time()
+            conn.execute("UPDATE workers SET last_seen = ? WHERE worker_id = ?", (now, worker_id))
+            held = set()
+            for song_id in song_ids:
+                cursor = conn.execute("UPDATE jobs SET lease_until = ? WHERE song_id = ? AND worker = ? "
+                                      "AND status = 'leased'", (now + self.lease_seconds, song_id, worker_id))
+                if cursor.rowcount:
+                    held.add(song_id)
+            return held
+
+        return self.transaction(renew)
+
+    def complete(self, worker_id, song_id, nbytes, path):
+        """报告下载完成，返回是否记录成功（租约已被其他节点收回时不记录，文件以对方为准）"""
+        def finish(conn):
+            now = time.time()
+            cursor = conn.execute("UPDATE jobs SET status = 'done', bytes = ?, path = ?, lease_until = NULL, "
+                                  "finished = ? WHERE song_id = ? AND worker = ? AND status = 'leased'",
+                                  (nbytes, path, now, song_id, worker_id))
+            if cursor.rowcount:
+                conn.execute("UPDATE workers SET done = done + 1, bytes = bytes + ?, last_seen = ? "
+                             "WHERE worker_id = ?", (nbytes, now, worker_id))
+            return bool(cursor.rowcount)
+
+        recorded = self.transaction(finish)
+        metrics.inc('flac_cluster_jobs_total', result='done' if recorded else 'lost')
+        return recorded
+
+    def fail(self, worker_id, song_id, error):
+        """报告下载失败：未达到最大尝试次数时放回队列，返回是否最终失败"""
+        def record(conn):
+            now = time.time()
+            row = conn.execute("SELECT attempts FROM jobs WHERE song_id = ? AND worker = ? AND status = 'leased'",
+                               (song_id, worker_id)).fetchone()
+            if row is None:
+                return None
+            final = row[0] >= self.max_attempts
+            conn.execute("UPDATE jobs SET status = ?, worker = CASE WHEN ? THEN worker END, lease_until = NULL, "
+                         "error = ?, finished = ? WHERE song_id = ?",
+                         ('failed' if final else 'pending', final, error, now if final else None, song_id))
+            if final:
+                conn.execute("UPDATE workers SET failed = failed + 1, last_seen = ? WHERE worker_id = ?",
+                             (now, worker_id))
+            return final
+
+        final = self.transaction(record)
+        if final:
+            metrics.inc('flac_cluster_jobs_total', result='failed')
+        return bool(final)
+
+    def release(self, worker_id, song_id):
+        """放回未完成的任务（节点正常退出时），不计入尝试次数"""
+        self.transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL, lease_until = NULL, attempts = attempts - 1 "
+            "WHERE song_id = ? AND worker = ? AND status = 'leased'", (song_id, worker_id)))
+
+    def retry_failed(self):
+        """把失败的任务重新放回队列，返回数量"""
+        return self.transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL, attempts = 0, error = NULL, finished = NULL "
+            "WHERE status = 'failed'").rowcount)
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT status, COUNT(*), SUM(bytes) FROM jobs GROUP BY status").fetchall()
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0, 'bytes': 0}
+        for status, count, nbytes in rows:
+            counts[status] = count
+            counts['bytes'] += nbytes or 0
+        counts['total'] = counts['pending'] + counts['leased'] + counts['done'] + counts['failed']
+        return counts
+
+    def stats(self, window=CLUSTER_THROUGHPUT_WINDOW):
+        """汇总队列进度和各节点吞吐量（最近 window 秒内完成的任务）"""
+        now = time.time()
+        since = now - window
+        with self.lock:
+            first_started, last_finished = self.conn.execute(
+                "SELECT MIN(started), MAX(finished) FROM jobs WHERE status = 'done'").fetchone()
+            recent = dict((worker, (count, nbytes)) for worker, count, nbytes in self.conn.execute(
+                "SELECT worker, COUNT(*), SUM(bytes) FROM jobs WHERE status = 'done' AND finished >= ? "
+                "GROUP BY worker", (since,)))
+            active = dict(self.conn.execute(
+                "SELECT worker, COUNT(*) FROM jobs WHERE status = 'leased' AND lease_until >= ? GROUP BY worker",
+                (now,)))
+            workers = self.conn.execute(
+                "SELECT worker_id, host, pid, started, last_seen, done, failed, bytes FROM workers "
+                "ORDER BY started").fetchall()
+
+        counts = self.counts()
+        nodes = []
+        for worker_id, host, pid, started, last_seen, done, failed, nbytes in workers:
+            recent_done, recent_bytes = recent.get(worker_id, (0, 0))
+            nodes.append({
+                'worker': worker_id, 'host': host, 'pid': pid, 'done': done, 'failed': failed, 'bytes': nbytes,
+                'active': active.get(worker_id, 0),
+                'alive': now - last_seen < self.lease_seconds,
+                'songs_per_min': round(recent_done * 60 / window, 2),
+                'bytes_per_sec': round((recent_bytes or 0) / window),
+            })
+
+        elapsed = (last_finished - first_started) if first_started and last_finished else 0
+        return {
+            'jobs': counts,
+            'workers': nodes,
+            'window': window,
+            'bytes_per_sec': sum(node['bytes_per_sec'] for node in nodes),
+            'songs_per_min': round(sum(node['songs_per_min'] for node in nodes), 2),
+            'average_bytes_per_sec': round(counts['bytes'] / elapsed) if elapsed > 0 else 0,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ClusterWorker:
+    """一个工作节点：用自己的会话和带宽从共享队列领取任务下载，直到队列中没有待下载和下载中的任务"""
+
+    def __init__(self, work_queue, client, output_dir, worker_id=None, concurrency=DOWNLOAD_WORKERS, rate_limit=0,
+                 events=None):
+        self.queue = work_queue
+        self.client = client
+        self.output_dir = output_dir
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.concurrency = concurrency
+        self.events = events or JsonLinesWriter()
+        self.limiter = RateLimiter(rate_limit, max(rate_limit, 64 * 1024)) if rate_limit > 0 else None
+        self.control = TaskControl()  # 中断时取消本节点的全部任务
+        self.heartbeat_interval = min(CLUSTER_HEARTBEAT_INTERVAL, work_queue.lease_seconds / 3)
+        self.stop_event = threading.Event()
+
+        self.lock = threading.Lock()
+        self.active = {}  # 歌曲ID -> TaskControl
+        self.lost = set()  # 租约被其他节点收回的歌曲ID
+        self.task_ids = itertools.count(1)
+        self.totals = {'done': 0, 'failed': 0, 'requeued': 0, 'lost': 0, 'bytes': 0}
+
+    def throttle(self, nbytes):
+        if self.limiter is not None:
+            self.limiter.acquire(nbytes)
+
+    def run(self):
+        """运行到队列清空或被中断，返回退出码"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.queue.register_worker(self.worker_id)
+        self.events.emit('worker', worker=self.worker_id, concurrency=self.concurrency, queue=self.queue.db_path)
+        started = time.monotonic()
+
+        heartbeat = threading.Thread(target=self.heartbeat_loop, name="cluster-heartbeat", daemon=True)
+        heartbeat.start()
+        threads = [threading.Thread(target=self.work_loop, name=f"cluster-worker-{i}", daemon=True)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.stop_event.set()
+
+        self.events.emit('summary', worker=self.worker_id, elapsed=round(time.monotonic() - started, 3),
+                         **self.totals)
+        if self.control.is_cancelled:
+            return EXIT_INTERRUPTED
+        return EXIT_OK if self.queue.counts()['failed'] == 0 else EXIT_INCOMPLETE
+
+    def work_loop(self):
+        while not self.control.is_cancelled:
+            song = self.queue.claim(self.worker_id)
+            if song is None:
+                counts = self.queue.counts()
+                if counts['pending'] == 0 and counts['leased'] == 0:
+                    return
+                # 其余任务在其他节点下载中：等待它们完成，或租约过期后收回
+                self.stop_event.wait(CLUSTER_POLL_INTERVAL)
+                continue
+            self.run_job(song)
+
+    def run_job(self, song):
+        task_id = next(self.task_ids)
+        control = TaskControl(self.control)
+        with self.lock:
+            self.active[song.id] = control
+        filename = self.client.song_filename(song)
+        started = time.monotonic()
+        self.events.emit('start', task=task_id, worker=self.worker_id, **song_fields(song))
+        try:
+            control.check()
+            path = self.client.download_song(song, self.output_dir, filename, task_id, control,
+                                             throttle=self.throttle)
+        except DownloadCancelled:
+            with self.lock:
+                lost = song.id in self.lost
+                self.lost.discard(song.id)
+            if lost:
+                self.events.emit('lost', task=task_id, song_id=song.id)
+                self.count('lost')
+            else:
+                self.queue.release(self.worker_id, song.id)
+                self.events.emit('cancelled', task=task_id, song_id=song.id)
+            return
+        except Exception as e:
+            final = self.queue.fail(self.worker_id, song.id, str(e))
+            self.events.emit('failed', task=task_id, song_id=song.id, error=str(e), final=final,
+                             duration=round(time.monotonic() - started, 3))
+            self.count('failed' if final else 'requeued')
+            return
+        finally:
+            with self.lock:
+                self.active.pop(song.id, None)
+
+        nbytes = os.path.getsize(path)
+        if self.queue.complete(self.worker_id, song.id, nbytes, path):
+            self.events.emit('done', task=task_id, song_id=song.id, path=path, bytes=nbytes,
+                             duration=round(time.monotonic() - started, 3))
+            self.count('done', nbytes)
+        else:
+            self.events.emit('lost', task=task_id, song_id=song.id, path=path)
+            self.count('lost')
+
+    def count(self, result, nbytes=0):
+        with self.lock:
+            self.totals[result] += 1
+            self.totals['bytes'] += nbytes
+
+    def heartbeat_loop(self):
+        """定时续约；续约失败的任务（已被其他节点收回）立即停止下载"""
+        while not self.stop_event.wait(self.heartbeat_interval):
+            with self.lock:
+                active = dict(self.active)
+            try:
+                held = self.queue.heartbeat(self.worker_id, active)
+            except sqlite3.Error as e:
+                logger.warning(f"任务续约失败: {e}", extra={'phase': 'cluster'})
+                continue
+            for song_id, control in active.items():
+                if song_id not in held:
+                    logger.warning(f"任务 {song_id} 的租约已被其他节点收回，停止下载", extra={'phase': 'cluster'})
+                    with self.lock:
+                        self.lost.add(song_id)
+                    control.cancel()
+
+    def cancel(self, timeout=5):
+        """取消本节点的全部任务并放回队列"""
+        self.control.cancel()
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        while self.active and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+def load_songs(client, song_ids=(), queries=(), playlist=None, per_query=1, concurrency=IMPORT_CONCURRENCY,
+               search_rate=IMPORT_RATE_LIMIT, events=None):
+    """把歌曲ID、搜索关键词和歌单文件解析为歌曲列表，返回 (歌曲列表, 未匹配数)"""
+    events = events or JsonLinesWriter()
+    songs = []
+    unmatched = 0
+    for song_id in song_ids:
+        song = client.song_index.get_song(song_id) if client.song_index is not None else None
+        songs.append(song or SongRecord(song_id))
+
+    def search(keywords, page_size):
+        return client.search_music_with_session(keywords, client.sl_session, client.sl_jwt_session, 1,
+                                                page_size)[0]
+
+    for keywords in queries:
+        found = search(keywords, per_query)[:per_query]
+        if not found:
+            unmatched += 1
+            events.emit('unmatched', source='query', query=keywords)
+        songs.extend(found)
+
+    if playlist:
+        importer = PlaylistImporter(search, client.song_index, concurrency, search_rate, client.log)
+        for result in importer.resolve(importer.parse_file(playlist)):
+            if result['song'] is None:
+                unmatched += 1
+                events.emit('unmatched', source='file', line=result['entry']['line'], raw=result['entry']['raw'],
+                            status=result['status'])
+            else:
+                songs.append(result['song'])
+    return songs, unmatched
+
+
+def format_stats(stats):
+    """队列进度和各节点吞吐量的文字报告"""
+    jobs = stats['jobs']
+    lines = [f"任务: 共 {jobs['total']}，完成 {jobs['done']}，下载中 {jobs['leased']}，等待 {jobs['pending']}，"
+             f"失败 {jobs['failed']}，已下载 {jobs['bytes'] / 1048576:.1f}MB",
+             f"吞吐量（最近 {stats['window']} 秒）: {stats['songs_per_min']} 首/分钟，"
+             f"{stats['bytes_per_sec'] / 1024:.0f}KB/s；全程平均 {stats['average_bytes_per_sec'] / 1024:.0f}KB/s"]
+    for node in stats['workers']:
+        lines.append(f"  {node['worker']} ({node['host']}) {'在线' if node['alive'] else '离线'}: "
+                     f"下载中 {node['active']}，完成 {node['done']}，失败 {node['failed']}，"
+                     f"{node['songs_per_min']} 首/分钟，{node['bytes_per_sec'] / 1024:.0f}KB/s")
+    return "\n".join(lines)
+
+
+def open_song_index(no_index):
+    if no_index:
+        return None
+    try:
+        return SongIndex(SONG_INDEX_PATH)
+    except Exception as e:
+        logger.warning(f"本地歌曲索引不可用: {e}")
+        return None
+
+
+def command_add(args, events):
+    client = MusicClient(open_song_index(args.no_index))
+    if (args.queries or args.input) and not client.init_session():
+        events.emit('session', status='failed')
+        return EXIT_SESSION_FAILED
+    songs, unmatched = load_songs(client, args.song_ids, args.queries, args.input, args.per_query,
+                                  args.search_concurrency, args.search_rate, events)
+    work_queue = WorkQueue(args.queue)
+    added = work_queue.add_songs(songs)
+    events.emit('added', queue=args.queue, added=added, skipped=len(songs) - added, unmatched=unmatched,
+                **work_queue.counts())
+    return EXIT_OK if unmatched == 0 else EXIT_INCOMPLETE
+
+
+def command_work(args, events):
+    try:
+        MetricsExporter(metrics).start()
+    except OSError as e:
+        logger.warning(f"指标导出不可用: {e}")
+    client = MusicClient(open_song_index(args.no_index))
+    client.track_cache = track_cache_from_args(args)
+    if not client.init_session():
+        events.emit('session', status='failed')
+        return EXIT_SESSION_FAILED
+    events.emit('session', status='ok')
+
+    work_queue = WorkQueue(args.queue, args.lease)
+    worker = ClusterWorker(work_queue, client, os.path.abspath(os.path.expanduser(args.output)), args.worker_id,
+                           args.concurrency, int(args.rate_limit * 1024), events)
+    try:
+        return worker.run()
+    except KeyboardInterrupt:
+        worker.cancel()
+        events.emit('interrupted', worker=worker.worker_id)
+        return EXIT_INTERRUPTED
+
+
+def command_status(args, events):
+    work_queue = WorkQueue(args.queue)
+    if args.retry_failed:
+        events.emit('requeued', count=work_queue.retry_failed())
+    while True:
+        stats = work_queue.stats(args.window)
+        if args.json:
+            events.emit('status', **stats)
+        else:
+            print(format_stats(stats), flush=True)
+        jobs = stats['jobs']
+        if not args.watch or (jobs['pending'] == 0 and jobs['leased'] == 0):
+            return EXIT_OK if jobs['failed'] == 0 else EXIT_INCOMPLETE
+        time.sleep(args.watch)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="无损音乐下载器（多节点模式）：多台机器从共享目录中的任务队列领取歌曲，各自用自己的会话和带宽下载")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('add', help="把歌曲加入队列")
+    add.add_argument('queue', help="队列文件（SQLite，放在各节点都能访问的共享目录中）")
+    add.add_argument('queries', nargs='*', metavar='QUERY', help="搜索关键词，加入排名靠前的结果")
+    add.add_argument('--id', dest='song_ids', action='append', default=[], metavar='SONG_ID',
+                     help="按歌曲ID加入（可重复）")
+    add.add_argument('-i', '--input', metavar='FILE', help="歌单文件（每行 \"歌手 - 歌名\"，或 CSV/M3U）")
+    add.add_argument('--per-query', type=int, default=1, metavar='N', help="每个关键词加入的结果数（默认 1）")
+    add.add_argument('--search-concurrency', type=int, default=IMPORT_CONCURRENCY,
+                     help="歌单解析的并发搜索数（默认 %(default)s）")
+    add.add_argument('--search-rate', type=float, default=IMPORT_RATE_LIMIT,
+                     help="歌单解析每秒最多搜索次数（默认 %(default)s）")
+
+    work = commands.add_parser('work', help="作为工作节点下载队列中的歌曲，直到队列清空")
+    work.add_argument('queue', help="队列文件")
+    work.add_argument('-o', '--output', default=DEFAULT_DOWNLOAD_DIR, help="下载目录（默认 %(default)s）")
+    work.add_argument('-j', '--concurrency', type=int, default=DOWNLOAD_WORKERS,
+                      help="本节点的并发下载数（默认 %(default)s）")
+    work.add_argument('--rate-limit', type=float, default=0, metavar='KBPS',
+                      help="本节点的带宽上限（KB/s，0 表示不限制）")
+    work.add_argument('--worker-id', help="节点名称（默认 主机名-进程号-随机后缀）")
+    work.add_argument('--lease', type=float, default=CLUSTER_LEASE_SECONDS, metavar='SECONDS',
+                      help="任务租约有效期（默认 %(default)s 秒），节点失联超过此时间后任务由其他节点收回")
+    add_cache_arguments(work)
+
+    status = commands.add_parser('status', help="汇总队列进度和各节点吞吐量")
+    status.add_argument('queue', help="队列文件")
+    status.add_argument('--watch', type=float, default=0, metavar='SECONDS', help="每隔指定秒数刷新，直到队列清空")
+    status.add_argument('--window', type=float, default=CLUSTER_THROUGHPUT_WINDOW, metavar='SECONDS',
+                        help="吞吐量统计窗口（默认 %(default)s 秒）")
+    status.add_argument('--json', action='store_true', help="以 JSON 行输出")
+    status.add_argument('--retry-failed', action='store_true', help="把失败的任务重新放回队列")
+
+    for sub in (add, work):
+        sub.add_argument('--no-index', action='store_true', help="不读写本地歌曲索引")
+        sub.add_argument('-q', '--quiet', action='store_true', help="标准错误只输出警告和错误日志")
+    status.set_defaults(quiet=True)
+
+    args = parser.parse_args(argv)
+    if args.command == 'add' and not (args.queries or args.song_ids or args.input):
+        add.error("需要至少一个关键词、--id 或 --input")
+    if args.command == 'work' and args.concurrency < 1:
+        work.error("--concurrency 至少为 1")
+    if args.command == 'work' and args.lease <= 0:
+        work.error("--lease 必须大于 0")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(level=logging.WARNING if args.quiet else logging.INFO, stream=sys.stderr)
+    metrics.set('flac_info', 1, mode=f'cluster-{args.command}')
+    events = JsonLinesWriter()
+    commands = {'add': command_add, 'work': command_work, 'status': command_status}
+    try:
+        return commands[args.command](args, events)
+    except sqlite3.Error as e:
+        logger.error(f"任务队列不可用: {e}")
+        return EXIT_INCOMPLETE
+
+
+if __name__ == '__main__':
+    sys.exit(main())
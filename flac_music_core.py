@@ -0,0 +1,3278 @@
+import time
+import re
+import warnings
+import json
+import threading
+import os
+import sys
+from datetime import datetime
+import traceback
+import math
+import queue
+import collections
+import logging
+import logging.handlers
+import atexit
+import functools
+import sqlite3
+import unicodedata
+
+# 彻底地禁用所有警告
+warnings.filterwarnings("ignore")
+
+# 定义颜色方案
+COLORS = {
+    "primary": "#4A90E2",
+    "secondary": "#5C6BC0",
+    "success": "#66BB6A",
+    "warning": "#FFA726",
+    "danger": "#EF5350",
+    "dark": "#2C3E50",
+    "light": "#F5F7FA",
+    "gray": "#B0BEC5",
+    "text": "#37474F",
+    "text_light": "#78909C",
+    "bg_light": "#FFFFFF",
+    "bg_dark": "#F8F9FA"
+}
+
+# "下载全部"模式：翻页请求的每页数量、并发页数以及待下载队列的容量上限
+DOWNLOAD_ALL_PAGE_SIZE = 20
+DOWNLOAD_ALL_PAGE_CONCURRENCY = 3
+DOWNLOAD_ALL_QUEUE_SIZE = 40
+
+# 下载服务的并发下载数（工作线程数）
+DOWNLOAD_WORKERS = 3
+
+# 下载优先级通道：交互任务（手动选择的歌曲）优先于批量任务（下载全部/歌单导入）
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+LANE_NAMES = {LANE_INTERACTIVE: "交互", LANE_BULK: "批量"}
+# 批量任务排队时，每连续调度这么多个交互任务至少调度一个批量任务，避免批量任务饿死
+INTERACTIVE_BURST = 3
+# 有交互任务在下载时，批量任务合计的带宽上限（字节/秒），0 表示不限制
+BULK_RATE_WHILE_INTERACTIVE = 512 * 1024
+
+# 下载时段：检查是否进入新时段的间隔（秒）和时段规格中星期的写法
+SCHEDULE_CHECK_INTERVAL = 30
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# 歌单导入：并发搜索数和每秒最多搜索次数
+IMPORT_CONCURRENCY = 4
+IMPORT_RATE_LIMIT = 5
+
+# 音质档位（从高到低）：名称、显示名、站点请求的格式和码率参数、估算码率（kbps，取不到文件大小时按时长估算）
+QualityTier = collections.namedtuple('QualityTier', 'name label format bitrate kbps')
+QUALITY_TIERS = (
+    QualityTier('hires', "Hi-Res 无损", 'flac', 2000, 2300),
+    QualityTier('lossless', "16位无损", 'flac', 1000, 900),
+    QualityTier('mp3_320', "MP3 320k", 'mp3', 320, 320),
+    QualityTier('mp3_128', "MP3 128k", 'mp3', 128, 128),
+)
+# 批次的音质策略：总是最高、在时间预算内尽量高、每首封顶
+QUALITY_HIGHEST = 'highest'
+QUALITY_BUDGET = 'budget'
+QUALITY_CAP = 'cap'
+QUALITY_MODES = (QUALITY_HIGHEST, QUALITY_BUDGET, QUALITY_CAP)
+# 链路吞吐量：统计窗口（秒）、至少需要的有数据的秒数，以及尚未测到时假设的速度（字节/秒）
+LINK_THROUGHPUT_WINDOW = 30
+LINK_THROUGHPUT_MIN_SECONDS = 3
+LINK_THROUGHPUT_DEFAULT = 1024 * 1024
+# 时长未知的歌曲按此时长（秒）估算文件大小
+DEFAULT_TRACK_SECONDS = 240
+
+# 多来源搜索：每个来源的截止时间（秒），超过截止时间的来源结果到达后再追加
+SOURCE_SEARCH_DEADLINE = 8
+# 额外的本地目录来源（如局域网共享的曲库），多个目录用 os.pathsep 分隔
+SOURCE_DIRS_ENV = 'FLAC_SOURCE_DIRS'
+
+# 本地数据目录（歌曲索引等）
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".flac_music_downloader")
+SONG_INDEX_PATH = os.path.join(APP_DATA_DIR, "song_index.db")
+
+# 默认下载目录
+DEFAULT_DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), "MusicDownloads")
+
+# 日志：文件按大小轮转，日志面板保留最近的记录条数
+LOG_DIR = os.path.join(APP_DATA_DIR, "logs")
+LOG_FILE_MAX_BYTES = 2 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+LOG_BUFFER_SIZE = 2000
+
+# 指标：定期导出 Prometheus 文本文件（供 node exporter textfile collector 采集）和 JSON 快照
+METRICS_DIR = os.path.join(APP_DATA_DIR, "metrics")
+METRICS_EXPORT_INTERVAL = 15  # 秒
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+WRITE_STALL_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# 诊断模式：采样间隔（秒）、tracemalloc 保留的栈深度和内存快照列出的分配位置数
+DIAGNOSTICS_DIR = os.path.join(APP_DATA_DIR, "diagnostics")
+DIAGNOSTICS_SAMPLE_INTERVAL = 0.01
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 30
+
+# 日志记录可携带的结构化字段
+LOG_FIELDS = ('task_id', 'song_id', 'phase', 'bytes', 'duration')
+
+logger = logging.getLogger("flac_music")
+
+# 日志颜色对应的级别
+COLOR_LEVELS = {COLORS['danger']: logging.ERROR, "RED": logging.ERROR,
+                COLORS['warning']: logging.WARNING, "YELLOW": logging.WARNING}
+
+
+def import_requests():
+    """按需导入 requests（连同 urllib3 导入较慢，不放在启动路径上），并关闭证书警告"""
+    import requests
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return requests
+
+
+class StartupTimer:
+    """启动耗时记录：各阶段距开始导入模块的时间"""
+
+    PHASE_NAMES = {'import': "模块导入", 'widgets': "界面构建", 'first_paint': "首次绘制",
+                   'search_ready': "可以搜索"}
+
+    def __init__(self, started):
+        self.started = started
+        self.marks = {}
+        self.reported = False
+
+    def mark(self, phase):
+        """记录阶段完成时间（只记录第一次）"""
+        self.marks.setdefault(phase, time.perf_counter() - self.started)
+
+    def report(self):
+        """启动耗时报告文本"""
+        parts = [f"{self.PHASE_NAMES.get(phase, phase)} {elapsed * 1000:.0f}ms"
+                 for phase, elapsed in sorted(self.marks.items(), key=lambda item: item[1])]
+        return "启动耗时: " + "，".join(parts)
+
+
+class SecretRedactor:
+    """日志脱敏：会话 Cookie、JWT、令牌等凭据只保留前几位"""
+
+    KEEP = 4
+    JWT_PATTERN = re.compile(r'eyJ[\w-]{6,}\.[\w-]+\.[\w-]*')
+    KEY_VALUE_PATTERN = re.compile(
+        r'((?:sl[-_]session|sl[-_]jwt[-_]session|sl[-_]challenge[-_]jwt|jwt|token|client_?id|issue_?id|'
+        r'authorization|\bsign)["\']?\s*[=:]\s*["\']?(?:Bearer\s+)?)([^\s;,"\'&]+)', re.I)
+
+    def mask(self, value):
+        return value[:self.KEEP] + "***"
+
+    def redact(self, text):
+        if not text:
+            return text
+        text = self.JWT_PATTERN.sub(lambda m: self.mask(m.group(0)), text)
+        return self.KEY_VALUE_PATTERN.sub(lambda m: m.group(1) + self.mask(m.group(2)), text)
+
+
+def structured_fields(record):
+    """取出日志记录中的结构化字段"""
+    return {name: getattr(record, name) for name in LOG_FIELDS if getattr(record, name, None) is not None}
+
+
+class ConsoleLogFormatter(logging.Formatter):
+    """控制台格式：[时间] 消息 字段=值"""
+
+    def format(self, record):
+        text = f"[{self.formatTime(record, '%H:%M:%S')}] {record.getMessage()}"
+        fields = structured_fields(record)
+        if fields:
+            text += "  " + " ".join(f"{name}={value}" for name, value in fields.items())
+        return text
+
+
+class JsonLogFormatter(logging.Formatter):
+    """文件格式：每行一条 JSON 记录"""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+                 'level': record.levelname,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        entry.update(structured_fields(record))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogRingBuffer(logging.Handler):
+    """保留最近的日志记录，供日志面板显示"""
+
+    def __init__(self, capacity=LOG_BUFFER_SIZE):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)  # (序号, 记录)
+        self.sequence = 0
+
+    def emit(self, record):
+        self.sequence += 1
+        self.records.append((self.sequence, record))
+
+    def since(self, sequence):
+        """读取序号大于 sequence 的记录"""
+        with self.lock:
+            newer = []
+            for item in reversed(self.records):
+                if item[0] <= sequence:
+                    break
+                newer.append(item)
+        newer.reverse()
+        return newer
+
+
+class RedactingQueueListener(logging.handlers.QueueListener):
+    """后台日志线程：先脱敏，再写入控制台、文件和内存缓冲"""
+
+    def __init__(self, log_queue, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.redactor = SecretRedactor()
+
+    def prepare(self, record):
+        record.msg = self.redactor.redact(record.getMessage())
+        record.args = None
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if isinstance(value, str):
+                setattr(record, name, self.redactor.redact(value))
+        return record
+
+
+log_buffer = LogRingBuffer()
+
+
+def setup_logging(log_dir=LOG_DIR, console=True, level=logging.INFO, stream=None):
+    """配置日志：调用线程只把记录放入队列（不等待输出），后台线程脱敏后写入控制台、轮转文件和内存缓冲；
+    stream 为控制台输出流，默认标准输出"""
+    if logger.handlers:
+        return
+
+    handlers = [log_buffer]
+    log_buffer.setLevel(level)
+
+    # 打包成窗口程序时没有控制台
+    stream = stream or sys.stdout
+    if console and stream is not None:
+        console_handler = logging.StreamHandler(stream)
+        console_handler.setLevel(level)
+        console_handler.setFormatter(ConsoleLogFormatter())
+        handlers.append(console_handler)
+
+    file_error = None
+    try:
+        os.makedirs(log_dir, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, "flac_music.log"), maxBytes=LOG_FILE_MAX_BYTES,
+            backupCount=LOG_FILE_BACKUPS, encoding='utf-8', delay=True)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(JsonLogFormatter())
+        handlers.append(file_handler)
+    except OSError as e:
+        file_error = e
+
+    log_queue = queue.SimpleQueue()
+    listener = RedactingQueueListener(log_queue, *handlers)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    listener.start()
+    # 退出前写完队列中剩余的日志
+    atexit.register(listener.stop)
+
+    if file_error is not None:
+        logger.warning(f"日志文件不可用: {file_error}")
+
+
+class DownloadProgressTracker:
+    """跟踪单个下载任务的进度信息"""
+
+    def __init__(self, filename, total_size):
+        self.filename = filename
+        self.total_size = total_size
+        self.downloaded = 0
+        self.start_time = time.time()
+        self.last_update_time = time.time()
+        self.last_downloaded = 0
+        self.speed = 0
+        self.eta = "计算中..."
+        self.progress = 0
+
+    def update(self, chunk_size):
+        """更新下载进度"""
+        self.downloaded += chunk_size
+        current_time = time.time()
+        time_elapsed = current_time - self.last_update_time
+
+        # 计算下载速度（每2秒更新一次）
+        if time_elapsed >= 2.0:
+            downloaded_since_last = self.downloaded - self.last_downloaded
+            self.speed = downloaded_since_last / time_elapsed  # 字节/秒
+            self.last_downloaded = self.downloaded
+            self.last_update_time = current_time
+
+            # 计算剩余时间
+            if self.speed > 0 and self.total_size > 0:
+                remaining_bytes = self.total_size - self.downloaded
+                eta_seconds = remaining_bytes / self.speed
+                if eta_seconds > 3600:
+                    self.eta = f"{eta_seconds / 3600:.1f}小时"
+                elif eta_seconds > 60:
+                    self.eta = f"{eta_seconds / 60:.1f}分钟"
+                else:
+                    self.eta = f"{eta_seconds:.0f}秒"
+            else:
+                self.eta = "计算中..."
+
+        # 计算进度百分比
+        if self.total_size > 0:
+            self.progress = (self.downloaded / self.total_size) * 100
+        else:
+            self.progress = 0
+
+    def format_size(self, size_bytes):
+        """格式化文件大小"""
+        if size_bytes == 0:
+            return "0B"
+        size_names = ("B", "KB", "MB", "GB")
+        i = int(math.floor(math.log(size_bytes, 1024)))
+        p = math.pow(1024, i)
+        s = round(size_bytes / p, 2)
+        return f"{s} {size_names[i]}"
+
+    def format_speed(self):
+        """格式化下载速度"""
+        return f"{self.format_size(self.speed)}/s"
+
+    def get_progress_text(self):
+        """获取进度显示文本"""
+        if self.total_size > 0:
+            return f"{self.format_size(self.downloaded)} / {self.format_size(self.total_size)} ({self.progress:.1f}%)"
+        else:
+            return f"{self.format_size(self.downloaded)} (大小未知)"
+
+
+class ProgressBoard:
+    """下载进度共享表：下载线程只登记变化，界面定时器按固定帧率统一渲染"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = {}  # 任务键 -> (进度跟踪器, 首次未渲染的发布时间)
+
+        # 渲染统计，用于衡量事件队列压力和界面延迟
+        self.published = 0
+        self.coalesced = 0
+        self.frames = 0
+        self.rows_rendered = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def publish(self, key, tracker):
+        """登记任务进度已变化（下载线程调用，不触碰Tk）"""
+        with self.lock:
+            self.published += 1
+            if key in self.dirty:
+                self.coalesced += 1
+            else:
+                self.dirty[key] = (tracker, time.perf_counter())
+
+    def discard(self, key):
+        """移除任务的待渲染记录"""
+        with self.lock:
+            self.dirty.pop(key, None)
+
+    def take_dirty(self):
+        """取出自上一帧以来发生变化的任务（界面线程调用）"""
+        with self.lock:
+            if not self.dirty:
+                return []
+            dirty, self.dirty = self.dirty, {}
+
+        now = time.perf_counter()
+        self.frames += 1
+        self.rows_rendered += len(dirty)
+        for _, published_at in dirty.values():
+            latency = now - published_at
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        return [(key, tracker) for key, (tracker, _) in dirty.items()]
+
+    def stats_text(self):
+        """渲染统计摘要"""
+        average = self.total_latency / self.rows_rendered * 1000 if self.rows_rendered else 0
+        return (f"进度发布 {self.published} 次，合并 {self.coalesced} 次，渲染 {self.frames} 帧/"
+                f"{self.rows_rendered} 行，平均延迟 {average:.1f}ms，最大延迟 {self.max_latency * 1000:.1f}ms")
+
+    def reset_stats(self):
+        """清零渲染统计"""
+        self.published = self.coalesced = self.frames = self.rows_rendered = 0
+        self.total_latency = self.max_latency = 0.0
+
+
+def unused_path(save_dir, filename):
+    """保存路径，下载目录中已有同名文件时在文件名后加序号（_1、_2 ...）"""
+    filepath = os.path.join(save_dir, filename)
+    counter = 1
+    base_name, ext = os.path.splitext(filename)
+    while os.path.exists(filepath):
+        filepath = os.path.join(save_dir, f"{base_name}_{counter}{ext}")
+        counter += 1
+    return filepath
+
+
+class DownloadCancelled(Exception):
+    """下载任务已被取消"""
+
+
+class DownloadPaused(Exception):
+    """下载任务已暂停，resume_state 保存断点续传所需的信息（尚未开始传输时为 None）"""
+
+    def __init__(self, resume_state=None):
+        super().__init__("paused")
+        self.resume_state = resume_state
+
+
+class TaskControl:
+    """下载任务的协作式控制：暂停、继续、取消，可挂在批次控制之下"""
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.paused = False
+        self.cancelled = False
+
+    @property
+    def is_paused(self):
+        return self.paused or (self.parent is not None and self.parent.is_paused)
+
+    @property
+    def is_cancelled(self):
+        return self.cancelled or (self.parent is not None and self.parent.is_cancelled)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        """已取消时抛出 DownloadCancelled"""
+        if self.is_cancelled:
+            raise DownloadCancelled()
+
+
+class DownloadTaskRecord:
+    """下载任务的紧凑状态记录"""
+
+    __slots__ = ('key', 'index', 'filename', 'tracker', 'status', 'control', 'resume_state')
+
+    def __init__(self, key, index, control=None, filename=''):
+        self.key = key  # 任务键（任务序号，同名的不同歌曲各有自己的记录）
+        self.index = index  # 任务序号
+        self.filename = filename  # 显示的文件名
+        self.tracker = None  # 下载进度跟踪器，开始传输后才有
+        self.status = 'waiting'  # waiting / downloading / paused / done / failed
+        self.control = control  # 暂停/继续/取消控制
+        self.resume_state = None  # 暂停时保存的断点信息
+
+
+class DownloadTaskModel:
+    """下载任务列表的后备数据模型，界面只为可见的行创建控件"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.by_key = {}
+        self.version = 0  # 列表结构（增删）变化计数，界面据此决定是否重新绑定行
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, key, index, control=None, filename=''):
+        """添加任务，同一任务键已存在时复用"""
+        with self.lock:
+            record = self.by_key.get(key)
+            if record is None:
+                record = DownloadTaskRecord(key, index, control, filename)
+                self.records.append(record)
+                self.by_key[key] = record
+                self.version += 1
+            return record
+
+    def get(self, key):
+        """按任务键查找记录"""
+        return self.by_key.get(key)
+
+    def set_status(self, key, status):
+        """修改任务状态"""
+        record = self.by_key.get(key)
+        if record is not None:
+            record.status = status
+            with self.lock:
+                self.version += 1
+
+    def remove(self, key):
+        """移除任务"""
+        with self.lock:
+            record = self.by_key.pop(key, None)
+            if record is not None:
+                self.records.remove(record)
+                self.version += 1
+
+    def clear(self):
+        """清空所有任务"""
+        with self.lock:
+            self.records = []
+            self.by_key = {}
+            self.version += 1
+
+    def slice(self, start, count):
+        """读取从 start 开始的 count 条记录"""
+        with self.lock:
+            return self.records[start:start + count]
+
+
+class DownloadJob:
+    """下载服务中的一项任务"""
+
+    __slots__ = ('song', 'index', 'download_dir', 'remove_when_done', 'lane', 'enqueued_at',
+                 'record', 'control')
+
+    def __init__(self, song, index, download_dir, remove_when_done=False, lane=LANE_INTERACTIVE):
+        self.song = song
+        self.index = index  # 本轮下载中的序号
+        self.download_dir = download_dir
+        self.remove_when_done = remove_when_done  # 完成后是否从任务列表移除
+        self.lane = lane  # 优先级通道
+        self.enqueued_at = time.monotonic()  # 进入排队的时间，用于统计排队等待
+        self.record = None  # 任务列表中的记录，由 prepare_job 填写
+        self.control = TaskControl()  # 暂停/继续/取消控制，由 prepare_job 替换
+
+
+class LaneWaitStats:
+    """单个优先级通道的排队等待统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent = collections.deque(maxlen=1000)  # 最近的等待时间，用于估算 p95
+
+    def add(self, wait):
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent.append(wait)
+
+    def summary(self):
+        """统计摘要：数量、平均、p95、最大等待（秒）"""
+        if not self.count:
+            return {'count': 0, 'avg': 0.0, 'p95': 0.0, 'max': 0.0}
+        ordered = sorted(self.recent)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return {'count': self.count, 'avg': self.total_wait / self.count, 'p95': p95, 'max': self.max_wait}
+
+
+class DownloadService:
+    """常驻下载服务：任意时刻都可加入任务，按歌曲ID对排队、下载中和暂停中的任务去重；
+    交互通道优先调度，批量通道保底调度"""
+
+    def __init__(self, run_job, workers=DOWNLOAD_WORKERS, prepare_job=None, on_start=None, on_idle=None,
+                 bulk_rate_while_interactive=BULK_RATE_WHILE_INTERACTIVE):
+        self.run_job = run_job  # 执行任务：成功返回 True，失败/取消返回 False，暂停返回 None
+        self.workers = workers
+        self.prepare_job = prepare_job  # 任务入队前回调（登记任务列表）
+        self.on_start = on_start  # 空闲后第一次加入任务时回调
+        self.on_idle = on_idle  # 全部任务结束时回调，参数为本轮统计
+
+        self.cond = threading.Condition()
+        self.pending = {LANE_INTERACTIVE: collections.deque(), LANE_BULK: collections.deque()}  # 各通道排队中的任务
+        self.queued = {}  # 排队中的歌曲ID -> 任务
+        self.parked = []  # 已暂停的任务，不占用工作线程
+        self.active_ids = set()  # 排队、下载中和暂停中的歌曲ID
+        self.running = {LANE_INTERACTIVE: 0, LANE_BULK: 0}
+        self.interactive_streak = 0  # 批量任务排队时连续调度的交互任务数
+        # 同时下载的任务数上限和全部下载共享的带宽令牌桶，由下载时段调整（见 DownloadScheduler）
+        self.limit = workers
+        self.rate_limiter = None
+
+        # 有交互任务下载时，批量任务共享的带宽令牌桶
+        self.bulk_limiter = None
+        if bulk_rate_while_interactive > 0:
+            self.bulk_limiter = RateLimiter(bulk_rate_while_interactive, bulk_rate_while_interactive)
+        self.holds = 0  # 仍在产出任务的生产者数量，期间不视为空闲
+        self.threads = []
+        self.reset_totals()
+
+    def reset_totals(self):
+        """清零本轮统计"""
+        self.next_index = 0
+        self.total = 0
+        self.done = 0
+        self.succeeded = 0
+        self.lane_waits = {LANE_INTERACTIVE: LaneWaitStats(), LANE_BULK: LaneWaitStats()}
+
+    def totals(self):
+        """本轮统计快照"""
+        with self.cond:
+            return {'total': self.total, 'done': self.done, 'succeeded': self.succeeded,
+                    'running': sum(self.running.values()),
+                    'pending': {lane: len(jobs) for lane, jobs in self.pending.items()},
+                    'paused': len(self.parked)}
+
+    def wait_summary(self):
+        """各通道的排队等待统计"""
+        with self.cond:
+            return {lane: stats.summary() for lane, stats in self.lane_waits.items()}
+
+    def is_idle(self):
+        return not self.active_ids and not self.holds
+
+    def begin(self):
+        """从空闲进入新一轮下载（需持有锁）"""
+        if self.is_idle():
+            self.reset_totals()
+            if self.on_start:
+                self.on_start()
+
+    def hold(self):
+        """生产者开始产出任务，在 release 之前服务不会报告空闲"""
+        with self.cond:
+            self.begin()
+            self.holds += 1
+
+    def release(self):
+        """生产者结束产出任务"""
+        with self.cond:
+            self.holds -= 1
+        self.notify_if_idle()
+
+    def submit(self, songs, download_dir, remove_when_done=False, lane=LANE_INTERACTIVE):
+        """加入下载任务，已在排队/下载/暂停中的歌曲跳过（交互任务会把批量通道中排队的同一首歌提前）；
+        返回实际加入的任务"""
+        jobs = []
+        with self.cond:
+            self.begin()
+            for song in songs:
+                song_id = song.id
+                if not song_id:
+                    continue
+                if song_id in self.active_ids:
+                    self.promote(song_id, lane)
+                    continue
+                self.active_ids.add(song_id)
+                self.next_index += 1
+                job = DownloadJob(song, self.next_index, download_dir, remove_when_done, lane)
+                if self.prepare_job:
+                    self.prepare_job(job)
+                jobs.append(job)
+                self.queued[song_id] = job
+
+            self.total += len(jobs)
+            self.pending[lane].extend(jobs)
+            self.ensure_workers()
+            self.cond.notify_all()
+        return jobs
+
+    def promote(self, song_id, lane):
+        """将批量通道中排队的任务移到交互通道（需持有锁）"""
+        job = self.queued.get(song_id)
+        if job is None or lane != LANE_INTERACTIVE or job.lane != LANE_BULK:
+            return
+        self.pending[LANE_BULK].remove(job)
+        job.lane = LANE_INTERACTIVE
+        self.pending[LANE_INTERACTIVE].append(job)
+
+    def wait_for_room(self, limit, stop_event, lane=LANE_BULK):
+        """等待该通道排队任务少于 limit，stop_event 被设置时返回 False"""
+        with self.cond:
+            while len(self.pending[lane]) >= limit and not stop_event.is_set():
+                self.cond.wait(0.5)
+        return not stop_event.is_set()
+
+    def throttle(self, job, nbytes):
+        """任务传输数据前调用：按当前时段的带宽上限限速；有交互任务在下载时批量任务另按共享带宽上限限速"""
+        rate_limiter = self.rate_limiter
+        if rate_limiter is not None:
+            rate_limiter.acquire(nbytes)
+        if job.lane == LANE_BULK and self.bulk_limiter is not None and self.running[LANE_INTERACTIVE]:
+            self.bulk_limiter.acquire(nbytes)
+
+    def set_limits(self, workers, rate=0):
+        """调整同时下载的任务数（0 表示暂不开始新任务）和带宽上限（字节/秒，0 表示不限制）；
+        超出新上限的下载中任务继续下载完，之后不再补上"""
+        with self.cond:
+            self.limit = workers
+            self.rate_limiter = RateLimiter(rate, max(rate, 64 * 1024)) if rate > 0 else None
+            self.ensure_workers()
+            self.cond.notify_all()
+
+    def has_capacity(self):
+        """是否还能开始一项任务（需持有锁）"""
+        return sum(self.running.values()) < self.limit
+
+    def discard_cancelled(self):
+        """移除排队和暂停中已取消的任务，返回被移除的任务"""
+        with self.cond:
+            dropped = [job for job in self.parked if job.control.is_cancelled]
+            self.parked = [job for job in self.parked if not job.control.is_cancelled]
+            for lane, jobs in self.pending.items():
+                dropped += [job for job in jobs if job.control.is_cancelled]
+                self.pending[lane] = collections.deque(job for job in jobs if not job.control.is_cancelled)
+            for job in dropped:
+                self.active_ids.discard(job.song.id)
+                self.queued.pop(job.song.id, None)
+            self.done += len(dropped)
+        if dropped:
+            self.notify_if_idle()
+        return dropped
+
+    def ensure_workers(self):
+        """按需启动工作线程（需持有锁）"""
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        while len(self.threads) < max(self.workers, self.limit):
+            thread = threading.Thread(target=self.worker_loop, name=f"download-worker-{len(self.threads) + 1}",
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def next_job(self):
+        """取下一项任务（需持有锁）：已继续（或已取消）的暂停任务优先，其次交互通道，
+        批量任务排队时每 INTERACTIVE_BURST 个交互任务后让出一次"""
+        for job in self.parked:
+            if not job.control.is_paused or job.control.is_cancelled:
+                self.parked.remove(job)
+                return job
+
+        interactive, bulk = self.pending[LANE_INTERACTIVE], self.pending[LANE_BULK]
+        if interactive and not (bulk and self.interactive_streak >= INTERACTIVE_BURST):
+            job = interactive.popleft()
+            self.interactive_streak = self.interactive_streak + 1 if bulk else 0
+        elif bulk:
+            job = bulk.popleft()
+            self.interactive_streak = 0
+        else:
+            return None
+
+        del self.queued[job.song.id]
+        self.lane_waits[job.lane].add(time.monotonic() - job.enqueued_at)
+        return job
+
+    def worker_loop(self):
+        """工作线程：持续从队列取任务执行"""
+        while True:
+            with self.cond:
+                job = self.next_job() if self.has_capacity() else None
+                while job is None:
+                    # 有暂停任务时定期检查是否已继续
+                    self.cond.wait(0.2 if self.parked else None)
+                    job = self.next_job() if self.has_capacity() else None
+                self.running[job.lane] += 1
+                self.cond.notify_all()
+
+            try:
+                result = self.run_job(job)
+            except Exception:
+                result = False
+            self.finish(job, result)
+
+    def finish(self, job, result):
+        """记录任务结果，暂停的任务搁置到继续为止"""
+        with self.cond:
+            self.running[job.lane] -= 1
+            if result is None:
+                self.parked.append(job)
+                return
+            self.active_ids.discard(job.song.id)
+            self.done += 1
+            if result:
+                self.succeeded += 1
+        self.notify_if_idle()
+
+    def notify_if_idle(self):
+        """全部任务结束后回调 on_idle"""
+        with self.cond:
+            if not self.is_idle() or self.total == 0:
+                return
+            totals = {'total': self.total, 'done': self.done, 'succeeded': self.succeeded}
+            # 只报告一次，下一轮从 begin 重新计数
+            self.total = 0
+        if self.on_idle:
+            self.on_idle(totals)
+
+
+class ScheduleWindow:
+    """下载时段：星期、起止时间（可跨午夜）、并发下载数和带宽上限
+
+    规格写法 "[星期] HH:MM-HH:MM 并发数[@带宽]"，如 "mon-fri 09:00-18:00 1@2M"、"18:00-09:00 8"；
+    星期可写 mon-fri 或 sat,sun（跨午夜的时段按开始的那天算），带宽单位 K/M（字节/秒），不带单位时为 KB/s，
+    起止时间相同表示全天。
+    """
+
+    __slots__ = ('spec', 'days', 'start', 'end', 'workers', 'rate')
+
+    def __init__(self, start, end, workers, rate=0, days=None, spec=''):
+        self.spec = spec
+        self.days = days  # 星期几（0 为周一）的集合，None 表示每天
+        self.start = start  # 一天中的第几分钟
+        self.end = end
+        self.workers = workers
+        self.rate = rate  # 字节/秒，0 表示不限制
+
+    @staticmethod
+    def parse_days(text):
+        days = set()
+        for part in text.lower().split(','):
+            first, _, last = part.partition('-')
+            if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+                raise ValueError(f"无法解析星期 {part!r}，应为 {'/'.join(WEEKDAYS)}")
+            day, stop = WEEKDAYS.index(first), WEEKDAYS.index(last or first)
+            days.add(day)
+            while day != stop:
+                day = (day + 1) % 7
+                days.add(day)
+        return frozenset(days)
+
+    @staticmethod
+    def parse_rate(text):
+        match = re.fullmatch(r'(\d+(?:\.\d+)?)([kKmM]?)', text)
+        if not match:
+            raise ValueError(f"无法解析带宽 {text!r}，应为如 512K、2M")
+        return int(float(match.group(1)) * {'': 1024, 'k': 1024, 'm': 1024 * 1024}[match.group(2).lower()])
+
+    @classmethod
+    def parse(cls, spec):
+        """解析时段规格，格式不对时抛出 ValueError"""
+        parts = spec.split()
+        days = cls.parse_days(parts.pop(0)) if len(parts) == 3 else None
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})', parts[0]) if len(parts) == 2 else None
+        if not match:
+            raise ValueError(f"无法解析下载时段 {spec!r}，应为 \"[星期] HH:MM-HH:MM 并发数[@带宽]\"")
+        start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+        start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+        if start_minute > 59 or end_minute > 59 or start >= 24 * 60 or end > 24 * 60:
+            raise ValueError(f"下载时段 {spec!r} 的时间无效")
+        workers, at, rate = parts[1].partition('@')
+        if not workers.isdigit() or int(workers) == 0:
+            # 要暂停下载时不设置这个时段即可（不在任何时段内时不开始新任务）
+            raise ValueError(f"下载时段 {spec!r} 的并发数无效，应至少为 1")
+        return cls(start, end % (24 * 60), int(workers), cls.parse_rate(rate) if at else 0, days, spec)
+
+    def on_day(self, day):
+        return self.days is None or day in self.days
+
+    def contains(self, moment):
+        """moment（datetime）是否在时段内"""
+        minute, day = moment.hour * 60 + moment.minute, moment.weekday()
+        if self.start == self.end:
+            return self.on_day(day)
+        if self.start < self.end:
+            return self.on_day(day) and self.start <= minute < self.end
+        return (self.on_day(day) and minute >= self.start) or (self.on_day((day - 1) % 7) and minute < self.end)
+
+    def describe(self):
+        rate = f"{self.rate / 1024:.0f}KB/s" if self.rate else "不限"
+        return f"下载时段 {self.spec}: 并发 {self.workers}，带宽 {rate}"
+
+
+class DownloadScheduler:
+    """按时段调整下载服务的并发数和带宽上限：按顺序取第一个包含当前时间的时段；
+    不在任何时段内时不开始新任务，排队和没开始的任务留到下一个时段"""
+
+    def __init__(self, service, windows, on_change=None, interval=SCHEDULE_CHECK_INTERVAL, clock=datetime.now):
+        self.service = service
+        self.windows = list(windows)
+        self.on_change = on_change  # 时段变化时回调，参数为新的时段（不在任何时段内时为 None）
+        self.interval = interval
+        self.clock = clock
+        self.current = None  # 当前时段，不在任何时段内时为 None
+        self.applied = False  # 是否已应用过时段
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def active_window(self, moment=None):
+        moment = moment or self.clock()
+        return next((window for window in self.windows if window.contains(moment)), None)
+
+    def apply(self):
+        """按当前时间应用时段，时段变化时返回 True"""
+        window = self.active_window()
+        if self.applied and window is self.current:
+            return False
+        self.current = window
+        self.applied = True
+        workers, rate = (window.workers, window.rate) if window else (0, 0)
+        self.service.set_limits(workers, rate)
+        metrics.set('flac_schedule_workers', workers)
+        metrics.set('flac_schedule_rate_bytes', rate)
+        logger.info(self.describe(window), extra={'phase': 'schedule'})
+        if self.on_change:
+            self.on_change(window)
+        return True
+
+    @staticmethod
+    def describe(window):
+        return window.describe() if window else "不在任何下载时段内，暂不开始新的下载"
+
+    def status(self):
+        """当前时段的状态"""
+        window = self.current
+        return {'window': window.spec if window else None,
+                'workers': window.workers if window else 0, 'rate': window.rate if window else 0}
+
+    def start(self):
+        """立即应用当前时段，之后在后台定时检查"""
+        self.apply()
+        self.thread = threading.Thread(target=self.run, name="download-scheduler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.apply()
+            except Exception:
+                logger.exception("应用下载时段失败")
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def add_schedule_arguments(parser):
+    """下载前端共用的下载时段参数"""
+    parser.add_argument('--window', dest='windows', action='append', default=[], metavar='SPEC',
+                        help="下载时段（可重复，取第一个包含当前时间的）：\"[星期] HH:MM-HH:MM 并发数[@带宽]\"，"
+                             "如 \"mon-fri 09:00-18:00 1@2M\" \"18:00-09:00 8\"；设置后不在任何时段内时不开始新的下载")
+
+
+def schedule_windows_from_args(args):
+    """解析 --window 参数，返回时段列表；格式不对时抛出 ValueError"""
+    return [ScheduleWindow.parse(spec) for spec in args.windows]
+
+
+class SongRecord:
+    """歌曲记录：固定字段的紧凑表示（无实例字典），歌手、专辑、时长等重复率高的字符串驻留共享"""
+
+    __slots__ = ('id', 'name', 'artist', 'album_name', 'duration', 'format', 'sign', 'time')
+
+    def __init__(self, song_id, name='未知', artist='未知', album_name='未知', duration='',
+                 music_format='flac', sign='', time=''):
+        self.id = str(song_id)
+        self.name = name
+        self.artist = sys.intern(str(artist))
+        self.album_name = sys.intern(str(album_name))
+        self.duration = sys.intern(str(duration))
+        self.format = sys.intern(music_format)
+        self.sign = sign
+        self.time = time
+
+    def __repr__(self):
+        return f"SongRecord({self.id!r}, {self.name!r}, {self.artist!r})"
+
+    def display_name(self):
+        """文件名和日志中使用的 "歌名 - 歌手" """
+        return f"{self.name} - {self.artist}"
+
+    def as_dict(self):
+        """转换为字典（JSON 接口）"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        """由字典创建，缺少的字段使用默认值"""
+        return cls(data['id'], data.get('name') or '未知', data.get('artist') or '未知',
+                   data.get('album_name') or '未知', data.get('duration') or '', data.get('format') or 'flac',
+                   data.get('sign') or '', data.get('time') or '')
+
+
+def benchmark_song_memory(counts=(10000, 100000, 1000000)):
+    """比较歌曲字典与 SongRecord 的内存占用，返回 [(数量, 字典字节数, 记录字节数)]"""
+    import gc
+    import tracemalloc
+
+    def payload(count):
+        # 模拟解析后的接口数据：每首歌的字符串都是独立对象，歌手和专辑有大量重复
+        artists = max(1, count // 50)
+        return [{'id': str(100000000 + i), 'name': f"歌曲{i}", 'artist': f"歌手{i % artists}",
+                 'album_name': f"专辑{i % (artists * 3)}", 'duration': f"0{i % 6}:{i % 60:02d}",
+                 'sign': f"{i:032x}", 'time': str(1700000000 + i)} for i in range(count)]
+
+    def as_dict(song):
+        return {'id': song['id'], 'name': song['name'], 'artist': song['artist'],
+                'album_name': song['album_name'], 'duration': song['duration'],
+                'format': 'flac', 'sign': song['sign'], 'time': song['time']}
+
+    def as_record(song):
+        return SongRecord(song['id'], song['name'], song['artist'], song['album_name'],
+                          song['duration'], 'flac', song['sign'], song['time'])
+
+    def measure(count, build):
+        # 接口数据解析后即丢弃，只计入保留下来的列表、记录对象和字符串
+        gc.collect()
+        tracemalloc.start()
+        songs = payload(count)
+        records = [build(song) for song in songs]
+        del songs
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del records
+        return size
+
+    results = []
+    for count in counts:
+        results.append((count, measure(count, as_dict), measure(count, as_record)))
+    return results
+
+
+def print_song_memory_benchmark(counts=(10000, 100000, 1000000)):
+    """输出歌曲记录内存基准测试结果"""
+    print(f"{'数量':>10} {'字典(MB)':>10} {'记录(MB)':>10} {'字典/首':>8} {'记录/首':>8} {'节省':>6}")
+    for count, dict_bytes, record_bytes in benchmark_song_memory(counts):
+        print(f"{count:>10} {dict_bytes / 1048576:>10.1f} {record_bytes / 1048576:>10.1f} "
+              f"{dict_bytes // count:>8} {record_bytes // count:>8} {1 - record_bytes / dict_bytes:>6.0%}")
+
+
+class SongSelectionModel:
+    """按歌曲ID维护的选择状态，增量维护已选数量和每页的全选状态"""
+
+    def __init__(self):
+        self.selected = {}  # 歌曲ID -> 歌曲信息
+        self.song_pages = {}  # 歌曲ID -> 所在页码
+        self.page_counted = {}  # 页码 -> 计入全选判断的歌曲ID集合（不含非首选的重复版本）
+        self.page_selected = {}  # 页码 -> 计入全选判断且已选择的歌曲数量
+
+    def __len__(self):
+        return len(self.selected)
+
+    def __contains__(self, song_id):
+        return song_id in self.selected
+
+    def songs(self):
+        """所有已选择的歌曲"""
+        return list(self.selected.values())
+
+    def register_page(self, page, song_ids, counted_ids):
+        """登记某页显示的歌曲，counted_ids 为参与全选判断的歌曲"""
+        for song_id in song_ids:
+            self.song_pages[song_id] = page
+        counted = set(counted_ids)
+        self.page_counted[page] = counted
+        self.page_selected[page] = sum(1 for song_id in counted if song_id in self.selected)
+
+    def adjust_page_count(self, song_id, delta):
+        """歌曲选择状态变化时更新所在页的已选数量"""
+        page = self.song_pages.get(song_id)
+        if page is not None and song_id in self.page_counted.get(page, ()):
+            self.page_selected[page] += delta
+
+    def select(self, song):
+        """选择歌曲，状态有变化时返回 True"""
+        song_id = song.id
+        if not song_id or song_id in self.selected:
+            return False
+        self.selected[song_id] = song
+        self.adjust_page_count(song_id, 1)
+        return True
+
+    def deselect(self, song_id):
+        """取消选择歌曲，状态有变化时返回 True"""
+        if self.selected.pop(song_id, None) is None:
+            return False
+        self.adjust_page_count(song_id, -1)
+        return True
+
+    def set_many(self, songs, selected):
+        """批量设置选择状态，返回状态发生变化的歌曲ID列表"""
+        if selected:
+            return [song.id for song in songs if self.select(song)]
+        return [song.id for song in songs if self.deselect(song.id)]
+
+    def is_page_all_selected(self, page):
+        """某页参与全选判断的歌曲是否已全部选择"""
+        counted = self.page_counted.get(page)
+        return bool(counted) and self.page_selected.get(page, 0) == len(counted)
+
+    def clear(self):
+        """清空选择和分页登记"""
+        self.selected.clear()
+        self.song_pages.clear()
+        self.page_counted.clear()
+        self.page_selected.clear()
+
+
+class SearchCancelled(Exception):
+    """搜索请求已被更新的搜索取代"""
+
+
+class SearchCancelToken:
+    """搜索请求的取消令牌，被取代时中止仍在读取中的响应"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.cancelled = False
+        self.response = None
+        self._lock = threading.Lock()
+
+    def attach(self, response):
+        """登记当前请求的响应对象，已取消时立即关闭"""
+        with self._lock:
+            self.response = response
+            if self.cancelled:
+                response.close()
+
+    def cancel(self):
+        """取消请求并关闭连接"""
+        with self._lock:
+            self.cancelled = True
+            if self.response is not None:
+                try:
+                    self.response.close()
+                except Exception:
+                    pass
+
+    def check(self):
+        """已取消时抛出 SearchCancelled"""
+        if self.cancelled:
+            raise SearchCancelled()
+
+
+class Histogram:
+    """累积直方图：各桶上限的计数、总次数和总和（与 Prometheus 语义一致）"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """进程内指标：计数器、仪表和直方图，按 (名称, 标签) 区分，线程安全"""
+
+    HELP = {
+        'flac_info': "运行模式和版本",
+        'flac_requests_total': "各阶段的请求次数",
+        'flac_errors_total': "各阶段按异常类型统计的错误次数",
+        'flac_phase_seconds': "各阶段耗时",
+        'flac_download_bytes_total': "下载写入的字节数",
+        'flac_download_ttfb_seconds': "下载请求到收到响应头的时间",
+        'flac_download_transfer_seconds': "下载传输时间",
+        'flac_download_write_stall_seconds': "每次下载累计的磁盘写入耗时",
+        'flac_ui_lag_seconds': "界面事件循环延迟",
+        'flac_daemon_search_cache_total': "守护进程搜索缓存命中/未命中次数",
+        'flac_cluster_jobs_total': "多节点队列中本节点完成/失败/收回/丢失租约的任务数",
+        'flac_cache_lookups_total': "下载前查询曲目缓存的命中/未命中/损坏/出错次数",
+        'flac_cache_requests_total': "缓存服务收到的取文件请求（命中/未命中/损坏）",
+        'flac_cache_bytes_total': "曲目缓存取出/存入/对外提供的字节数",
+        'flac_cache_size_bytes': "曲目缓存占用的字节数",
+        'flac_cache_evictions_total': "曲目缓存按最近访问时间淘汰的条目数",
+        'flac_source_requests_total': "各来源的搜索/获取链接次数（成功/出错/超过截止时间）",
+        'flac_source_seconds': "各来源的搜索/获取链接耗时",
+        'flac_source_ready': "各来源的会话是否可用",
+        'flac_watch_requests_total': "同步关注的歌手发出的搜索请求数",
+        'flac_watch_new_songs_total': "同步关注的歌手找到的新歌数",
+        'flac_quality_selected_total': "按音质策略为歌曲选定的档位",
+        'flac_schedule_workers': "当前下载时段的并发下载数",
+        'flac_schedule_rate_bytes': "当前下载时段的带宽上限（字节/秒，0 表示不限制）",
+        'flac_link_throughput_bytes': "最近测得的链路吞吐量（字节/秒）",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (名称, 标签) -> 值
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def record_error(self, phase, error):
+        """按异常类型记录一次错误（包装过的异常按原始异常计）"""
+        error = error.__cause__ or error
+        self.inc('flac_errors_total', phase=phase, error=type(error).__name__)
+
+    def snapshot(self):
+        """JSON 快照"""
+        with self.lock:
+            return {
+                'timestamp': time.time(),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                                'buckets': {str(bound): count for bound, count in zip(h.buckets, h.counts)}}
+                               for (name, labels), h in sorted(self.histograms.items())],
+            }
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        """格式化标签，转义反斜杠、引号和换行"""
+        parts = []
+        for name, value in list(labels) + list(extra):
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{name}="{value}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def prometheus_text(self):
+        """Prometheus 文本格式"""
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                describe(name, "counter")
+                lines.append(f"{name}{self.format_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                describe(name, "gauge")
+                lines.append(f"{name}{self.format_labels(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                describe(name, "histogram")
+                for bound, count in zip(h.buckets, h.counts):
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {h.count}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """定期把指标写成 Prometheus 文本文件和 JSON 快照（先写临时文件再替换，采集方不会读到半个文件）"""
+
+    def __init__(self, registry, directory=METRICS_DIR, interval=METRICS_EXPORT_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="metrics-exporter", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.export()
+
+    def stop(self):
+        """停止定期导出，并导出最后一次"""
+        if not self.stop_event.is_set():
+            self.stop_event.set()
+            self.export()
+
+    def write_atomic(self, filename, text):
+        path = os.path.join(self.directory, filename)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    def export(self):
+        try:
+            self.write_atomic("flac_music.prom", self.registry.prometheus_text())
+            self.write_atomic("flac_music_metrics.json",
+                              json.dumps(self.registry.snapshot(), ensure_ascii=False, indent=1))
+        except OSError as e:
+            logger.warning(f"导出指标失败: {e}")
+
+
+metrics = MetricsRegistry()
+
+# 暂停、取消等流程控制异常不计为错误
+METRICS_IGNORED_ERRORS = (SearchCancelled, DownloadPaused, DownloadCancelled)
+
+
+def timed_phase(phase):
+    """装饰器：记录阶段的请求次数和耗时，向外抛出的异常按类型计为错误"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics.inc('flac_requests_total', phase=phase)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except METRICS_IGNORED_ERRORS:
+                raise
+            except Exception as e:
+                metrics.record_error(phase, e)
+                raise
+            finally:
+                metrics.observe('flac_phase_seconds', time.perf_counter() - started, phase=phase)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """采样分析器：后台线程定时采样所有线程的调用栈，汇总为折叠栈（可直接生成火焰图）"""
+
+    def __init__(self, interval=DIAGNOSTICS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()  # (线程名, 代码对象...) -> 次数
+        self.sample_count = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[tuple(reversed(stack))] += 1
+            self.sample_count += 1
+
+    @staticmethod
+    def frame_label(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def write_collapsed(self, path):
+        """写出折叠栈：每行为 "线程;外层函数;...;内层函数 次数"，可交给 flamegraph.pl 或 speedscope"""
+        labels = {}
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                thread_name, codes = stack[0], stack[1:]
+                parts = [thread_name.replace(';', '_')]
+                for code in codes:
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = self.frame_label(code).replace(';', '_')
+                    parts.append(label)
+                f.write(f"{';'.join(parts)} {count}\n")
+
+
+class Diagnostics:
+    """诊断模式：运行时开启/关闭，输出采样分析折叠栈、tracemalloc 内存快照和线程堆栈，
+    每次开启对应一个带时间戳的诊断目录"""
+
+    def __init__(self, base_dir=DIAGNOSTICS_DIR):
+        self.base_dir = base_dir
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.session_dir = None
+        self.started_tracemalloc = False
+
+    @property
+    def active(self):
+        return self.profiler is not None
+
+    @staticmethod
+    def timestamp():
+        return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    def output_dir(self):
+        """当前诊断会话的目录；未开启诊断时为按时间戳新建的目录"""
+        directory = self.session_dir or os.path.join(self.base_dir, self.timestamp())
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def start(self):
+        """开启诊断：开始采样分析和内存分配跟踪"""
+        import tracemalloc
+
+        with self.lock:
+            if self.active:
+                return self.session_dir
+            self.session_dir = self.output_dir()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.started_tracemalloc = True
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+            return self.session_dir
+
+    def stop(self):
+        """关闭诊断：写出折叠栈和最后一次内存快照，返回诊断目录"""
+        import tracemalloc
+
+        with self.lock:
+            if not self.active:
+                return None
+            profiler, self.profiler = self.profiler, None
+            profiler.stop()
+            directory = self.session_dir
+            profiler.write_collapsed(os.path.join(directory, f"profile_{self.timestamp()}.collapsed"))
+            self.write_memory_snapshot(directory)
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+            self.session_dir = None
+            logger.info(f"诊断已保存: {directory}（采样 {profiler.sample_count} 次）")
+            return directory
+
+    def snapshot_memory(self):
+        """写出当前的内存分配排行，未开启诊断时返回 None"""
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            return None
+        return self.write_memory_snapshot(self.output_dir())
+
+    def write_memory_snapshot(self, directory):
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        path = os.path.join(directory, f"tracemalloc_{self.timestamp()}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"当前 {current / 1024 / 1024:.1f} MB，峰值 {peak / 1024 / 1024:.1f} MB\n\n")
+            f.write(f"按代码行统计的前 {TRACEMALLOC_TOP} 个分配位置:\n")
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                f.write(f"{stat}\n")
+            f.write("\n按调用栈统计的前 10 个分配位置:\n")
+            for stat in snapshot.statistics('traceback')[:10]:
+                f.write(f"\n{stat}\n")
+                f.write("\n".join(stat.traceback.format()) + "\n")
+        return path
+
+    def dump_threads(self):
+        """写出所有线程当前的调用栈"""
+        names = {thread.ident: thread for thread in threading.enumerate()}
+        path = os.path.join(self.output_dir(), f"threads_{self.timestamp()}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            for thread_id, frame in sys._current_frames().items():
+                thread = names.get(thread_id)
+                name = thread.name if thread else "未知线程"
+                daemon = "，守护线程" if thread is not None and thread.daemon else ""
+                f.write(f"线程 {name} (id {thread_id}{daemon}):\n")
+                f.write("".join(traceback.format_stack(frame)))
+                f.write("\n")
+        return path
+
+
+class SongIndex:
+    """本地歌曲索引：保存所有出现过的搜索结果，支持离线全文检索"""
+
+    # 每批最多合并写入的歌曲数
+    BATCH_SIZE = 500
+    # 累计写入多少行后整理一次索引并回收空闲页
+    MAINTENANCE_INTERVAL = 50000
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = self.connect()
+        self.has_fts = self.create_schema(self.conn)
+
+        # 写入在后台线程中批量执行，搜索线程不会被磁盘写入阻塞
+        self.write_queue = queue.Queue()
+        self.rows_since_maintenance = 0
+        self.writer = threading.Thread(target=self.run_writer, name="song-index-writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def connect(self):
+        """创建数据库连接"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        # 新建数据库时启用增量回收，便于定期释放空闲页（须在建表和切换WAL之前设置）
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def create_schema(self, conn):
+        """创建数据表，返回是否支持FTS5全文索引"""
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS songs (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT UNIQUE NOT NULL,
+                name TEXT,
+                artist TEXT,
+                album_name TEXT,
+                duration TEXT,
+                sign TEXT,
+                time TEXT,
+                last_seen REAL
+            )
+        """)
+        # 已下载的歌曲：来源、音质档位和文件大小
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                song_id TEXT PRIMARY KEY,
+                source TEXT,
+                quality TEXT,
+                bytes INTEGER,
+                path TEXT,
+                downloaded_at REAL
+            )
+        """)
+        # 歌单导入的解析结果缓存
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS import_cache (
+                query_key TEXT PRIMARY KEY,
+                status TEXT,
+                song_id TEXT,
+                score REAL,
+                resolved_at REAL
+            )
+        """)
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(terms, prefix='2 3 4', columnsize=0)")
+            has_fts = True
+        except sqlite3.OperationalError:
+            has_fts = False
+        conn.commit()
+        return has_fts
+
+    @staticmethod
+    def segment_terms(text):
+        """分词：中日韩文字按单字切分，其余按单词切分"""
+        return re.sub(r'([\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uac00-\ud7af])', r' \1 ',
+                      str(text).lower())
+
+    def build_match_query(self, keywords):
+        """将关键词转换为FTS5查询：连续的中文按短语匹配，最后一个词按前缀匹配"""
+        words = keywords.split()
+        parts = []
+        for i, word in enumerate(words):
+            tokens = re.findall(r'\w+', self.segment_terms(word))
+            if not tokens:
+                continue
+            phrase = '"' + ' '.join(tokens) + '"'
+            if i == len(words) - 1 and tokens[-1].isascii():
+                phrase += '*'
+            parts.append(phrase)
+        return ' '.join(parts)
+
+    def add_songs(self, songs):
+        """登记一批搜索结果（异步写入）"""
+        if songs:
+            self.write_queue.put((time.time(), list(songs)))
+
+    def run_writer(self):
+        """后台写入线程：合并多批结果后在一个事务中写入"""
+        conn = self.connect()
+        while True:
+            batch = [self.write_queue.get()]
+            rows = len(batch[0][1])
+            while rows < self.BATCH_SIZE:
+                try:
+                    item = self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[1])
+
+            try:
+                self.write_batch(conn, batch)
+                self.rows_since_maintenance += rows
+                if self.rows_since_maintenance >= self.MAINTENANCE_INTERVAL:
+                    self.rows_since_maintenance = 0
+                    self.maintain(conn)
+            except Exception:
+                logger.exception("歌曲索引写入失败")
+
+    def write_batch(self, conn, batch):
+        """在一个事务中写入一批歌曲"""
+        with conn:
+            for seen_at, songs in batch:
+                for song in songs:
+                    song_id = song.id
+                    if not song_id:
+                        continue
+                    values = (song.name, song.artist, song.album_name, song.duration, song.sign, song.time)
+                    row = conn.execute("SELECT rowid, name, artist, album_name FROM songs WHERE id = ?",
+                                       (song_id,)).fetchone()
+                    if row is None:
+                        cursor = conn.execute(
+                            "INSERT INTO songs (id, name, artist, album_name, duration, sign, time, last_seen) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (song_id,) + values + (seen_at,))
+                        rowid = cursor.lastrowid
+                    else:
+                        rowid = row[0]
+                        conn.execute(
+                            "UPDATE songs SET name = ?, artist = ?, album_name = ?, duration = ?, "
+                            "sign = ?, time = ?, last_seen = ? WHERE rowid = ?", values + (seen_at, rowid))
+                        # 文本未变化时不重建全文索引
+                        if tuple(row[1:]) == values[:3]:
+                            continue
+                        if self.has_fts:
+                            conn.execute("DELETE FROM songs_fts WHERE rowid = ?", (rowid,))
+
+                    if self.has_fts:
+                        terms = self.segment_terms(' '.join(values[:3]))
+                        conn.execute("INSERT INTO songs_fts (rowid, terms) VALUES (?, ?)", (rowid, terms))
+
+    def maintain(self, conn):
+        """合并全文索引段并回收空闲页，保持数据库紧凑"""
+        if self.has_fts:
+            with conn:
+                conn.execute("INSERT INTO songs_fts (songs_fts) VALUES ('optimize')")
+        conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    @staticmethod
+    def row_to_song(row):
+        """数据库行转换为歌曲记录"""
+        song_id, name, artist, album_name, duration, sign, song_time = row
+        return SongRecord(song_id, name, artist, album_name, duration, sign=sign, time=song_time)
+
+    def get_song(self, song_id):
+        """按歌曲ID读取最近一次见到的歌曲信息"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, name, artist, album_name, duration, sign, time FROM songs WHERE id = ?",
+                (str(song_id),)).fetchone()
+        return self.row_to_song(row) if row else None
+
+    def get_import_resolution(self, query_key):
+        """读取歌单条目的缓存解析结果 (状态, 歌曲ID, 得分, 解析时间)"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT status, song_id, score, resolved_at FROM import_cache WHERE query_key = ?",
+                (query_key,)).fetchone()
+
+    def save_import_resolution(self, query_key, status, song_id, score):
+        """保存歌单条目的解析结果"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO import_cache (query_key, status, song_id, score, resolved_at) "
+                "VALUES (?, ?, ?, ?, ?)", (query_key, status, song_id, score, time.time()))
+
+    def record_download(self, song_id, source, quality, nbytes, path):
+        """记录下载完成的歌曲及所选的音质档位"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO downloads (song_id, source, quality, bytes, path, downloaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (str(song_id), source, quality, nbytes, path, time.time()))
+
+    def get_download(self, song_id):
+        """读取歌曲的下载记录 (来源, 音质档位, 字节数, 路径, 下载时间)"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT source, quality, bytes, path, downloaded_at FROM downloads WHERE song_id = ?",
+                (str(song_id),)).fetchone()
+
+    def search(self, keywords, limit=20):
+        """在本地索引中检索歌曲，返回与 search_music_with_session 相同格式的列表"""
+        keywords = keywords.strip()
+        if not keywords:
+            return []
+
+        columns = "s.id, s.name, s.artist, s.album_name, s.duration, s.sign, s.time"
+        with self.lock:
+            if self.has_fts:
+                match_query = self.build_match_query(keywords)
+                if not match_query:
+                    return []
+                rows = self.conn.execute(
+                    f"SELECT {columns} FROM songs_fts f JOIN songs s ON s.rowid = f.rowid "
+                    f"WHERE songs_fts MATCH ? LIMIT ?", (match_query, limit)).fetchall()
+            else:
+                pattern = f"%{keywords}%"
+                rows = self.conn.execute(
+                    f"SELECT {columns} FROM songs s WHERE s.name LIKE ? OR s.artist LIKE ? "
+                    f"OR s.album_name LIKE ? LIMIT ?", (pattern, pattern, pattern, limit)).fetchall()
+
+        return [self.row_to_song(row) for row in rows]
+
+
+class DuplicateClusterer:
+    """跨页重复歌曲检测：按规范化的歌名、歌手和时长将疑似重复的歌曲归为一组"""
+
+    # 时长分桶宽度（秒），相邻分桶视为同一时长
+    DURATION_BUCKET = 3
+
+    def __init__(self):
+        self.song_keys = {}  # 歌曲ID -> 预先计算的 (歌名, 歌手, 时长分桶)
+        self.song_clusters = {}  # 歌曲ID -> 分组ID
+        self.key_clusters = {}  # (歌名, 歌手, 时长分桶) -> 分组ID
+        self.clusters = {}  # 分组ID -> {'preferred': 首选歌曲ID, 'score': 首选歌曲评分, 'size': 数量}
+        self.seen_count = 0
+
+    @staticmethod
+    def normalize_text(text):
+        """规范化文本：全角转半角、忽略大小写、去除空白和标点"""
+        text = unicodedata.normalize('NFKC', str(text)).casefold()
+        return re.sub(r'[\W_]+', '', text)
+
+    def normalize_artist(self, artist):
+        """规范化歌手：拆分合唱歌手并排序，忽略顺序差异"""
+        names = re.split(r'\s*(?:[/、,，&;；]|\bfeat\.?|\bft\.?)\s*', str(artist), flags=re.IGNORECASE)
+        return '|'.join(sorted(filter(None, (self.normalize_text(name) for name in names))))
+
+    @staticmethod
+    def duration_seconds(duration):
+        """将 MM:SS 格式的时长转换为秒"""
+        try:
+            minutes, seconds = str(duration).split(':')
+            return int(minutes) * 60 + int(seconds)
+        except (ValueError, TypeError):
+            return 0
+
+    def compute_key(self, song):
+        """计算歌曲的去重键 (歌名, 歌手, 时长分桶)"""
+        seconds = self.duration_seconds(song.duration)
+        return (self.normalize_text(song.name),
+                self.normalize_artist(song.artist),
+                seconds // self.DURATION_BUCKET if seconds else None)
+
+    def song_key(self, song):
+        """获取歌曲的去重键，每首歌只计算一次"""
+        song_id = song.id
+        key = self.song_keys.get(song_id)
+        if key is None:
+            key = self.compute_key(song)
+            self.song_keys[song_id] = key
+        return key
+
+    def candidate_keys(self, key):
+        """与给定键视为重复的所有键（相邻时长分桶）"""
+        title, artist, bucket = key
+        if bucket is None:
+            return [key]
+        return [key, (title, artist, bucket - 1), (title, artist, bucket + 1)]
+
+    @staticmethod
+    def variant_score(song, rank):
+        """版本评分：有签名、专辑信息完整、时长已知、排名靠前的版本优先"""
+        return (bool(song.sign),
+                song.album_name not in ('', '未知'),
+                song.duration not in ('', '00:00'),
+                -rank)
+
+    def add_songs(self, songs):
+        """将一批歌曲归入重复分组，并更新每组的首选版本"""
+        for song in songs:
+            song_id = song.id
+            if not song_id or song_id in self.song_clusters:
+                continue
+
+            key = self.song_key(song)
+            cluster_id = None
+            for candidate in self.candidate_keys(key):
+                cluster_id = self.key_clusters.get(candidate)
+                if cluster_id is not None:
+                    break
+
+            score = self.variant_score(song, self.seen_count)
+            self.seen_count += 1
+
+            if cluster_id is None:
+                cluster_id = len(self.clusters)
+                self.clusters[cluster_id] = {'preferred': song_id, 'score': score, 'size': 1}
+            else:
+                cluster = self.clusters[cluster_id]
+                cluster['size'] += 1
+                if score > cluster['score']:
+                    cluster['preferred'] = song_id
+                    cluster['score'] = score
+
+            self.key_clusters.setdefault(key, cluster_id)
+            self.song_clusters[song_id] = cluster_id
+
+    def is_duplicate(self, song_id):
+        """歌曲是否属于包含多个版本的分组"""
+        cluster_id = self.song_clusters.get(song_id)
+        return cluster_id is not None and self.clusters[cluster_id]['size'] > 1
+
+    def is_preferred(self, song_id):
+        """歌曲是否为所在分组的首选版本（未分组的歌曲视为首选）"""
+        cluster_id = self.song_clusters.get(song_id)
+        return cluster_id is None or self.clusters[cluster_id]['preferred'] == song_id
+
+    def pick_for_selection(self, songs, selected_ids):
+        """从一批歌曲中挑出需要自动选择的歌曲：每组只选一首，已有选中版本的分组跳过"""
+        selected_clusters = {self.song_clusters.get(song_id) for song_id in selected_ids}
+        selected_clusters.discard(None)
+
+        picked = {}
+        for song in songs:
+            song_id = song.id
+            cluster_id = self.song_clusters.get(song_id)
+            if cluster_id is None:
+                picked[('id', song_id)] = song
+                continue
+            if cluster_id in selected_clusters:
+                continue
+            current = picked.get(cluster_id)
+            if current is None or self.is_preferred(song_id):
+                picked[cluster_id] = song
+        return list(picked.values())
+
+    def duplicate_count(self):
+        """被识别为重复（非首选）的歌曲数量"""
+        return len(self.song_clusters) - len(self.clusters)
+
+
+class RateLimiter:
+    """令牌桶限速器：限制每秒的请求次数（rate<=0 表示不限速）"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """获取令牌，令牌不足时阻塞等待"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class LinkThroughputMeter:
+    """链路吞吐量：最近一段时间内全部下载合计的字节/秒，按秒分桶，只计有数据的秒（批次之间的空闲不拉低结果）"""
+
+    def __init__(self, window=LINK_THROUGHPUT_WINDOW):
+        self.window = window
+        self.buckets = collections.deque()  # [秒, 字节数]
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        second = int(time.monotonic())
+        with self.lock:
+            if self.buckets and self.buckets[-1][0] == second:
+                self.buckets[-1][1] += nbytes
+            else:
+                self.buckets.append([second, nbytes])
+                while self.buckets and self.buckets[0][0] <= second - self.window:
+                    self.buckets.popleft()
+
+    def rate(self):
+        """字节/秒，数据不足时返回 None"""
+        second = int(time.monotonic())
+        with self.lock:
+            buckets = [bucket for bucket in self.buckets if bucket[0] > second - self.window]
+        # 当前这一秒还没结束，不计入
+        complete = [nbytes for start, nbytes in buckets if start < second]
+        if len(complete) < LINK_THROUGHPUT_MIN_SECONDS:
+            return None
+        return sum(complete) / len(complete)
+
+
+link_throughput = LinkThroughputMeter()
+
+
+class QualityPolicy:
+    """一个下载批次的音质策略：按测得的链路吞吐量和预检的文件大小为每首歌挑选音质档位
+
+    highest 总是最高档；budget 在截止时间内尽量高：剩余时间可下载的字节数扣除下载中歌曲的预计字节后，
+    平均分给尚未开始的歌曲；cap 每首不超过 max_tier 档和 max_track_bytes 字节。
+    remaining() 返回尚未开始下载的歌曲数（不含当前这首）。
+    """
+
+    def __init__(self, mode=QUALITY_HIGHEST, deadline=None, max_tier=None, max_track_bytes=None, remaining=None,
+                 meter=None, default_throughput=LINK_THROUGHPUT_DEFAULT):
+        if mode not in QUALITY_MODES:
+            raise ValueError(f"未知的音质策略 {mode}")
+        if mode == QUALITY_BUDGET and not deadline:
+            raise ValueError("budget 策略需要截止时间")
+        self.mode = mode
+        self.deadline = deadline  # 秒，从批次开始计
+        self.max_tier = max_tier
+        self.max_track_bytes = max_track_bytes
+        self.remaining = remaining or (lambda: 0)
+        self.meter = meter or link_throughput
+        self.default_throughput = default_throughput
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.in_flight = {}  # 歌曲ID -> 预计字节数
+        self.chosen = collections.Counter()
+
+    def begin(self):
+        """新批次开始：重新计时"""
+        with self.lock:
+            self.started = time.monotonic()
+            self.in_flight.clear()
+            self.chosen.clear()
+
+    def candidates(self, tiers):
+        names = [tier.name for tier in tiers]
+        if self.mode != QUALITY_HIGHEST and self.max_tier in names:
+            return tiers[names.index(self.max_tier):]
+        return tiers
+
+    @staticmethod
+    def estimate(song, tier):
+        seconds = DuplicateClusterer.duration_seconds(song.duration) or DEFAULT_TRACK_SECONDS
+        return int(seconds * tier.kbps * 1000 / 8)
+
+    def allowance(self):
+        """当前这首歌可用的字节数（不限时返回 None）"""
+        limit = self.max_track_bytes
+        if self.mode == QUALITY_BUDGET:
+            throughput = self.meter.rate() or self.default_throughput
+            metrics.set('flac_link_throughput_bytes', round(throughput))
+            with self.lock:
+                time_left = max(0.0, self.deadline - (time.monotonic() - self.started))
+                outstanding = sum(self.in_flight.values())
+            budget = (throughput * time_left - outstanding) / (self.remaining() + 1)
+            limit = budget if limit is None else min(limit, budget)
+        return limit
+
+    def select(self, song, tiers, probe):
+        """挑选档位，probe(档位) 返回 (链接, 文件名, 预检大小或 None)；返回 (档位, 链接, 文件名)
+
+        先预检最高的候选档位，放不下时按它的实际大小估算较低档位，取估算能放下的最高档再预检确认。
+        """
+        candidates = self.candidates(tiers)
+        allowance = None if self.mode == QUALITY_HIGHEST else self.allowance()
+        reference = None
+        for i, tier in enumerate(candidates):
+            last = i == len(candidates) - 1
+            if reference is not None and not last:
+                ref_tier, ref_size = reference
+                if ref_size * tier.kbps / ref_tier.kbps > allowance:
+                    continue
+            url, filename, size = probe(tier)
+            size = size or self.estimate(song, tier)
+            if allowance is None or size <= allowance or last:
+                with self.lock:
+                    self.in_flight[song.id] = size
+                    self.chosen[tier.name] += 1
+                if allowance is not None and tier is not candidates[0]:
+                    logger.info(f"音质降为 {tier.label}: {song.display_name()}（{size / 1048576:.1f}MB，"
+                                f"可用 {max(0, allowance) / 1048576:.1f}MB）", extra={'phase': 'resolve'})
+                metrics.inc('flac_quality_selected_total', tier=tier.name, mode=self.mode)
+                return tier, url, filename
+            reference = (tier, size)
+
+    def cache_tiers(self, song, tiers):
+        """曲目缓存命中时可以直接使用的档位（从高到低）：本策略会选的最高候选档，
+        以及按估算大小放不下更高档位时的较低档位"""
+        allowance = None if self.mode == QUALITY_HIGHEST else self.allowance()
+        accepted = []
+        for tier in self.candidates(tiers):
+            accepted.append(tier)
+            if allowance is None or self.estimate(song, tier) <= allowance:
+                break
+        return accepted
+
+    def record_cached(self, tier):
+        """缓存命中：计入所选档位（不经过站点，不占用预算）"""
+        if tier is None:
+            return
+        with self.lock:
+            self.chosen[tier.name] += 1
+        metrics.inc('flac_quality_selected_total', tier=tier.name, mode=self.mode)
+
+    def finish(self, song_id):
+        """歌曲下载结束（成功或失败），不再占用预算"""
+        with self.lock:
+            self.in_flight.pop(song_id, None)
+
+
+def add_quality_arguments(parser):
+    """下载前端共用的音质策略参数"""
+    parser.add_argument('--quality', choices=QUALITY_MODES, default=QUALITY_HIGHEST,
+                        help="音质策略：highest 总是最高，budget 在 --deadline 内尽量高，cap 每首封顶（默认 %(default)s）")
+    parser.add_argument('--deadline', type=float, metavar='MINUTES', help="budget 策略下一批下载的完成时限（分钟）")
+    parser.add_argument('--max-quality', choices=[tier.name for tier in QUALITY_TIERS],
+                        help="budget/cap 策略下的最高档位")
+    parser.add_argument('--max-track-mb', type=float, metavar='MB', help="budget/cap 策略下每首的大小上限（MB）")
+
+
+def quality_policy_from_args(args, remaining=None):
+    """按参数创建音质策略，总是最高档时返回 None（不预检）；参数不合理时抛出 ValueError"""
+    if args.quality == QUALITY_HIGHEST:
+        return None
+    if args.quality == QUALITY_BUDGET and not args.deadline:
+        raise ValueError("--quality budget 需要同时指定 --deadline")
+    if args.quality == QUALITY_CAP and not (args.max_quality or args.max_track_mb):
+        raise ValueError("--quality cap 需要指定 --max-quality 或 --max-track-mb")
+    if (args.deadline is not None and args.deadline <= 0) or (args.max_track_mb is not None and args.max_track_mb <= 0):
+        raise ValueError("--deadline 和 --max-track-mb 必须为正数")
+    return QualityPolicy(args.quality, args.deadline * 60 if args.deadline else None, args.max_quality,
+                         int(args.max_track_mb * 1024 * 1024) if args.max_track_mb else None, remaining)
+
+
+def bounded_map(func, items, max_workers, stop_event=None):
+    """并发执行 func(item)，同时最多 max_workers 个任务在途，按完成顺序产出 (item, future)"""
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for item in items:
+            pending[executor.submit(func, item)] = item
+            if len(pending) >= max_workers:
+                break
+
+        while pending and not (stop_event and stop_event.is_set()):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future
+                next_item = next(items, None)
+                if next_item is not None and not (stop_event and stop_event.is_set()):
+                    pending[executor.submit(func, next_item)] = next_item
+
+        for future in pending:
+            future.cancel()
+
+
+class PlaylistImporter:
+    """歌单批量导入：解析文本/CSV/M3U歌单，并发搜索并为每一行挑选最佳匹配"""
+
+    # 低于该得分视为未匹配
+    MATCH_THRESHOLD = 0.75
+    # 第二名与第一名得分差距小于该值（且不是同一录音）视为有歧义
+    AMBIGUOUS_MARGIN = 0.05
+    # 未匹配的结果缓存多久后重新搜索（秒）
+    UNMATCHED_CACHE_TTL = 24 * 3600
+
+    def __init__(self, search_func, song_index=None, concurrency=4, rate_limit=5, log=None):
+        self.search_func = search_func  # search_func(关键词, 每页数量) -> 歌曲列表
+        self.song_index = song_index
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.log = log or log_message  # 日志函数须接受 level 等结构化字段
+        self.normalizer = DuplicateClusterer()
+
+    @staticmethod
+    def read_lines(path):
+        """读取歌单文件，兼容UTF-8和GBK编码"""
+        for encoding in ('utf-8-sig', 'gbk'):
+            try:
+                with open(path, 'r', encoding=encoding) as f:
+                    return f.read().splitlines()
+            except UnicodeDecodeError:
+                continue
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.read().splitlines()
+
+    @staticmethod
+    def parse_duration(text):
+        """解析时长（MM:SS 或秒数），无法解析时返回 None"""
+        text = str(text).strip()
+        try:
+            if ':' in text:
+                minutes, seconds = text.split(':')[-2:]
+                return int(minutes) * 60 + int(float(seconds))
+            seconds = int(float(text))
+            return seconds if seconds > 0 else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def split_artist_title(text):
+        """拆分 "歌手 - 歌名" 格式的文本"""
+        parts = re.split(r'\s+[-–—]\s+', text.strip(), maxsplit=1)
+        if len(parts) == 2:
+            return parts[0].strip(), parts[1].strip()
+        return '', text.strip()
+
+    def parse_file(self, path):
+        """解析歌单文件，返回条目列表"""
+        import csv
+
+        lines = self.read_lines(path)
+        ext = os.path.splitext(path)[1].lower()
+        entries = []
+
+        def add(line_no, raw, artist, title, duration=None):
+            if title:
+                entries.append({'line': line_no, 'raw': raw, 'artist': artist,
+                                'title': title, 'duration': duration})
+
+        if ext in ('.m3u', '.m3u8'):
+            extinf = None
+            for line_no, line in enumerate(lines, 1):
+                line = line.strip()
+                match = re.match(r'#EXTINF:\s*(-?\d+)[^,]*,(.*)', line)
+                if match:
+                    extinf = (line_no, line, int(match.group(1)), match.group(2))
+                elif line and not line.startswith('#'):
+                    if extinf:
+                        info_line, raw, duration, text = extinf
+                        add(info_line, raw, *self.split_artist_title(text),
+                            duration if duration > 0 else None)
+                    else:
+                        name = os.path.splitext(os.path.basename(line.replace('\\', '/')))[0]
+                        add(line_no, line, *self.split_artist_title(name))
+                    extinf = None
+        elif ext == '.csv':
+            rows = list(csv.reader(lines))
+            columns = {'artist': None, 'title': None, 'duration': None}
+            if rows:
+                aliases = {'artist': ('artist', 'singer', '歌手', '艺术家'),
+                           'title': ('title', 'name', 'song', '歌名', '歌曲', '歌曲名称'),
+                           'duration': ('duration', 'length', '时长')}
+                header = [cell.strip().lower() for cell in rows[0]]
+                for field, names in aliases.items():
+                    for i, cell in enumerate(header):
+                        if cell in names:
+                            columns[field] = i
+                            break
+            if columns['title'] is not None:
+                start = 1
+            else:
+                # 无表头：单列按 "歌手 - 歌名" 解析，多列按 歌手, 歌名[, 时长] 解析
+                start = 0
+                columns = {'artist': 0, 'title': 1, 'duration': 2}
+
+            for line_no, row in enumerate(rows[start:], start + 1):
+                cells = [cell.strip() for cell in row]
+                if not any(cells):
+                    continue
+                if len(cells) == 1:
+                    add(line_no, cells[0], *self.split_artist_title(cells[0]))
+                    continue
+
+                def cell(field):
+                    index = columns[field]
+                    return cells[index] if index is not None and index < len(cells) else ''
+
+                duration = self.parse_duration(cell('duration')) if cell('duration') else None
+                add(line_no, ','.join(cells), cell('artist'), cell('title'), duration)
+        else:
+            for line_no, line in enumerate(lines, 1):
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    add(line_no, line, *self.split_artist_title(line))
+
+        return entries
+
+    def entry_key(self, entry):
+        """条目的缓存键"""
+        return '|'.join((self.normalizer.normalize_artist(entry['artist']),
+                         self.normalizer.normalize_text(entry['title']),
+                         str(entry['duration'] or '')))
+
+    def score(self, entry, song):
+        """计算候选歌曲与条目的匹配得分（0~1）"""
+        import difflib
+
+        title_score = difflib.SequenceMatcher(
+            None, self.normalizer.normalize_text(entry['title']),
+            self.normalizer.normalize_text(song.name)).ratio()
+
+        if entry['artist']:
+            artist_score = difflib.SequenceMatcher(
+                None, self.normalizer.normalize_artist(entry['artist']),
+                self.normalizer.normalize_artist(song.artist)).ratio()
+            score = title_score * 0.65 + artist_score * 0.35
+        else:
+            score = title_score
+
+        if entry['duration']:
+            seconds = self.normalizer.duration_seconds(song.duration)
+            if seconds:
+                difference = abs(seconds - entry['duration'])
+                if difference > 3:
+                    score -= min(0.3, difference / 60)
+
+        return max(0.0, score)
+
+    def resolve_entry(self, entry):
+        """搜索并为单个条目挑选最佳匹配"""
+        self.rate_limiter.acquire()
+        keywords = f"{entry['artist']} {entry['title']}".strip()
+        candidates = self.search_func(keywords, 10)
+
+        ranked = sorted(((self.score(entry, song), song) for song in candidates),
+                        key=lambda item: item[0], reverse=True)
+        result = {'entry': entry, 'status': 'unmatched', 'song': None, 'score': 0.0,
+                  'candidates': [f"{song.display_name()} ({score:.2f})"
+                                 for score, song in ranked[:3]]}
+        if not ranked or ranked[0][0] < self.MATCH_THRESHOLD:
+            if ranked:
+                result['score'] = ranked[0][0]
+            return result
+
+        best_score, best_song = ranked[0]
+        result['song'] = best_song
+        result['score'] = best_score
+        result['status'] = 'matched'
+
+        # 第二名得分接近且不是同一录音时视为歧义
+        if len(ranked) > 1:
+            second_score, second_song = ranked[1]
+            if (best_score - second_score < self.AMBIGUOUS_MARGIN and
+                    self.normalizer.compute_key(best_song) != self.normalizer.compute_key(second_song)):
+                result['status'] = 'ambiguous'
+        return result
+
+    def cached_result(self, entry):
+        """从本地缓存读取条目的解析结果"""
+        if self.song_index is None:
+            return None
+        cached = self.song_index.get_import_resolution(self.entry_key(entry))
+        if cached is None:
+            return None
+        status, song_id, score, resolved_at = cached
+        if status == 'unmatched' and time.time() - resolved_at > self.UNMATCHED_CACHE_TTL:
+            return None
+        song = self.song_index.get_song(song_id) if song_id else None
+        if status != 'unmatched' and song is None:
+            return None
+        return {'entry': entry, 'status': status, 'song': song, 'score': score,
+                'candidates': [], 'cached': True}
+
+    def resolve(self, entries, stop_event=None):
+        """并发解析所有条目，按完成顺序产出结果（命中缓存的条目不再搜索）"""
+        to_search = []
+        for entry in entries:
+            result = self.cached_result(entry)
+            if result is not None:
+                yield result
+            else:
+                to_search.append(entry)
+
+        for entry, future in bounded_map(self.resolve_entry, to_search, self.concurrency, stop_event):
+            try:
+                result = future.result()
+            except Exception as e:
+                self.log(f"解析歌单行失败 (第{entry['line']}行): {e}", level=logging.WARNING, phase='import')
+                yield {'entry': entry, 'status': 'error', 'song': None, 'score': 0.0,
+                       'candidates': [str(e)]}
+                continue
+
+            if self.song_index is not None:
+                song_id = result['song'].id if result['song'] else None
+                self.song_index.save_import_resolution(self.entry_key(entry), result['status'],
+                                                       song_id, result['score'])
+            yield result
+
+    @staticmethod
+    def report_path(path):
+        """导入报告的保存路径"""
+        return os.path.splitext(path)[0] + "_import_report.csv"
+
+    def write_report(self, path, results):
+        """写出未匹配或有歧义的条目报告（CSV）"""
+        import csv
+
+        status_names = {'unmatched': '未匹配', 'ambiguous': '有歧义', 'error': '出错'}
+        with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['行号', '原始内容', '状态', '得分', '选用歌曲', '候选歌曲'])
+            for result in results:
+                song = result['song']
+                writer.writerow([result['entry']['line'], result['entry']['raw'],
+                                 status_names.get(result['status'], result['status']),
+                                 f"{result['score']:.2f}",
+                                 song.display_name() if song else '',
+                                 ' | '.join(result['candidates'])])
+
+
+def log_message(message, color=None, level=None, **fields):
+    """记录日志（只放入日志队列，不等待输出）；未指定级别时按颜色确定，
+    fields 为结构化字段（task_id、song_id、phase、bytes、duration）"""
+    if level is None:
+        level = COLOR_LEVELS.get(color, logging.INFO)
+    fields['color'] = color
+    logger.log(level, message, extra=fields)
+
+
+class SourceProvider:
+    """音乐来源：会话初始化、搜索和获取下载链接；新的来源继承此类并实现这三个方法
+
+    name 用作歌曲ID的前缀（主来源除外）和指标标签；session 用于下载该来源返回的链接。
+    """
+
+    name = ''
+    deadline = SOURCE_SEARCH_DEADLINE
+    quality_tiers = ()  # 可选的音质档位（从高到低），空表示只有一种
+
+    def __init__(self):
+        self.ready = False
+        self.session = None
+
+    def init_session(self):
+        """初始化会话，返回是否可用"""
+        raise NotImplementedError
+
+    def search(self, keywords, page=1, page_size=10, cancel_token=None):
+        """搜索，返回 (歌曲列表, 总数)"""
+        raise NotImplementedError
+
+    def resolve(self, song, tier=None):
+        """获取下载链接，返回 (链接, 文件名)，失败时抛出异常；tier 为 quality_tiers 中的音质档位"""
+        raise NotImplementedError
+
+
+class FlacSiteProvider(SourceProvider):
+    """flac.music.hi.cn：先通过雷池人机验证取得会话，再调用 ajax.php 搜索和获取下载链接"""
+
+    name = 'flac'
+    quality_tiers = QUALITY_TIERS
+
+    def __init__(self, log=log_message):
+        super().__init__()
+        self.log = log
+        self.sl_session = None
+        self.sl_jwt_session = None
+
+    def init_session(self):
+        """创建会话并通过站点验证，返回是否成功"""
+        if self.session is None:
+            self.session = self.create_session()
+        self.sl_session, self.sl_jwt_session = self.get_jwt_data()
+        return bool(self.sl_session and self.sl_jwt_session)
+
+    def search(self, keywords, page=1, page_size=10, cancel_token=None):
+        return self.search_music_with_session(keywords, self.sl_session, self.sl_jwt_session, page, page_size,
+                                              cancel_token)
+
+    def resolve(self, song, tier=None):
+        return self.get_music_download_url_with_session(song.id, self.sl_session, self.sl_jwt_session,
+                                                        song.sign, song.time, tier)
+
+    def create_session(self):
+        """创建搜索/下载使用的会话对象"""
+        session = import_requests().Session()
+        session.headers.update({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36'
+        })
+        return session
+
+    # 以下是网络请求函数（保持不变）
+    def get_sl_session(self):
+        """获取sl_session"""
+        try:
+            response = self.session.get('https://flac.music.hi.cn/', verify=False, timeout=10)
+            sl_session_cookie = response.cookies.get('sl-session')
+            logger.debug("获取 sl-session: %s", "成功" if sl_session_cookie else "为空", extra={'phase': 'init'})
+            return sl_session_cookie
+        except Exception as e:
+            self.log(f"获取sl_session失败: {e}", level=logging.ERROR, phase='init')
+            return None
+
+    def get_clientId(self):
+        """获取客户端ID"""
+        try:
+            url = "https://flac.music.hi.cn/"
+            response = self.session.get(url, verify=False, timeout=30)
+            text = response.text
+            pattern = r'SafeLineChallenge\("([^"]+)"'
+            match = re.search(pattern, text)
+            logger.debug("获取 clientId: %s", "成功" if match else "未找到", extra={'phase': 'init'})
+            return match.group(1) if match else None
+        except Exception as e:
+            self.log(f"获取clientId失败: {e}", level=logging.ERROR, phase='init')
+            return None
+
+    def get_issueId(self):
+        """获取issueId"""
+        try:
+            clientId = self.get_clientId()
+            if not clientId:
+                self.log("ERROR: clientId 获取失败", level=logging.ERROR, phase='init')
+                return None, None
+
+            # self.log(f"DEBUG: 获取到的 clientId: {clientId}")
+
+            url = "https://challenge.rivers.chaitin.cn/challenge/v2/api/issue"
+            payload = json.dumps({"client_id": clientId, "level": 1})
+
+            # self.log(f"DEBUG: 请求URL: {url}")
+            # self.log(f"DEBUG: 请求payload: {payload}")
+
+            # 添加更完整的请求头
+            headers = {
+                'Host': 'challenge.rivers.chaitin.cn',
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36',
+                'Content-Type': 'application/json',
+                'Accept': '*/*',
+                'Accept-Language': 'zh-CN,zh;q=0.9',
+                'sec-ch-ua-platform': '"Windows"',
+                'sec-ch-ua': '"Chromium";v="142", "Google Chrome";v="142", "Not_A Brand";v="99"',
+                'sec-ch-ua-mobile': '?0',
+                'Origin': 'https://flac.music.hi.cn',
+                'Sec-Fetch-Site': 'cross-site',
+                'Sec-Fetch-Mode': 'cors',
+                'Sec-Fetch-Dest': 'empty',
+                'Referer': 'https://flac.music.hi.cn/'
+            }
+
+            max_retries = 3
+            for attempt in range(max_retries):
+                try:
+                    self.log(f"尝试获取issueId (第{attempt + 1}次)...")
+                    response = self.session.post(url,
+                                                 headers=headers,
+                                                 data=payload,
+                                                 verify=False,
+                                                 timeout=15)
+
+                    # self.log(f"DEBUG: 响应状态码: {response.status_code}")
+                    # self.log(f"DEBUG: 响应头: {dict(response.headers)}")
+
+                    if response.status_code == 200:
+                        result = response.json()
+                        # self.log(f"DEBUG: 响应JSON: {json.dumps(result, ensure_ascii=False)[:300]}")
+
+                        if 'data' in result:
+                            data_org = result['data'].get('data')
+                            issue_id = result['data'].get('issue_id')
+
+                            # self.log(f"DEBUG: data_org: {data_org}")
+                            # self.log(f"DEBUG: issue_id: {issue_id}")
+
+                            if data_org and issue_id:
+                                self.log("获取issueId成功")
+                                return data_org, issue_id
+                            else:
+                                self.log(f"WARN: data_org或issue_id为空")
+                        else:
+                            self.log(f"WARN: 响应中没有data字段")
+                    else:
+                        self.log(f"ERROR: 响应状态码异常: {response.status_code}")
+                        self.log(f"ERROR: 响应文本: {response.text[:500]}")
+
+                except json.JSONDecodeError as e:
+                    self.log(f"ERROR: JSON解析失败: {e}", level=logging.ERROR, phase='init')
+                    self.log(f"ERROR: 响应内容: {response.text[:500]}")
+                    if attempt < max_retries - 1:
+                        time.sleep(1)
+                    else:
+                        raise
+                except Exception as e:
+                    self.log(f"ERROR: 请求异常: {e}")
+                    if attempt < max_retries - 1:
+                        time.sleep(1)
+                    else:
+                        raise
+
+            self.log("ERROR: 所有重试都失败", level=logging.ERROR, phase='init')
+            return None, None
+
+        except Exception as e:
+            self.log(f"获取issueId失败: {e}", level=logging.ERROR, phase='init')
+            self.log(traceback.format_exc())
+            return None, None
+
+    def f(self):
+        """计算函数"""
+        try:
+            data_org, issue_id = self.get_issueId()
+            if not data_org or not issue_id:
+                return None, None
+
+            t = 1
+            n = sum(data_org)
+            r = (6 + len(data_org) + n) % 6 + 6
+
+            for _ in range(r):
+                t *= 6
+
+            if t < 6666:
+                t *= len(data_org)
+            if t > 0x3f940aa:
+                t = t // len(data_org)
+
+            for o in range(len(data_org)):
+                t += data_org[o] ** 3
+                t ^= o
+                t ^= data_org[o] + o
+
+            f_result = []
+            while t > 0:
+                f_result.insert(0, 63 & t)
+                t >>= 6
+
+            logger.debug("计算 challenge 结果完成", extra={'phase': 'init'})
+            return f_result, issue_id
+        except Exception as e:
+            self.log(f"计算函数f失败: {e}", level=logging.ERROR, phase='init')
+            return None, None
+
+    @timed_phase('challenge')
+    def get_sl_challenge_jwt(self):
+        """获取sl_challenge_jwt"""
+        try:
+            clientId = self.get_clientId()
+            if not clientId:
+                return None
+
+            f_result, issue_id = self.f()
+            if not f_result or not issue_id:
+                return None
+
+            url = "https://challenge.rivers.chaitin.cn/challenge/v2/api/verify"
+            payload = json.dumps({
+                "issue_id": issue_id,
+                "result": f_result,
+                "serials": [],
+                "client": {
+                    "userAgent": self.session.headers['User-Agent'],
+                    "platform": "Win32",
+                    "language": "zh-CN,zh",
+                    "vendor": "Google Inc.",
+                    "screen": [1920, 1080],
+                    "visitorId": clientId,
+                    "score": 0,
+                    "target": []
+                }
+            })
+            headers = {
+                'Host': 'challenge.rivers.chaitin.cn',
+                'sec-ch-ua-platform': '"Windows"',
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36',
+                'sec-ch-ua': '"Chromium";v="142", "Google Chrome";v="142", "Not_A Brand";v="99"',
+                'Content-Type': 'application/json',
+                'sec-ch-ua-mobile': '?0',
+                'Accept': '*/*',
+                'Origin': 'https://flac.music.hi.cn',
+                'Sec-Fetch-Site': 'cross-site',
+                'Sec-Fetch-Mode': 'cors',
+                'Sec-Fetch-Dest': 'empty',
+                'Referer': 'https://flac.music.hi.cn/',
+                'Accept-Language': 'zh-CN,zh;q=0.9'
+            }
+
+            response = self.session.post(url, headers=headers, data=payload, verify=False, timeout=30)
+            result = response.json()
+            logger.debug("获取 sl_challenge_jwt: %s", "成功" if result.get('data') else "失败", extra={'phase': 'init'})
+            return result['data']['jwt'] if 'data' in result else None
+
+        except Exception as e:
+            metrics.record_error('challenge', e)
+            self.log(f"获取sl_challenge_jwt失败: {e}", level=logging.ERROR, phase='init')
+            return None
+
+    @timed_phase('session_init')
+    def get_jwt_data(self):
+        """获取完整的JWT数据"""
+        try:
+            sl_session = self.get_sl_session()
+            if not sl_session:
+                return None, None
+
+            sl_challenge_jwt = self.get_sl_challenge_jwt()
+            if not sl_challenge_jwt:
+                return None, None
+
+            cookie = f'sl-session={sl_session}; sl-challenge-server=cloud; sl-challenge-jwt={sl_challenge_jwt}'
+            url = "https://flac.music.hi.cn"
+
+            headers = {'Cookie': cookie}
+            response = self.session.get(url, headers=headers, verify=False, timeout=30)
+            sl_jwt_session = response.cookies.get('sl_jwt_session')
+            logger.debug("获取 sl_jwt_session: %s", "成功" if sl_jwt_session else "为空", extra={'phase': 'init'})
+
+            return sl_session, sl_jwt_session
+
+        except Exception as e:
+            metrics.record_error('session_init', e)
+            self.log(f"获取JWT数据失败: {e}", level=logging.ERROR, phase='init')
+            return None, None
+
+    @timed_phase('search')
+    def search_music_with_session(self, keywords, sl_session, sl_jwt_session, page=1, page_size=10,
+                                  cancel_token=None):
+        """使用已有的会话信息搜索音乐，cancel_token 被取消时抛出 SearchCancelled"""
+        try:
+            if cancel_token is not None:
+                cancel_token.check()
+
+            url = "https://flac.music.hi.cn/ajax.php?act=search"
+            payload = f'keyword={keywords}&page={page}&size={page_size}'
+
+            headers = {
+                'Cookie': f'sl-session={sl_session}; sl_jwt_session={sl_jwt_session}; sl_jwt_sign=',
+                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                'X-Requested-With': 'XMLHttpRequest'
+            }
+
+            response = self.session.post(url, headers=headers, data=payload,
+                                         verify=False, timeout=30, stream=cancel_token is not None)
+            if cancel_token is not None:
+                # 响应体读取期间被取消时关闭连接，不再读完整个响应
+                cancel_token.attach(response)
+                cancel_token.check()
+            result = response.json()
+
+            if 'data' not in result:
+                return [], 0
+
+            # 获取总结果数并转换为整数
+            total_count = result['data'].get('total', 0)
+            try:
+                total_count = int(total_count)
+            except (ValueError, TypeError):
+                total_count = 0
+
+            if 'list' not in result['data']:
+                return [], total_count
+
+            song_list = result['data']['list']
+            formatted_list = []
+
+            for song in song_list:
+                formatted_list.append(SongRecord(
+                    song.get('id', ''),
+                    song.get('name') or '未知',
+                    song.get('artist') or '未知',
+                    song.get('album_name') or '未知',
+                    self.format_duration(song.get('duration', 0)),
+                    'flac',  # 默认格式
+                    song.get('sign', ''),  # 保存sign值
+                    song.get('time', '')  # 保存time值
+                ))
+
+            return formatted_list, total_count
+
+        except SearchCancelled:
+            raise
+        except Exception as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise SearchCancelled()
+            metrics.record_error('search', e)
+            self.log(f"搜索音乐失败: {e}", level=logging.ERROR, phase='search')
+            return [], 0
+
+    def format_duration(self, seconds):
+        """格式化时长（秒 → MM:SS）"""
+        try:
+            minutes = int(seconds) // 60
+            secs = int(seconds) % 60
+            return f"{minutes:02d}:{secs:02d}"
+        except:
+            return "00:00"
+
+    @timed_phase('resolve')
+    def get_music_download_url_with_session(self, song_id, sl_session, sl_jwt_session, sign='', time='', tier=None):
+        """使用已有的会话信息获取音乐下载链接，带上sign值和time值；tier 为音质档位（默认最高）"""
+        try:
+            url = "https://flac.music.hi.cn/ajax.php?act=getUrl"
+            tier = tier or QUALITY_TIERS[0]
+            quality = f'format={tier.format}&bitrate={tier.bitrate}'
+
+            # 构建请求参数，包含sign值和time值
+            params = [f'songid={song_id}', quality]
+            if sign:
+                params.append(f'sign={sign}')
+            if time:
+                params.append(f'time={time}')
+
+            payload = '&'.join(params)
+
+            headers = {
+                'Cookie': f'sl-session={sl_session}; sl_jwt_session={sl_jwt_session}; sl_jwt_sign=',
+                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                'X-Requested-With': 'XMLHttpRequest'
+            }
+
+            self.log(f"获取下载链接: song_id={song_id}, sign={sign[:20]}..., time={time}")
+
+            response = self.session.post(url, headers=headers, data=payload,
+                                         verify=False, timeout=60)
+            result = response.json()
+
+            if 'data' not in result:
+                raise Exception("下载链接获取失败")
+
+            song_info = result['data']
+            song_url = song_info['url']
+
+            # 从URL中提取文件名
+            if 'song_name' in song_info and 'artist' in song_info:
+                song_name = song_info['song_name']
+                artist = song_info['artist']
+                music_format = song_info.get('format', tier.format)
+                filename = f"{song_name} - {artist}.{music_format}"
+            else:
+                # 如果没有歌曲信息，使用当前时间作为文件名
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                filename = f"song_{timestamp}.{tier.format}"
+
+            return song_url, filename
+
+        except Exception as e:
+            self.log(f"获取下载链接失败: {e}", level=logging.ERROR, phase='resolve')
+            raise
+
+
+class LocalFileResponse:
+    """本地文件的响应对象，提供下载所需的 requests 响应接口（支持从指定位置续传）"""
+
+    def __init__(self, path, start=0):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        start = min(start, size)
+        self.file.seek(start)
+        self.status_code = 206 if start else 200
+        self.headers = {'content-length': str(size - start)}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=8192):
+        return iter(lambda: self.file.read(chunk_size), b'')
+
+    def close(self):
+        self.file.close()
+
+
+class LocalFileSession:
+    """按路径读取本地文件的会话，接口与 requests.Session.get 相同"""
+
+    def get(self, url, headers=None, **kwargs):
+        start = 0
+        if headers and headers.get('Range'):
+            start = int(re.match(r'bytes=(\d+)-', headers['Range']).group(1))
+        return LocalFileResponse(url, start)
+
+
+class DirectoryProvider(SourceProvider):
+    """本地目录来源：把一个音乐文件夹（如局域网共享的曲库）当作来源，按文件名检索；
+    文件名按 "歌名 - 歌手.扩展名" 解析，歌曲ID为 "来源名:相对路径"。也可在测试时替代在线来源"""
+
+    AUDIO_EXTENSIONS = ('.flac', '.ape', '.wav', '.m4a', '.mp3', '.ogg')
+
+    def __init__(self, root, name='dir', deadline=SOURCE_SEARCH_DEADLINE):
+        super().__init__()
+        self.root = root
+        self.name = name
+        self.deadline = deadline
+        self.songs = []  # (检索词, 歌曲)
+        self.session = LocalFileSession()
+
+    def init_session(self):
+        """扫描目录，返回是否存在"""
+        if not os.path.isdir(self.root):
+            return False
+        songs = []
+        for directory, _, files in os.walk(self.root):
+            for file in sorted(files):
+                stem, ext = os.path.splitext(file)
+                if ext.lower() not in self.AUDIO_EXTENSIONS:
+                    continue
+                name, _, artist = stem.partition(' - ')
+                relative = os.path.relpath(os.path.join(directory, file), self.root).replace(os.sep, '/')
+                album = os.path.basename(directory) if directory != self.root else '未知'
+                song = SongRecord(f"{self.name}:{relative}", name.strip() or stem, artist.strip() or '未知', album,
+                                  '', ext[1:].lower())
+                songs.append((DuplicateClusterer.normalize_text(f"{stem} {album}"), song))
+        self.songs = songs
+        return True
+
+    def search(self, keywords, page=1, page_size=10, cancel_token=None):
+        terms = [DuplicateClusterer.normalize_text(word) for word in keywords.split()]
+        matches = [song for text, song in self.songs if all(term in text for term in terms)]
+        start = (page - 1) * page_size
+        return matches[start:start + page_size], len(matches)
+
+    def resolve(self, song, tier=None):
+        relative = str(song.id).split(':', 1)[1]
+        path = os.path.normpath(os.path.join(self.root, relative))
+        if os.path.commonpath([path, os.path.normpath(self.root)]) != os.path.normpath(self.root) or \
+                not os.path.isfile(path):
+            raise Exception(f"文件不存在: {relative}")
+        return path, os.path.basename(path)
+
+
+class SearchResultMerger:
+    """合并多个来源的搜索结果：其他来源已有的同一首歌（歌名、歌手相同，时长相同或有一方未知）只保留先到的一个；
+    同一来源内的重复版本照常保留，由界面归组显示"""
+
+    def __init__(self):
+        self.normalizer = DuplicateClusterer()
+        self.seen_ids = set()
+        self.seen_keys = set()  # (歌名, 歌手, 时长分桶)
+        self.seen_titles = set()  # (歌名, 歌手)
+        self.untimed_titles = set()  # 时长未知的 (歌名, 歌手)
+        self.lock = threading.Lock()
+
+    def is_duplicate(self, song, key):
+        if song.id in self.seen_ids or key in self.seen_keys:
+            return True
+        title = key[:2]
+        return title in self.untimed_titles or (key[2] is None and title in self.seen_titles)
+
+    def add(self, songs):
+        """加入一个来源的结果，返回其中的新歌曲"""
+        with self.lock:
+            added = [(song, key) for song, key in ((song, self.normalizer.compute_key(song)) for song in songs)
+                     if not self.is_duplicate(song, key)]
+            for song, key in added:
+                self.seen_ids.add(song.id)
+                self.seen_keys.add(key)
+                self.seen_titles.add(key[:2])
+                if key[2] is None:
+                    self.untimed_titles.add(key[:2])
+        return [song for song, _ in added]
+
+
+def default_source_providers(log=log_message, directories=()):
+    """默认来源：flac 站点，以及环境变量 FLAC_SOURCE_DIRS 和 directories 中的本地目录"""
+    providers = [FlacSiteProvider(log)]
+    directories = [d for d in os.environ.get(SOURCE_DIRS_ENV, '').split(os.pathsep) if d] + list(directories)
+    for i, directory in enumerate(directories, 1):
+        providers.append(DirectoryProvider(os.path.expanduser(directory), f"dir{i}"))
+    return providers
+
+
+class MusicClient:
+    """音乐站点客户端：会话验证、搜索、获取下载链接和下载文件，不依赖界面"""
+
+    def __init__(self, song_index=None, log=log_message, providers=None):
+        self.song_index = song_index  # 搜索结果同时记录到本地索引
+        self.log = log
+        self.track_cache = None  # 可选的曲目缓存（本地目录或局域网缓存服务），下载前先查缓存
+        # 音乐来源，第一个为主来源；歌曲ID带 "来源名:" 前缀的属于对应来源，其余属于主来源
+        self.providers = providers if providers is not None else default_source_providers(log)
+        self.search_executor = None
+        self.matcher = None
+        # 主来源的会话（下载默认使用），在初始化时创建（导入 requests 较慢）
+        self.session = None
+        self.sl_session = None
+        self.sl_jwt_session = None
+
+    def init_session(self):
+        """并行初始化全部来源的会话，返回是否有可用的来源"""
+        for _ in bounded_map(self.init_provider, self.providers, max(1, len(self.providers))):
+            pass
+        primary = self.providers[0]
+        self.session = primary.session
+        self.sl_session = getattr(primary, 'sl_session', None)
+        self.sl_jwt_session = getattr(primary, 'sl_jwt_session', None)
+        return any(provider.ready for provider in self.providers)
+
+    def init_provider(self, provider):
+        try:
+            provider.ready = bool(provider.init_session())
+        except Exception as e:
+            provider.ready = False
+            self.log(f"来源 {provider.name} 初始化失败: {e}", level=logging.ERROR, phase='init')
+        metrics.set('flac_source_ready', int(provider.ready), provider=provider.name)
+        return provider.ready
+
+    def provider_for(self, song_id):
+        """歌曲ID所属的来源"""
+        prefix = str(song_id).split(':', 1)[0] if ':' in str(song_id) else None
+        for provider in self.providers[1:]:
+            if provider.name == prefix:
+                return provider
+        return self.providers[0]
+
+    @staticmethod
+    def search_provider(provider, keywords, page, page_size, cancel_token):
+        started = time.perf_counter()
+        try:
+            return provider.search(keywords, page, page_size, cancel_token)
+        finally:
+            metrics.observe('flac_source_seconds', time.perf_counter() - started, provider=provider.name, op='search')
+
+    def search_music_with_session(self, keywords, sl_session=None, sl_jwt_session=None, page=1, page_size=10,
+                                  cancel_token=None, on_late=None):
+        """并行搜索全部可用来源，按来源顺序合并并去除重复的歌曲，返回 (歌曲列表, 总数)
+
+        每个来源有自己的截止时间，超时来源的结果到达后经 on_late(新增歌曲列表) 追加（在来源的搜索线程中回调，
+        已返回的来源在本线程中立即回调，回调不能阻塞；未提供时丢弃）；总数取各来源中最大的一个。会话参数只为兼容保留，各来源使用自己的会话。
+        """
+        from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+        providers = [provider for provider in self.providers if provider.ready]
+        if not providers:
+            return [], 0
+        if len(providers) == 1:
+            songs, total = self.search_provider(providers[0], keywords, page, page_size, cancel_token)
+            metrics.inc('flac_source_requests_total', provider=providers[0].name, op='search', result='ok')
+            return self.record_results(songs), total
+
+        merger = SearchResultMerger()
+        if self.search_executor is None:
+            self.search_executor = ThreadPoolExecutor(max_workers=len(self.providers) * 4,
+                                                      thread_name_prefix="source-search")
+        futures = [(provider, self.search_executor.submit(self.search_provider, provider, keywords, page,
+                                                          page_size, cancel_token))
+                   for provider in providers]
+
+        # 各来源同时开始，按各自的截止时间依次等待
+        started = time.monotonic()
+        songs, total, late = [], 0, []
+        for provider, future in futures:
+            try:
+                found, count = future.result(timeout=max(0.0, provider.deadline - (time.monotonic() - started)))
+            except SearchCancelled:
+                raise
+            except FutureTimeout:
+                late.append((provider, future))
+                metrics.inc('flac_source_requests_total', provider=provider.name, op='search', result='late')
+                continue
+            except Exception as e:
+                metrics.inc('flac_source_requests_total', provider=provider.name, op='search', result='error')
+                self.log(f"来源 {provider.name} 搜索失败: {e}", level=logging.WARNING, phase='search')
+                continue
+            metrics.inc('flac_source_requests_total', provider=provider.name, op='search', result='ok')
+            songs.extend(merger.add(found))
+            total = max(total, count)
+        if cancel_token is not None:
+            cancel_token.check()
+
+        for provider, future in late:
+            future.add_done_callback(functools.partial(self.on_late_results, provider, merger, cancel_token, on_late))
+        return self.record_results(songs), max(total, len(songs))
+
+    def on_late_results(self, provider, merger, cancel_token, on_late, future):
+        """超过截止时间的来源返回后，把其中的新歌曲追加给调用方"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        if cancel_token is not None and cancel_token.cancelled:
+            return
+        songs = self.record_results(merger.add(future.result()[0]))
+        self.log(f"来源 {provider.name} 的结果晚到，追加 {len(songs)} 首", level=logging.DEBUG, phase='search')
+        if songs and on_late is not None:
+            on_late(songs)
+
+    def record_results(self, songs):
+        """记录到本地索引"""
+        if songs and self.song_index is not None:
+            self.song_index.add_songs(songs)
+        return songs
+
+    def find_equivalent(self, provider, song):
+        """在其他来源中查找同一首歌（歌名、歌手和时长匹配），找不到时返回 None"""
+        if song.name == '未知':
+            return None
+        if self.matcher is None:
+            self.matcher = PlaylistImporter(None, log=self.log)
+        entry = {'title': song.name, 'artist': '' if song.artist == '未知' else song.artist,
+                 'duration': DuplicateClusterer.duration_seconds(song.duration) or None}
+        candidates, _ = provider.search(f"{entry['artist']} {song.name}".strip(), 1, 10)
+        ranked = sorted(((self.matcher.score(entry, candidate), candidate) for candidate in candidates),
+                        key=lambda item: item[0], reverse=True)
+        if ranked and ranked[0][0] >= PlaylistImporter.MATCH_THRESHOLD:
+            return ranked[0][1]
+        return None
+
+    def preflight_size(self, provider, url):
+        """预检文件大小（HEAD 请求的 Content-Length），取不到时返回 None"""
+        head = getattr(provider.session, 'head', None)
+        if head is None:
+            return None
+        try:
+            response = head(url, allow_redirects=True, verify=False, timeout=15)
+            response.close()
+            return int(response.headers.get('content-length') or 0) or None
+        except Exception as e:
+            logger.debug("预检文件大小失败: %s", e, extra={'phase': 'resolve'})
+            return None
+
+    def resolve_with_policy(self, provider, song, policy, tier=None):
+        """按音质策略挑选档位并获取下载链接，返回 (链接, 文件名, 档位)；指定 tier 时使用该档位（断点续传）"""
+        if tier is not None and tier in provider.quality_tiers:
+            song_url, filename = provider.resolve(song, tier)
+            return song_url, filename, tier
+        if policy is None or not provider.quality_tiers:
+            song_url, filename = provider.resolve(song)
+            return song_url, filename, provider.quality_tiers[0] if provider.quality_tiers else None
+
+        def probe(tier):
+            song_url, filename = provider.resolve(song, tier)
+            size = self.preflight_size(provider, song_url) if policy.mode != QUALITY_HIGHEST else None
+            return song_url, filename, size
+
+        tier, song_url, filename = policy.select(song, provider.quality_tiers, probe)
+        return song_url, filename, tier
+
+    def resolve_song(self, song, policy=None, tier=None, source=None):
+        """获取下载链接，返回 (链接, 文件名, 来源, 音质档位)；所属来源获取失败时依次到其他来源查找同一首歌；
+        policy 为批次的音质策略（只作用于提供多个档位的来源），tier 为续传时沿用的档位，
+        source 为续传时限定的来源名称（断点文件只能从原来源接上）"""
+        owner = self.provider_for(song.id)
+        errors = []
+        for provider in [owner] + [provider for provider in self.providers if provider is not owner]:
+            if not provider.ready or (source is not None and provider.name != source):
+                continue
+            started = time.perf_counter()
+            try:
+                target = song if provider is owner else self.find_equivalent(provider, song)
+                if target is None:
+                    errors.append(f"{provider.name}: 未找到")
+                    continue
+                song_url, filename, chosen = self.resolve_with_policy(provider, target, policy, tier)
+            except Exception as e:
+                metrics.inc('flac_source_requests_total', provider=provider.name, op='resolve', result='error')
+                errors.append(f"{provider.name}: {e}")
+                continue
+            finally:
+                metrics.observe('flac_source_seconds', time.perf_counter() - started, provider=provider.name,
+                                op='resolve')
+            metrics.inc('flac_source_requests_total', provider=provider.name, op='resolve', result='ok')
+            if provider is not owner:
+                self.log(f"改从来源 {provider.name} 下载: {song.display_name()}", level=logging.INFO,
+                         song_id=song.id, phase='resolve')
+            return song_url, filename, provider, chosen
+        raise Exception("所有来源都无法获取下载链接（" + "；".join(errors or ["没有可用的来源"]) + "）")
+
+    def resolve_resume(self, song, policy, resume_state):
+        """续传时只从原来源、按原档位获取下载链接，返回 resolve_song 的结果；
+        原来源无法获取时删除断点文件并返回 None，由调用方重新下载"""
+        source = resume_state.get('provider')
+        try:
+            return self.resolve_song(song, policy, resume_state.get('tier'), source)
+        except Exception as e:
+            self.log(f"原来源 {source} 无法续传，重新下载: {e}", level=logging.WARNING, song_id=song.id,
+                     phase='resolve')
+            self.remove_partial_file(resume_state['part_path'])
+            return None
+
+    def get_music_download_url_with_session(self, song_id, sl_session=None, sl_jwt_session=None, sign='', time=''):
+        """获取歌曲ID的下载链接，返回 (链接, 文件名)；本地索引中有歌曲信息时可回退到其他来源"""
+        song = self.song_index.get_song(song_id) if self.song_index is not None else None
+        if song is None:
+            song = SongRecord(song_id, sign=sign, time=time)
+        song_url, filename, _, _ = self.resolve_song(song)
+        return song_url, filename
+
+    @staticmethod
+    def filename_for_tier(filename, tier):
+        """按所选档位的格式调整扩展名（如降为 MP3）"""
+        if tier is None:
+            return filename
+        return f"{os.path.splitext(filename)[0]}.{tier.format}"
+
+    def record_download(self, song, path, provider, tier):
+        """在本地索引中记录下载完成的歌曲、来源和音质档位"""
+        if self.song_index is None or not path:
+            return
+        try:
+            self.song_index.record_download(song.id, provider.name, tier.name if tier else None,
+                                            os.path.getsize(path), path)
+        except Exception as e:
+            self.log(f"记录下载信息失败: {e}", level=logging.WARNING, song_id=song.id)
+
+    def song_filename(self, song):
+        """生成歌曲的保存文件名：歌曲名 - 艺术家.格式"""
+        filename = f"{song.display_name()}.{song.format}"
+        # 清理文件名中的非法字符
+        return self.clean_filename(filename)
+
+    def clean_filename(self, filename):
+        """清理文件名中的非法字符"""
+        # 替换Windows文件名中不允许的字符
+        illegal_chars = r'[<>:"/\\|?*]'
+        filename = re.sub(illegal_chars, '_', filename)
+
+        # 移除开头和结尾的空格和点
+        filename = filename.strip('. ')
+
+        # 如果文件名太长，截断
+        if len(filename) > 200:
+            name, ext = os.path.splitext(filename)
+            filename = name[:200 - len(ext)] + ext
+
+        return filename
+
+    @timed_phase('download')
+    def download_file(self, url, save_dir, filename, task_index, control=None, resume_state=None, throttle=None,
+                      on_progress=None, session=None):
+        """下载文件并保存，返回保存路径；支持暂停（释放连接，继续时断点续传）和取消；
+        throttle(字节数) 在写入每个数据块前调用，用于限速；on_progress(进度跟踪器) 在写入每个数据块后调用；
+        session 为链接所属来源的会话（默认使用主来源的会话）"""
+        if control is None:
+            control = TaskControl()
+        part_path = None
+        try:
+            if resume_state:
+                # 从上次暂停的位置继续
+                filepath = resume_state['filepath']
+                part_path = resume_state['part_path']
+                downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            else:
+                # 如果文件已存在，添加序号
+                filepath = unused_path(save_dir, filename)
+
+                # 先写入临时文件，完成后再改名，中断时不会留下残缺的音乐文件
+                part_path = filepath + ".part"
+                downloaded = 0
+
+            # 下载文件，继续下载时只请求剩余部分
+            headers = {'Range': f'bytes={downloaded}-'} if downloaded else None
+            request_started = time.perf_counter()
+            response = (session or self.session).get(url, stream=True, verify=False, timeout=30,
+                                                     headers=headers)
+            # 流式请求在收到响应头后返回，近似于首字节时间
+            metrics.observe('flac_download_ttfb_seconds', time.perf_counter() - request_started)
+            transfer_started = time.perf_counter()
+            write_seconds = 0.0
+            written = 0
+            try:
+                response.raise_for_status()
+
+                if downloaded and response.status_code != 206:
+                    # 服务器不支持断点续传，从头开始
+                    downloaded = 0
+
+                # 获取文件大小（续传时 content-length 为剩余大小）
+                total_size = downloaded + int(response.headers.get('content-length', 0))
+
+                # 创建进度跟踪器
+                tracker = DownloadProgressTracker(filename, total_size)
+                tracker.downloaded = tracker.last_downloaded = downloaded
+
+                # 打开文件进行写入
+                with open(part_path, 'ab' if downloaded else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        # 每个数据块检查一次暂停/取消
+                        if control.is_paused or control.is_cancelled:
+                            control.check()
+                            self.log(f"已暂停: {filename} ({tracker.format_size(tracker.downloaded)})")
+                            raise DownloadPaused({'filepath': filepath, 'part_path': part_path})
+                        if chunk:
+                            if throttle is not None:
+                                throttle(len(chunk))
+                            write_started = time.perf_counter()
+                            f.write(chunk)
+                            write_seconds += time.perf_counter() - write_started
+                            written += len(chunk)
+                            link_throughput.add(len(chunk))
+                            # 更新进度
+                            tracker.update(len(chunk))
+                            if on_progress is not None:
+                                on_progress(tracker)
+            finally:
+                # 暂停或取消时关闭响应，释放连接给其他任务
+                response.close()
+                metrics.inc('flac_download_bytes_total', written)
+                metrics.observe('flac_download_transfer_seconds', time.perf_counter() - transfer_started)
+                metrics.observe('flac_download_write_stall_seconds', write_seconds, WRITE_STALL_BUCKETS)
+
+            os.replace(part_path, filepath)
+            return filepath
+
+        except DownloadPaused:
+            raise
+        except DownloadCancelled:
+            self.remove_partial_file(part_path)
+            raise
+        except Exception as e:
+            self.remove_partial_file(part_path)
+            raise Exception(f"文件下载失败: {str(e)}") from e
+
+    def download_song(self, song, save_dir, filename, task_index, control=None, resume_state=None, throttle=None,
+                      on_progress=None, policy=None):
+        """获取下载链接并下载一首歌曲，返回保存路径；只有歌曲ID（没有歌名）时使用来源返回的文件名；
+        policy 为批次的音质策略"""
+        resolved = self.resolve_resume(song, policy, resume_state) if resume_state else None
+        if resolved is None:
+            resume_state = None
+            path, tier = self.fetch_cached(song, save_dir, None if song.name == '未知' else filename, policy)
+            if path:
+                if policy is not None:
+                    policy.record_cached(tier)
+                self.record_download(song, path, self.provider_for(song.id), tier)
+                return path
+            resolved = self.resolve_song(song, policy)
+        song_url, server_filename, provider, tier = resolved
+        try:
+            if song.name == '未知' and server_filename and not resume_state:
+                filename = self.clean_filename(server_filename)
+            elif not resume_state:
+                filename = self.filename_for_tier(filename, tier)
+            path = self.download_file(song_url, save_dir, filename, task_index, control, resume_state, throttle,
+                                      on_progress, provider.session)
+        except DownloadPaused as e:
+            # 继续时沿用同一来源和档位，断点文件才能接上
+            e.resume_state['provider'] = provider.name
+            e.resume_state['tier'] = tier
+            raise
+        finally:
+            if policy is not None:
+                policy.finish(song.id)
+        self.store_cached(song, path, tier)
+        self.record_download(song, path, provider, tier)
+        return path
+
+    @staticmethod
+    def cache_key(song, tier):
+        """曲目缓存的键：同一首歌的不同音质档位分开存放"""
+        return song.id if tier is None else f"{song.id}@{tier.name}"
+
+    def fetch_cached(self, song, save_dir, filename=None, policy=None):
+        """曲目缓存中有这首歌符合音质策略的档位时直接取出（不经过站点），返回 (保存路径, 档位)，
+        否则返回 (None, None)；文件扩展名按取出的档位调整，缓存出错不影响下载"""
+        if self.track_cache is None:
+            return None, None
+        tiers = self.provider_for(song.id).quality_tiers
+        for tier in (policy.cache_tiers(song, tiers) if policy is not None else tiers[:1]) or (None,):
+            try:
+                path = self.track_cache.fetch(self.cache_key(song, tier), save_dir,
+                                              filename and self.filename_for_tier(filename, tier))
+            except Exception as e:
+                self.log(f"读取曲目缓存失败: {e}", level=logging.WARNING, song_id=song.id, phase='cache')
+                return None, None
+            if path:
+                self.log(f"从缓存取得: {os.path.basename(path)}", level=logging.INFO, song_id=song.id,
+                         phase='cache')
+                return path, tier
+        return None, None
+
+    def store_cached(self, song, path, tier=None):
+        """把下载完成的文件按档位存入曲目缓存，失败只记录日志"""
+        if self.track_cache is None or not path:
+            return
+        try:
+            self.track_cache.put(self.cache_key(song, tier), path)
+        except Exception as e:
+            self.log(f"写入曲目缓存失败: {e}", level=logging.WARNING, song_id=song.id, phase='cache')
+
+    def remove_partial_file(self, part_path):
+        """删除未完成的临时文件"""
+        if part_path and os.path.exists(part_path):
+            try:
+                os.remove(part_path)
+            except OSError as e:
+                self.log(f"删除临时文件失败: {e}", level=logging.WARNING)
@@ -0,0 +1,801 @@
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+from flac_music_cache import add_cache_arguments, track_cache_from_args
+from flac_music_core import (
+    DEFAULT_DOWNLOAD_DIR, DOWNLOAD_WORKERS, LANE_BULK, LANE_INTERACTIVE, LANE_NAMES, SONG_INDEX_PATH,
+    DownloadCancelled, DownloadJob, DownloadPaused, DownloadProgressTracker, DownloadService, DownloadTaskRecord,
+    DownloadScheduler, MetricsExporter, MusicClient, RateLimiter, SearchCancelled, SongIndex, SongRecord,
+    TaskControl, add_schedule_arguments, log_message, logger, metrics, schedule_windows_from_args, setup_logging,
+)
+
+# 守护进程默认只监听本机
+DAEMON_HOST = '127.0.0.1'
+DAEMON_PORT = 8765
+
+# 事件流：同一任务的进度事件最小间隔（秒）、空闲时的保活间隔（秒）、每个订阅者最多积压的事件数
+PROGRESS_EVENT_INTERVAL = 0.5
+EVENT_KEEPALIVE = 15
+EVENT_BACKLOG = 2000
+
+# 搜索结果缓存：有效期（秒）和条数，多个客户端的相同搜索只请求一次站点
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_SIZE = 256
+
+# 守护进程保留的已结束任务数（供客户端查询结果）
+FINISHED_TASKS_KEPT = 1000
+
+
+class EventSubscriber:
+    """事件流的一个订阅者：积压超过上限时标记溢出，由服务端断开，客户端重连后重新同步"""
+
+    def __init__(self, capacity=EVENT_BACKLOG):
+        self.capacity = capacity
+        self.events = collections.deque()
+        self.cond = threading.Condition()
+        self.overflowed = False
+
+    def put(self, item):
+        with self.cond:
+            if len(self.events) >= self.capacity:
+                self.overflowed = True
+            else:
+                self.events.append(item)
+            self.cond.notify()
+
+    def get(self, timeout):
+        """取下一个事件，超时返回 None"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.events or self.overflowed, timeout)
+            return self.events.popleft() if self.events else None
+
+
+class EventBroker:
+    """向所有事件流订阅者广播事件 (序号, 事件名, 数据)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.sequence = 0
+
+    def subscribe(self):
+        subscriber = EventSubscriber()
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, **data):
+        with self.lock:
+            self.sequence += 1
+            item = (self.sequence, event, data)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(item)
+
+
+class SearchCache:
+    """搜索结果缓存（按关键词、页码和每页数量），超过有效期或条数上限时淘汰"""
+
+    def __init__(self, ttl=SEARCH_CACHE_TTL, capacity=SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # 键 -> (缓存时间, 歌曲列表, 总数)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                metrics.inc('flac_daemon_search_cache_total', result='miss')
+                return None
+            self.entries.move_to_end(key)
+        metrics.inc('flac_daemon_search_cache_total', result='hit')
+        return entry[1], entry[2]
+
+    def put(self, key, songs, total):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), songs, total)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+
+class DaemonEngine:
+    """守护进程的下载引擎：共享的会话、连接池、歌曲索引、搜索缓存和下载队列，供多个客户端使用"""
+
+    def __init__(self, output_dir, workers=DOWNLOAD_WORKERS, rate_limit=0, song_index=None):
+        self.output_dir = output_dir
+        self.client = MusicClient(song_index)
+        self.session_lock = threading.Lock()
+        self.broker = EventBroker()
+        self.search_cache = SearchCache()
+        self.limiter = RateLimiter(rate_limit, max(rate_limit, 64 * 1024)) if rate_limit > 0 else None
+
+        self.batch_control = TaskControl()  # 全部暂停/取消
+        self.lock = threading.Lock()
+        # 任务ID在守护进程运行期间唯一（下载服务的序号每轮重新计数），记在任务记录的 index 中
+        self.task_ids = itertools.count(1)
+        self.jobs = collections.OrderedDict()  # 任务ID -> 任务（含已结束的任务）
+        self.service = DownloadService(self.run_job, workers, prepare_job=self.prepare_job,
+                                       on_start=self.on_start, on_idle=self.on_idle)
+        self.scheduler = None  # 下载时段（可选）
+
+    def start_schedule(self, windows):
+        """按时段调整并发数和带宽上限，时段变化时通知客户端"""
+        self.scheduler = DownloadScheduler(self.service, windows,
+                                           on_change=lambda window: self.broker.publish('schedule',
+                                                                                        **self.scheduler.status()))
+        self.scheduler.start()
+
+    @property
+    def session_ready(self):
+        return bool(self.client.sl_session and self.client.sl_jwt_session)
+
+    def init_session(self):
+        """初始化（或重新初始化）站点会话，所有客户端共用"""
+        with self.session_lock:
+            ok = self.client.init_session()
+        self.broker.publish('session', ready=ok)
+        log_message("会话初始化成功" if ok else "会话初始化失败", level=logging.INFO if ok else logging.ERROR,
+                    phase='init')
+        return ok
+
+    def search(self, keywords, page=1, page_size=10):
+        """搜索（相同的搜索在有效期内直接返回缓存）"""
+        key = (keywords, page, page_size)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            return cached
+        songs, total = self.client.search_music_with_session(
+            keywords, self.client.sl_session, self.client.sl_jwt_session, page, page_size)
+        if songs:
+            self.search_cache.put(key, songs, total)
+        return songs, total
+
+    def enqueue(self, songs, lane=LANE_INTERACTIVE):
+        """加入下载队列，返回 (新任务, 已在队列中的歌曲ID)"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        jobs = self.service.submit(songs, self.output_dir, lane=lane)
+        added = {job.song.id for job in jobs}
+        return jobs, [song.id for song in songs if song.id not in added]
+
+    def prepare_job(self, job):
+        """任务入队前登记（持有下载服务的锁）"""
+        task_id = next(self.task_ids)
+        job.record = DownloadTaskRecord(task_id, task_id, TaskControl(self.batch_control),
+                                        self.client.song_filename(job.song))
+        job.control = job.record.control
+        with self.lock:
+            self.jobs[job.record.index] = job
+        self.broker.publish('queued', **self.task_info(job))
+
+    def on_start(self):
+        """空闲后开始新一轮：清理上一轮已结束的任务，保留最近的若干条"""
+        self.batch_control = TaskControl()
+        with self.lock:
+            finished = [task_id for task_id, job in self.jobs.items()
+                        if job.record.status in ('done', 'failed', 'cancelled')]
+            for task_id in finished[:max(0, len(finished) - FINISHED_TASKS_KEPT)]:
+                del self.jobs[task_id]
+
+    def on_idle(self, totals):
+        self.broker.publish('idle', **totals)
+
+    def task_info(self, job):
+        """任务状态（JSON 接口）"""
+        record = job.record
+        tracker = record.tracker
+        return {'task': record.index, 'song': job.song.as_dict(), 'lane': job.lane, 'status': record.status,
+                'file': record.filename, 'bytes': tracker.downloaded if tracker else 0,
+                'total': tracker.total_size if tracker else 0, 'speed': round(tracker.speed) if tracker else 0}
+
+    def tasks(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [self.task_info(job) for job in jobs]
+
+    def get_job(self, task_id):
+        with self.lock:
+            return self.jobs.get(task_id)
+
+    def control(self, action, task_id=None):
+        """暂停/继续/取消一个任务（task_id 为 None 时作用于全部任务），返回是否找到任务"""
+        if task_id is None:
+            control = self.batch_control
+        else:
+            job = self.get_job(task_id)
+            if job is None:
+                return False
+            control = job.control
+        if action == 'pause':
+            control.pause()
+        elif action == 'resume':
+            control.resume()
+        else:
+            control.cancel()
+            if task_id is None:
+                # 之后加入的任务不受影响（被取消的任务可能还在收尾）
+                self.batch_control = TaskControl()
+            # 排队或暂停中的任务直接移除
+            for job in self.service.discard_cancelled():
+                self.finish_cancelled(job)
+        return True
+
+    def finish_cancelled(self, job):
+        record = job.record
+        if record.resume_state:
+            self.client.remove_partial_file(record.resume_state['part_path'])
+            record.resume_state = None
+        record.status = 'cancelled'
+        self.broker.publish('cancelled', task=record.index, song_id=job.song.id)
+
+    def status(self):
+        totals = self.service.totals()
+        return {'session': self.session_ready, 'output_dir': self.output_dir, 'totals': totals,
+                'waits': self.service.wait_summary(), 'paused': self.batch_control.is_paused,
+                'schedule': self.scheduler.status() if self.scheduler is not None else None}
+
+    def run_job(self, job):
+        """下载服务工作线程执行一项任务：成功返回 True，失败/取消返回 False，暂停返回 None"""
+        song = job.song
+        record = job.record
+        task_id = record.index
+        last_event = [0.0]
+
+        def on_progress(tracker):
+            record.tracker = tracker
+            now = time.monotonic()
+            if now - last_event[0] >= PROGRESS_EVENT_INTERVAL:
+                last_event[0] = now
+                self.broker.publish('progress', task=task_id, bytes=tracker.downloaded, total=tracker.total_size,
+                                    speed=round(tracker.speed))
+
+        def throttle(nbytes):
+            self.service.throttle(job, nbytes)
+            if self.limiter is not None:
+                self.limiter.acquire(nbytes)
+
+        started = time.monotonic()
+        try:
+            job.control.check()
+            if job.control.is_paused:
+                raise DownloadPaused(record.resume_state)
+            record.status = 'downloading'
+            self.broker.publish('start', task=task_id, song_id=song.id)
+            path = self.client.download_song(song, job.download_dir, record.filename, task_id, job.control,
+                                             record.resume_state, throttle, on_progress)
+        except DownloadPaused as e:
+            record.resume_state = e.resume_state
+            record.status = 'paused'
+            self.broker.publish('paused', task=task_id, song_id=song.id)
+            return None
+        except DownloadCancelled:
+            self.finish_cancelled(job)
+            return False
+        except Exception as e:
+            record.status = 'failed'
+            log_message(f"❌ 下载失败 {song.display_name()}: {e}", level=logging.ERROR, task_id=task_id,
+                        song_id=song.id, phase='download')
+            self.broker.publish('failed', task=task_id, song_id=song.id, error=str(e))
+            return False
+
+        record.resume_state = None
+        record.status = 'done'
+        record.filename = os.path.basename(path)
+        log_message(f"✅ 下载完成: {record.filename}", task_id=task_id, song_id=song.id, phase='download',
+                    bytes=record.tracker.downloaded if record.tracker else None,
+                    duration=round(time.monotonic() - started, 3))
+        self.broker.publish('done', task=task_id, song_id=song.id, path=path,
+                            bytes=record.tracker.downloaded if record.tracker else os.path.getsize(path))
+        return True
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """HTTP 接口的请求处理"""
+
+    server_version = "FlacMusicDaemon/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("HTTP %s " + format, self.client_address[0], *args)
+
+    @property
+    def engine(self):
+        return self.server.engine
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json({'error': message}, status)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def authorized(self, query):
+        """设置了令牌时，请求须带 Authorization: Bearer <令牌> 或 ?token=<令牌>"""
+        token = self.server.token
+        if not token:
+            return True
+        header = self.headers.get('Authorization', '')
+        return header == f"Bearer {token}" or query.get('token', [None])[0] == token
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        if not self.authorized(query):
+            self.send_error_json(401, "未授权")
+            return
+        try:
+            self.route(method, parts, query)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error_json(400, f"请求无效: {e}")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            logger.exception("处理请求出错")
+            self.send_error_json(500, str(e))
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def route(self, method, parts, query):
+        engine = self.engine
+        if method == 'GET' and parts == ['metrics']:
+            body = metrics.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if not parts or parts[0] != 'api':
+            self.send_error_json(404, "没有这个接口")
+            return
+
+        parts = parts[1:]
+        if method == 'GET' and parts == ['status']:
+            self.send_json(engine.status())
+        elif method == 'POST' and parts == ['session']:
+            self.send_json({'session': engine.init_session()})
+        elif method == 'GET' and parts == ['search']:
+            keywords = query['q'][0].strip()
+            page = int(query.get('page', ['1'])[0])
+            page_size = min(100, int(query.get('size', ['10'])[0]))
+            songs, total = engine.search(keywords, page, page_size)
+            self.send_json({'total': total, 'songs': [song.as_dict() for song in songs]})
+        elif method == 'GET' and parts == ['downloads']:
+            self.send_json({'tasks': engine.tasks(), 'totals': engine.service.totals()})
+        elif method == 'POST' and parts == ['downloads']:
+            body = self.read_json()
+            lane = body.get('lane', LANE_INTERACTIVE)
+            if lane not in LANE_NAMES:
+                raise ValueError(f"未知的通道 {lane}")
+            songs = [SongRecord.from_dict(song) for song in body.get('songs', [])]
+            for song_id in body.get('song_ids', []):
+                song = engine.client.song_index.get_song(song_id) if engine.client.song_index else None
+                songs.append(song or SongRecord(song_id))
+            jobs, skipped = engine.enqueue(songs, lane)
+            self.send_json({'tasks': [engine.task_info(job) for job in jobs], 'skipped': skipped})
+        elif method == 'POST' and len(parts) == 2 and parts[0] == 'downloads' and \
+                parts[1] in ('pause', 'resume', 'cancel'):
+            engine.control(parts[1])
+            self.send_json({'ok': True})
+        elif method == 'POST' and len(parts) == 3 and parts[0] == 'downloads' and \
+                parts[2] in ('pause', 'resume', 'cancel'):
+            if not engine.control(parts[2], int(parts[1])):
+                self.send_error_json(404, "没有这个任务")
+                return
+            self.send_json({'ok': True})
+        elif method == 'GET' and parts == ['events']:
+            self.stream_events()
+        else:
+            self.send_error_json(404, "没有这个接口")
+
+    def stream_events(self):
+        """服务器推送事件（SSE）：每个事件一条 id/event/data，空闲时定期发送保活注释"""
+        subscriber = self.engine.broker.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(b"retry: 2000\n\n")
+            self.wfile.flush()
+            while not self.server.stopping.is_set():
+                item = subscriber.get(EVENT_KEEPALIVE)
+                if subscriber.overflowed:
+                    break
+                if item is None:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    sequence, event, data = item
+                    payload = json.dumps(data, ensure_ascii=False, default=str)
+                    self.wfile.write(f"id: {sequence}\nevent: {event}\ndata: {payload}\n\n".encode('utf-8'))
+                self.wfile.flush()
+        finally:
+            self.engine.broker.unsubscribe(subscriber)
+
+
+def make_server(engine, host=DAEMON_HOST, port=DAEMON_PORT, token=None):
+    """创建 HTTP 服务（每个连接一个线程，事件流长连接不阻塞其他请求）"""
+    server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+    server.daemon_threads = True
+    server.engine = engine
+    server.token = token
+    server.stopping = threading.Event()
+    return server
+
+
+class RemoteMusicClient(MusicClient):
+    """守护进程的客户端：会话和搜索转发给守护进程，接口与 MusicClient 相同"""
+
+    def __init__(self, base_url, token=None, song_index=None, log=log_message):
+        super().__init__(song_index, log)
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.ready = False
+
+    def request(self, method, path, body=None, timeout=30):
+        """发送请求并解析 JSON 响应，HTTP 错误时抛出带服务端说明的异常"""
+        import urllib.error
+        import urllib.request
+
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        req.add_header('Content-Type', 'application/json')
+        if self.token:
+            req.add_header('Authorization', f"Bearer {self.token}")
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read().decode('utf-8')).get('error', e.reason)
+            except ValueError:
+                message = e.reason
+            raise Exception(f"守护进程返回 {e.code}: {message}") from e
+
+    def init_session(self):
+        """守护进程已有会话时直接使用，否则请守护进程初始化"""
+        status = self.request('GET', '/api/status')
+        self.ready = status['session'] or self.request('POST', '/api/session', {}, timeout=120)['session']
+        # 会话凭据留在守护进程中，这里只作为已初始化的标记
+        self.sl_session = self.sl_jwt_session = 'daemon' if self.ready else None
+        return self.ready
+
+    def search_music_with_session(self, keywords, sl_session, sl_jwt_session, page=1, page_size=10,
+                                  cancel_token=None, on_late=None):
+        """由守护进程搜索；守护进程只返回截止时间内到达的来源结果，晚到的结果不转发，on_late 不会被调用"""
+        try:
+            if cancel_token is not None:
+                cancel_token.check()
+            query = urlencode({'q': keywords, 'page': page, 'size': page_size})
+            result = self.request('GET', f"/api/search?{query}")
+            if cancel_token is not None:
+                cancel_token.check()
+            songs = [SongRecord.from_dict(song) for song in result['songs']]
+            if self.song_index is not None:
+                self.song_index.add_songs(songs)
+            return songs, result['total']
+        except SearchCancelled:
+            raise
+        except Exception as e:
+            self.log(f"搜索音乐失败: {e}", level=logging.ERROR, phase='search')
+            return [], 0
+
+    def events(self, timeout=EVENT_KEEPALIVE * 2):
+        """读取事件流，逐个产出 (事件名, 数据)；连接断开时结束"""
+        import urllib.request
+
+        query = f"?{urlencode({'token': self.token})}" if self.token else ""
+        with urllib.request.urlopen(self.base_url + "/api/events" + query, timeout=timeout) as response:
+            event, data = None, []
+            for raw in response:
+                line = raw.decode('utf-8').rstrip('\r\n')
+                if not line:
+                    if event and data:
+                        yield event, json.loads("\n".join(data))
+                    event, data = None, []
+                elif line.startswith('event:'):
+                    event = line[6:].strip()
+                elif line.startswith('data:'):
+                    data.append(line[5:].strip())
+
+
+class RemoteDownloadService:
+    """守护进程下载队列的本地代理，接口与 DownloadService 相同：任务在守护进程中下载，
+    进度和结果经事件流回到本地任务，本地任务的暂停/继续/取消同步给守护进程"""
+
+    SYNC_INTERVAL = 0.2  # 同步本地控制状态的间隔（秒）
+
+    def __init__(self, client, prepare_job=None, on_start=None, on_idle=None, on_state=None, on_progress=None,
+                 on_finish=None):
+        self.client = client
+        self.prepare_job = prepare_job
+        self.on_start = on_start
+        self.on_idle = on_idle
+        self.on_state = on_state  # 状态变化回调 (任务, 状态 waiting/downloading/paused)
+        self.on_progress = on_progress  # 进度回调 (任务, 进度跟踪器)
+        self.on_finish = on_finish  # 结束回调 (任务, 状态 done/failed/cancelled, 事件数据)
+
+        self.cond = threading.Condition()
+        self.jobs = {}  # 守护进程的任务ID -> 本地任务（未结束）
+        self.states = {}  # 任务ID -> 守护进程中的状态
+        self.sent = {}  # 任务ID -> 已同步给守护进程的 (暂停, 取消)
+        self.trackers = {}  # 任务ID -> 由进度事件更新的进度跟踪器
+        self.holds = 0
+        self.total = 0
+        self.done = 0
+        self.succeeded = 0
+        self.started = False
+
+        for target, name in ((self.event_loop, "daemon-events"), (self.sync_loop, "daemon-sync")):
+            threading.Thread(target=target, name=name, daemon=True).start()
+
+    def totals(self):
+        with self.cond:
+            pending = {LANE_INTERACTIVE: 0, LANE_BULK: 0}
+            running = paused = 0
+            for task_id, job in self.jobs.items():
+                state = self.states.get(task_id)
+                if state == 'downloading':
+                    running += 1
+                elif state == 'paused':
+                    paused += 1
+                else:
+                    pending[job.lane] += 1
+            return {'total': self.total, 'done': self.done, 'succeeded': self.succeeded, 'running': running,
+                    'pending': pending, 'paused': paused}
+
+    def wait_summary(self):
+        try:
+            return self.client.request('GET', '/api/status')['waits']
+        except Exception:
+            return {}
+
+    def begin(self):
+        """从空闲进入新一轮（需持有锁）"""
+        if not self.jobs and not self.holds:
+            self.total = self.done = self.succeeded = 0
+            if self.on_start:
+                self.on_start()
+
+    def hold(self):
+        with self.cond:
+            self.begin()
+            self.holds += 1
+
+    def release(self):
+        with self.cond:
+            self.holds -= 1
+        self.notify_if_idle()
+
+    def submit(self, songs, download_dir=None, remove_when_done=False, lane=LANE_INTERACTIVE):
+        """加入守护进程的下载队列（保存目录由守护进程决定），返回实际加入的任务"""
+        songs = list(songs)
+        if not songs:
+            return []
+        result = self.client.request('POST', '/api/downloads',
+                                     {'songs': [song.as_dict() for song in songs], 'lane': lane})
+        by_id = {song.id: song for song in songs}
+        jobs = []
+        with self.cond:
+            self.begin()
+            for info in result['tasks']:
+                song = by_id.get(info['song']['id']) or SongRecord.from_dict(info['song'])
+                job = DownloadJob(song, info['task'], download_dir, remove_when_done, info['lane'])
+                if self.prepare_job:
+                    self.prepare_job(job)
+                self.jobs[job.index] = job
+                self.states.setdefault(job.index, info['status'])
+                self.total += 1
+                jobs.append(job)
+            self.cond.notify_all()
+        return jobs
+
+    def wait_for_room(self, limit, stop_event, lane=LANE_BULK):
+        """等待该通道排队任务少于 limit，stop_event 被设置时返回 False"""
+        with self.cond:
+            while not stop_event.is_set():
+                waiting = sum(1 for task_id, job in self.jobs.items()
+                              if job.lane == lane and self.states.get(task_id) == 'waiting')
+                if waiting < limit:
+                    break
+                self.cond.wait(0.5)
+        return not stop_event.is_set()
+
+    def throttle(self, job, nbytes):
+        """下载在守护进程中进行，本地不限速"""
+
+    def discard_cancelled(self):
+        """取消由同步线程转发给守护进程，本地没有需要清理的临时文件"""
+        self.sync_controls()
+        return []
+
+    def sync_loop(self):
+        while True:
+            time.sleep(self.SYNC_INTERVAL)
+            try:
+                self.sync_controls()
+            except Exception as e:
+                logger.debug(f"同步任务控制失败: {e}")
+
+    def sync_controls(self):
+        """本地任务的暂停/继续/取消状态变化时通知守护进程"""
+        with self.cond:
+            jobs = list(self.jobs.items())
+        for task_id, job in jobs:
+            if job.control is None:
+                continue
+            wanted = (job.control.is_paused, job.control.is_cancelled)
+            sent = self.sent.get(task_id, (False, False))
+            if wanted == sent:
+                continue
+            if wanted[1]:
+                action = 'cancel'
+            else:
+                action = 'pause' if wanted[0] else 'resume'
+            self.client.request('POST', f"/api/downloads/{task_id}/{action}", {})
+            self.sent[task_id] = wanted
+
+    def event_loop(self):
+        """读取守护进程的事件流，断开后重连并重新同步任务状态"""
+        while True:
+            try:
+                self.resync()
+                for event, data in self.client.events():
+                    self.handle_event(event, data)
+            except Exception as e:
+                logger.debug(f"守护进程事件流断开: {e}")
+            time.sleep(2)
+
+    def resync(self):
+        """按守护进程的任务列表补上断线期间错过的状态变化"""
+        with self.cond:
+            if not self.jobs:
+                return
+        for info in self.client.request('GET', '/api/downloads')['tasks']:
+            if info['status'] in ('done', 'failed', 'cancelled'):
+                self.handle_event(info['status'], {'task': info['task'], 'bytes': info['bytes']})
+            else:
+                self.handle_event('state', {'task': info['task'], 'status': info['status']})
+
+    def handle_event(self, event, data):
+        task_id = data.get('task')
+        with self.cond:
+            job = self.jobs.get(task_id)
+        if job is None:
+            return
+
+        if event == 'progress':
+            tracker = self.trackers.get(task_id)
+            if tracker is None:
+                tracker = self.trackers[task_id] = DownloadProgressTracker(str(task_id), data['total'])
+            tracker.total_size = data['total']
+            tracker.downloaded = data['bytes']
+            tracker.speed = data['speed']
+            tracker.progress = data['bytes'] / data['total'] * 100 if data['total'] else 0
+            self.set_state(task_id, 'downloading')
+            if self.on_progress:
+                self.on_progress(job, tracker)
+        elif event in ('start', 'paused', 'state'):
+            self.set_state(task_id, {'start': 'downloading', 'paused': 'paused'}.get(event, data.get('status')))
+        elif event in ('done', 'failed', 'cancelled'):
+            with self.cond:
+                if self.jobs.pop(task_id, None) is None:
+                    return
+                self.states.pop(task_id, None)
+                self.sent.pop(task_id, None)
+                self.trackers.pop(task_id, None)
+                self.done += 1
+                if event == 'done':
+                    self.succeeded += 1
+                self.cond.notify_all()
+            if self.on_finish:
+                self.on_finish(job, event, data)
+            self.notify_if_idle()
+
+    def set_state(self, task_id, state):
+        with self.cond:
+            job = self.jobs.get(task_id)
+            if job is None or self.states.get(task_id) == state:
+                return
+            self.states[task_id] = state
+            self.cond.notify_all()
+        if self.on_state:
+            self.on_state(job, state)
+
+    def notify_if_idle(self):
+        with self.cond:
+            if self.jobs or self.holds or self.total == 0:
+                return
+            totals = {'total': self.total, 'done': self.done, 'succeeded': self.succeeded}
+            self.total = 0
+        if self.on_idle:
+            self.on_idle(totals)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="无损音乐下载器守护进程：HTTP/JSON 接口和事件流，多个客户端共用会话和下载队列")
+    parser.add_argument('--host', default=DAEMON_HOST, help="监听地址（默认 %(default)s，局域网共用时设为 0.0.0.0）")
+    parser.add_argument('--port', type=int, default=DAEMON_PORT, help="监听端口（默认 %(default)s）")
+    parser.add_argument('-o', '--output', default=DEFAULT_DOWNLOAD_DIR, help="下载目录（默认 %(default)s）")
+    parser.add_argument('-j', '--concurrency', type=int, default=DOWNLOAD_WORKERS,
+                        help="并发下载数（默认 %(default)s）")
+    parser.add_argument('--rate-limit', type=float, default=0, metavar='KBPS',
+                        help="全部下载合计的带宽上限（KB/s，0 表示不限制）")
+    parser.add_argument('--token', default=os.environ.get('FLAC_DAEMON_TOKEN'),
+                        help="访问令牌（也可用环境变量 FLAC_DAEMON_TOKEN），监听非本机地址时建议设置")
+    parser.add_argument('--no-index', action='store_true', help="不读写本地歌曲索引")
+    add_cache_arguments(parser)
+    add_schedule_arguments(parser)
+    args = parser.parse_args(argv)
+    try:
+        windows = schedule_windows_from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    setup_logging(stream=sys.stderr)
+    metrics.set('flac_info', 1, mode='daemon')
+    try:
+        MetricsExporter(metrics).start()
+    except OSError as e:
+        logger.warning(f"指标导出不可用: {e}")
+
+    song_index = None
+    if not args.no_index:
+        try:
+            song_index = SongIndex(SONG_INDEX_PATH)
+        except Exception as e:
+            logger.warning(f"本地歌曲索引不可用: {e}")
+
+    engine = DaemonEngine(os.path.abspath(os.path.expanduser(args.output)), args.concurrency,
+                          int(args.rate_limit * 1024), song_index)
+    engine.client.track_cache = track_cache_from_args(args)
+    if windows:
+        engine.start_schedule(windows)
+    server = make_server(engine, args.host, args.port, args.token)
+    if args.host not in ('127.0.0.1', 'localhost', '::1') and not args.token:
+        logger.warning("监听非本机地址且未设置访问令牌，局域网内任何人都可以使用此守护进程")
+
+    # 会话在后台初始化，期间接口已可访问（状态中 session 为 false）
+    threading.Thread(target=engine.init_session, name="session-init", daemon=True).start()
+    logger.info(f"守护进程已启动: http://{args.host}:{server.server_address[1]}/api/status，下载目录 {engine.output_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopping.set()
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,108 +1,104 @@
-from tqdm import tqdm
-import requests
-import re
-import warnings
-import urllib3
-import json
+import time
+
+# 开始导入模块的时间，用于 --startup-report 启动耗时报告
+STARTUP_STARTED = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
 import threading
-import time
 import os
 import sys
-import shutil
-from datetime import datetime, timedelta
 import traceback
 import math
-import subprocess
-
-# 彻底地禁用所有警告
-warnings.filterwarnings("ignore")
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# 定义颜色方案
-COLORS = {
-    "primary": "#4A90E2",
-    "secondary": "#5C6BC0",
-    "success": "#66BB6A",
-    "warning": "#FFA726",
-    "danger": "#EF5350",
-    "dark": "#2C3E50",
-    "light": "#F5F7FA",
-    "gray": "#B0BEC5",
-    "text": "#37474F",
-    "text_light": "#78909C",
-    "bg_light": "#FFFFFF",
-    "bg_dark": "#F8F9FA"
-}
-
-
-class DownloadProgressTracker:
-    """跟踪单个下载任务的进度信息"""
-
-    def __init__(self, filename, total_size):
-        self.filename = filename
-        self.total_size = total_size
-        self.downloaded = 0
-        self.start_time = time.time()
-        self.last_update_time = time.time()
-        self.last_downloaded = 0
-        self.speed = 0
-        self.eta = "计算中..."
-        self.progress = 0
-
-    def update(self, chunk_size):
-        """更新下载进度"""
-        self.downloaded += chunk_size
-        current_time = time.time()
-        time_elapsed = current_time - self.last_update_time
-
-        # 计算下载速度（每2秒更新一次）
-        if time_elapsed >= 2.0:
-            downloaded_since_last = self.downloaded - self.last_downloaded
-            self.speed = downloaded_since_last / time_elapsed  # 字节/秒
-            self.last_downloaded = self.downloaded
-            self.last_update_time = current_time
-
-            # 计算剩余时间
-            if self.speed > 0 and self.total_size > 0:
-                remaining_bytes = self.total_size - self.downloaded
-                eta_seconds = remaining_bytes / self.speed
-                if eta_seconds > 3600:
-                    self.eta = f"{eta_seconds / 3600:.1f}小时"
-                elif eta_seconds > 60:
-                    self.eta = f"{eta_seconds / 60:.1f}分钟"
-                else:
-                    self.eta = f"{eta_seconds:.0f}秒"
-            else:
-                self.eta = "计算中..."
-
-        # 计算进度百分比
-        if self.total_size > 0:
-            self.progress = (self.downloaded / self.total_size) * 100
-        else:
-            self.progress = 0
-
-    def format_size(self, size_bytes):
-        """格式化文件大小"""
-        if size_bytes == 0:
-            return "0B"
-        size_names = ("B", "KB", "MB", "GB")
-        i = int(math.floor(math.log(size_bytes, 1024)))
-        p = math.pow(1024, i)
-        s = round(size_bytes / p, 2)
-        return f"{s} {size_names[i]}"
-
-    def format_speed(self):
-        """格式化下载速度"""
-        return f"{self.format_size(self.speed)}/s"
-
-    def get_progress_text(self):
-        """获取进度显示文本"""
-        if self.total_size > 0:
-            return f"{self.format_size(self.downloaded)} / {self.format_size(self.total_size)} ({self.progress:.1f}%)"
-        else:
-            return f"{self.format_size(self.downloaded)} (大小未知)"
+import collections
+import logging
+import logging.handlers
+import atexit
+import functools
+
+from flac_music_core import (
+    COLORS, DEFAULT_DOWNLOAD_DIR, DIAGNOSTICS_DIR, DOWNLOAD_ALL_PAGE_CONCURRENCY, DOWNLOAD_ALL_PAGE_SIZE, DOWNLOAD_ALL_QUEUE_SIZE,
+    DOWNLOAD_WORKERS, IMPORT_CONCURRENCY, IMPORT_RATE_LIMIT, LANE_BULK, LANE_INTERACTIVE, LANE_NAMES,
+    SONG_INDEX_PATH, ConsoleLogFormatter, Diagnostics, DownloadCancelled, DownloadPaused,
+    DownloadProgressTracker, DownloadScheduler, DownloadService, DownloadTaskModel, DuplicateClusterer,
+    MetricsExporter, MusicClient, PlaylistImporter, ProgressBoard, SearchCancelled, SearchCancelToken, SongIndex,
+    SongSelectionModel, StartupTimer, TaskControl, add_quality_arguments, add_schedule_arguments,
+    bounded_map, import_requests, log_buffer, log_message, logger, metrics, print_song_memory_benchmark,
+    quality_policy_from_args, schedule_windows_from_args, setup_logging,
+)
+
+# 下载进度的界面刷新帧率（次/秒）
+PROGRESS_RENDER_FPS = 10
+
+# 边输入边搜索的防抖间隔（毫秒）
+SEARCH_DEBOUNCE_MS = 400
+
+# 检查关注的歌手是否到了同步时间的间隔（毫秒）
+WATCH_CHECK_MS = 10 * 60 * 1000
+
+# 界面响应：调度队列的执行间隔和每批时间上限、心跳间隔、延迟预算和卡顿告警的最小间隔
+UI_DISPATCH_INTERVAL_MS = 16
+UI_DISPATCH_BUDGET = 0.008
+UI_HEARTBEAT_MS = 50
+UI_LAG_BUDGET = 0.1
+UI_LAG_WARN_INTERVAL = 5
+UI_LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class WatchListPanel:
+    """关注歌手窗口：添加/取消关注，查看上次同步时间，立即同步"""
+
+    def __init__(self, parent, watch_list, sync_callback):
+        self.watch_list = watch_list
+        self.sync_callback = sync_callback
+
+        self.window = tk.Toplevel(parent)
+        self.window.title("关注的歌手")
+        self.window.geometry("520x400")
+        self.window.configure(bg=COLORS['bg_light'])
+
+        toolbar = tk.Frame(self.window, bg=COLORS['bg_light'])
+        toolbar.pack(fill=tk.X, padx=10, pady=(10, 5))
+        self.name_var = tk.StringVar()
+        entry = ttk.Entry(toolbar, textvariable=self.name_var, font=("Microsoft YaHei", 10))
+        entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        entry.bind('<Return>', lambda e: self.add_artist())
+        ModernButton(toolbar, text="关注", command=self.add_artist, bg=COLORS['primary'],
+                     padx=8, pady=3).pack(side=tk.LEFT, padx=(5, 0))
+        ModernButton(toolbar, text="取消关注", command=self.remove_artist, bg=COLORS['danger'],
+                     padx=8, pady=3).pack(side=tk.LEFT, padx=(5, 0))
+        ModernButton(toolbar, text="立即同步", command=self.sync_now, bg=COLORS['success'],
+                     padx=8, pady=3).pack(side=tk.LEFT, padx=(5, 0))
+
+        self.tree = ttk.Treeview(self.window, columns=('name', 'songs', 'last_sync'), show='headings')
+        for column, text, width in (('name', "歌手", 200), ('songs', "已知歌曲", 80), ('last_sync', "上次同步", 160)):
+            self.tree.heading(column, text=text)
+            self.tree.column(column, width=width)
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        self.reload()
+
+    def reload(self):
+        self.tree.delete(*self.tree.get_children())
+        for artist in self.watch_list.artists():
+            last_sync = (time.strftime("%Y-%m-%d %H:%M", time.localtime(artist['last_sync']))
+                         if artist['last_sync'] else "未同步")
+            self.tree.insert('', tk.END, iid=artist['name'], values=(artist['name'], artist['songs'], last_sync))
+
+    def add_artist(self):
+        name = self.name_var.get().strip()
+        if name:
+            self.watch_list.add(name)
+            self.name_var.set("")
+            self.reload()
+
+    def remove_artist(self):
+        for name in self.tree.selection():
+            self.watch_list.remove(name)
+        self.reload()
+
+    def sync_now(self):
+        """同步选中的歌手（未选中时同步全部）"""
+        self.sync_callback(list(self.tree.selection()) or None)
 
 
 class UpdateChecker:
@@ -113,11 +109,18 @@ class UpdateChecker:
         self.update_info = None
         self.local_version = "3.2"  # 当前本地版本
         self.update_url = "https://gh-proxy.org/https://github.com/tackeyxy/flac_music_downloader/blob/main/update_info.json"
+        self.session = None  # 独立的连接池，不与搜索/下载会话共用
+
+    def get_session(self):
+        """按需创建更新检查专用的会话"""
+        if self.session is None:
+            self.session = import_requests().Session()
+        return self.session
 
     def check_for_update(self):
         """检查更新"""
         try:
-            response = requests.get(self.update_url, verify=False, timeout=10)
+            response = self.get_session().get(self.update_url, verify=False, timeout=10)
             response.raise_for_status()
 
             self.update_info = response.json()
@@ -172,7 +175,7 @@ class UpdateChecker:
             filepath = os.path.join(current_dir, filename)
 
             # 下载文件
-            response = requests.get(download_url, stream=True, verify=False, timeout=30)
+            response = self.get_session().get(download_url, stream=True, verify=False, timeout=30)
             response.raise_for_status()
 
             total_size = int(response.headers.get('content-length', 0))
@@ -273,14 +276,503 @@ class ModernEntry(tk.Entry):
         super().__init__(master, **defaults)
 
 
+def callback_name(func):
+    """回调的可读名称"""
+    func = getattr(func, 'func', func)  # functools.partial
+    return getattr(func, '__qualname__', None) or repr(func)
+
+
+class UiDispatcher:
+    """界面线程调度队列：工作线程只把界面修改放入队列，界面线程定时批量执行，每批有时间上限"""
+
+    def __init__(self, root, interval_ms=UI_DISPATCH_INTERVAL_MS, budget=UI_DISPATCH_BUDGET):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.budget = budget
+        self.main_id = threading.get_ident()  # 在界面线程中创建
+        self.queue = collections.deque()
+        self.current = None  # 正在执行的回调名称，供延迟监视标注卡顿
+        self.executed = 0
+        self.batches = 0
+        self.max_backlog = 0
+
+    def call(self, func, *args, **kwargs):
+        """在界面线程执行 func；在界面线程中调用时直接执行"""
+        if threading.get_ident() == self.main_id:
+            func(*args, **kwargs)
+        else:
+            self.queue.append((func, args, kwargs))
+
+    def start(self):
+        self.root.after(self.interval_ms, self.drain)
+
+    def drain(self):
+        """执行队列中的回调，超过时间上限的留到下一批"""
+        if self.queue:
+            self.max_backlog = max(self.max_backlog, len(self.queue))
+            self.batches += 1
+            deadline = time.perf_counter() + self.budget
+            while self.queue:
+                func, args, kwargs = self.queue.popleft()
+                self.current = callback_name(func)
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    logger.exception(f"界面回调出错: {self.current}")
+                self.executed += 1
+                if time.perf_counter() >= deadline:
+                    break
+            self.current = None
+        self.root.after(self.interval_ms, self.drain)
+
+
+class EventLoopMonitor:
+    """界面事件循环延迟监视：界面线程定时心跳测量延迟；心跳超时时看门狗线程采样界面线程的调用栈，
+    标注卡顿期间正在执行的回调"""
+
+    WORST_STALLS = 10
+
+    def __init__(self, root, dispatcher=None, interval_ms=UI_HEARTBEAT_MS, budget=UI_LAG_BUDGET):
+        self.root = root
+        self.dispatcher = dispatcher
+        self.interval = interval_ms / 1000
+        self.budget = budget
+        self.main_id = threading.get_ident()  # 在界面线程中创建
+        self.lags = collections.deque(maxlen=2000)  # 最近的心跳延迟（秒）
+        self.beats = 0
+        self.over_budget = 0
+        self.stalls = []  # 最严重的卡顿 (延迟, 回调)
+        self.expected = None
+        self.stall_label = None
+        self.last_warning = 0.0
+        self.stop_event = threading.Event()
+
+    def start(self):
+        self.expected = time.perf_counter() + self.interval
+        self.root.after(int(self.interval * 1000), self.beat)
+        threading.Thread(target=self.watchdog, name="ui-lag-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def beat(self):
+        """心跳：实际执行时间与预期时间之差即事件循环延迟"""
+        now = time.perf_counter()
+        self.record(max(0.0, now - self.expected))
+        self.expected = now + self.interval
+        if not self.stop_event.is_set():
+            self.root.after(int(self.interval * 1000), self.beat)
+
+    def watchdog(self):
+        """心跳超时时记录界面线程正在执行的代码"""
+        while not self.stop_event.wait(self.budget / 4):
+            expected = self.expected
+            if self.stall_label is None and expected is not None and time.perf_counter() - expected > self.budget:
+                frame = sys._current_frames().get(self.main_id)
+                self.stall_label = self.describe(frame)
+
+    def describe(self, frame):
+        """卡顿位置：正在执行的回调（本程序中连续的最外层函数）和最内层的函数"""
+        names = []
+        while frame is not None:
+            if frame.f_code.co_filename == __file__:
+                names.append(getattr(frame.f_code, 'co_qualname', frame.f_code.co_name))
+            elif names:
+                break  # 已越过回调入口，外层是 Tk 事件循环
+            frame = frame.f_back
+
+        if self.dispatcher is not None and self.dispatcher.current:
+            outer = self.dispatcher.current
+        elif names:
+            outer = names[-1]
+        else:
+            return "Tk 事件处理"
+        inner = names[0] if names else outer
+        return outer if inner == outer else f"{outer} > {inner}"
+
+    def record(self, lag):
+        self.beats += 1
+        self.lags.append(lag)
+        metrics.observe('flac_ui_lag_seconds', lag, UI_LAG_BUCKETS)
+        label, self.stall_label = self.stall_label, None
+        if lag <= self.budget:
+            return
+
+        self.over_budget += 1
+        label = label or "未知"
+        self.stalls.append((lag, label))
+        self.stalls.sort(reverse=True)
+        del self.stalls[self.WORST_STALLS:]
+
+        now = time.monotonic()
+        if now - self.last_warning >= UI_LAG_WARN_INTERVAL:
+            self.last_warning = now
+            logger.warning(f"界面卡顿 {lag * 1000:.0f}ms，超出预算 {self.budget * 1000:.0f}ms（正在执行: {label}）",
+                           extra={'phase': 'ui', 'duration': round(lag, 3)})
+
+    def summary(self):
+        """延迟统计摘要文本"""
+        if not self.lags:
+            return "界面延迟: 暂无数据"
+        ordered = sorted(self.lags)
+
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+        text = (f"界面延迟: 心跳 {self.beats} 次，p50 {percentile(0.5):.1f}ms，p95 {percentile(0.95):.1f}ms，"
+                f"p99 {percentile(0.99):.1f}ms，最大 {ordered[-1] * 1000:.1f}ms，超出预算 {self.over_budget} 次")
+        if self.stalls:
+            text += "；最严重的卡顿: " + "，".join(f"{lag * 1000:.0f}ms {label}" for lag, label in self.stalls[:5])
+        return text
+
+
+class VirtualTaskList:
+    """虚拟化的下载任务列表：只为可见行（加少量缓冲行）创建控件，其余任务只保存在数据模型中"""
+
+    ROW_HEIGHT = 80  # 每行高度（像素）
+    BUFFER_ROWS = 2  # 可见区域之外额外保留的行数
+
+    def __init__(self, master, model):
+        self.model = model
+        self.rows = []  # 复用的行控件池
+        self.top = 0  # 第一条可见任务在模型中的位置
+        self.bound_version = -1
+
+        self.container = tk.Frame(master, bg=COLORS['bg_light'])
+        self.scrollbar = ttk.Scrollbar(master, orient="vertical",
+                                       command=self.on_scroll,
+                                       style="Custom.Vertical.TScrollbar")
+        self.container.pack(side="left", fill="both", expand=True, padx=(0, 5))
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.container.bind('<Configure>', self.on_resize)
+        self.bind_mousewheel(self.container)
+
+    def bind_mousewheel(self, widget):
+        """绑定鼠标滚轮（Windows/macOS 与 X11）"""
+        widget.bind('<MouseWheel>', lambda e: self.scroll_by(-1 if e.delta > 0 else 1))
+        widget.bind('<Button-4>', lambda e: self.scroll_by(-1))
+        widget.bind('<Button-5>', lambda e: self.scroll_by(1))
+
+    def visible_count(self):
+        """可见区域能完整显示的行数"""
+        return max(1, self.container.winfo_height() // self.ROW_HEIGHT)
+
+    def on_resize(self, event):
+        """容器大小变化时调整行控件池"""
+        needed = event.height // self.ROW_HEIGHT + self.BUFFER_ROWS
+        while len(self.rows) < needed:
+            self.rows.append(self.create_row())
+        while len(self.rows) > needed:
+            self.rows.pop()['frame'].destroy()
+        self.refresh(force=True)
+
+    def create_row(self):
+        """创建一行任务控件（只在控件池扩容时调用）"""
+        frame = tk.Frame(self.container,
+                         relief=tk.RIDGE,
+                         bd=1,
+                         padx=10,
+                         pady=8,
+                         bg=COLORS['bg_light'])
+
+        # 任务信息标签
+        task_label = tk.Label(frame,
+                              font=("Microsoft YaHei", 9, "bold"),
+                              anchor="w",
+                              bg=COLORS['bg_light'],
+                              fg=COLORS['text'])
+        task_label.pack(fill=tk.X)
+
+        # 进度条
+        progress_var = tk.DoubleVar()
+        progress_bar = ttk.Progressbar(frame,
+                                       variable=progress_var,
+                                       maximum=100,
+                                       style="Custom.Horizontal.TProgressbar")
+        progress_bar.pack(fill=tk.X, pady=(5, 2))
+
+        # 进度信息框架
+        info_frame = tk.Frame(frame, bg=COLORS['bg_light'])
+        info_frame.pack(fill=tk.X)
+
+        # 进度百分比、大小、速度、剩余时间标签
+        percent_label = tk.Label(info_frame, font=("Microsoft YaHei", 9, "bold"), width=6, anchor="w",
+                                 bg=COLORS['bg_light'], fg=COLORS['primary'])
+        percent_label.pack(side=tk.LEFT, padx=(0, 15))
+
+        size_label = tk.Label(info_frame, font=("Microsoft YaHei", 9), width=25, anchor="w",
+                              bg=COLORS['bg_light'], fg=COLORS['text'])
+        size_label.pack(side=tk.LEFT, padx=(0, 15))
+
+        speed_label = tk.Label(info_frame, font=("Microsoft YaHei", 9), width=15, anchor="w",
+                               bg=COLORS['bg_light'], fg=COLORS['text'])
+        speed_label.pack(side=tk.LEFT, padx=(0, 15))
+
+        eta_label = tk.Label(info_frame, font=("Microsoft YaHei", 9), width=15, anchor="w",
+                             bg=COLORS['bg_light'], fg=COLORS['text'])
+        eta_label.pack(side=tk.LEFT)
+
+        row = {}
+
+        # 取消、暂停/继续按钮
+        cancel_button = ModernButton(info_frame, text="取消", command=lambda: self.cancel_task(row),
+                                     bg=COLORS['danger'], font=('Microsoft YaHei', 8), padx=6, pady=0)
+        cancel_button.pack(side=tk.RIGHT)
+        pause_button = ModernButton(info_frame, text="暂停", command=lambda: self.toggle_pause(row),
+                                    bg=COLORS['warning'], font=('Microsoft YaHei', 8), padx=6, pady=0)
+        pause_button.pack(side=tk.RIGHT, padx=(0, 5))
+
+        for widget in (frame, task_label, progress_bar, info_frame,
+                       percent_label, size_label, speed_label, eta_label):
+            self.bind_mousewheel(widget)
+
+        row.update({
+            'frame': frame,
+            'pause_button': pause_button,
+            'cancel_button': cancel_button,
+            'progress_var': progress_var,
+            'percent_label': percent_label,
+            'size_label': size_label,
+            'speed_label': speed_label,
+            'eta_label': eta_label,
+            'task_label': task_label,
+            'record': None,
+            'rendered': {}
+        })
+        return row
+
+    def toggle_pause(self, row):
+        """暂停或继续该行的任务"""
+        record = row['record']
+        if record is None or record.control is None:
+            return
+        if record.control.paused:
+            record.control.resume()
+        else:
+            record.control.pause()
+        self.render_row(row)
+
+    def cancel_task(self, row):
+        """取消该行的任务，立即从列表移除"""
+        record = row['record']
+        if record is None or record.control is None:
+            return
+        record.control.cancel()
+        self.model.remove(record.key)
+        self.refresh()
+
+    def on_scroll(self, *args):
+        """滚动条回调"""
+        total = len(self.model)
+        if args[0] == 'moveto':
+            self.set_top(int(float(args[1]) * total))
+        elif args[0] == 'scroll':
+            step = int(args[1]) * (self.visible_count() if args[2] == 'pages' else 1)
+            self.scroll_by(step)
+
+    def scroll_by(self, rows):
+        """按行滚动"""
+        self.set_top(self.top + rows)
+
+    def set_top(self, top):
+        """设置第一条可见任务"""
+        top = max(0, min(top, len(self.model) - self.visible_count()))
+        if top != self.top:
+            self.top = top
+            self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """模型结构变化或滚动后，重新把行控件绑定到对应任务"""
+        if not force and self.bound_version == self.model.version:
+            return
+        self.bound_version = self.model.version
+
+        total = len(self.model)
+        self.top = max(0, min(self.top, total - self.visible_count()))
+        records = self.model.slice(self.top, len(self.rows))
+
+        for i, row in enumerate(self.rows):
+            record = records[i] if i < len(records) else None
+            if record is None:
+                row['frame'].place_forget()
+                row['record'] = None
+                continue
+
+            if row['record'] is not record:
+                row['record'] = record
+                row['rendered'] = {}
+            row['frame'].place(x=0, y=i * self.ROW_HEIGHT, relwidth=1, height=self.ROW_HEIGHT - 4)
+            self.render_row(row)
+
+        # 更新滚动条
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.visible_count()) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def render_key(self, key):
+        """刷新某个任务的显示（不可见的任务直接跳过）"""
+        for row in self.rows:
+            record = row['record']
+            if record is not None and record.key == key:
+                self.render_row(row)
+                return
+
+    def render_row(self, row):
+        """刷新一行控件，只修改内容有变化的控件"""
+        record = row['record']
+        rendered = row['rendered']
+        tracker = record.tracker
+
+        def set_text(name, text):
+            if rendered.get(name) != text:
+                rendered[name] = text
+                row[name].config(text=text)
+
+        if tracker is not None:
+            progress = 100 if record.status == 'done' else tracker.progress
+            size_text = tracker.get_progress_text()
+            speed_text = f"速度: {tracker.format_speed()}"
+            eta_text = f"剩余: {tracker.eta}"
+        else:
+            progress = 100 if record.status == 'done' else 0
+            size_text = "0B / 0B"
+            speed_text = "速度: 0B/s"
+            eta_text = "剩余: 计算中..."
+
+        if rendered.get('progress') != round(progress, 1):
+            rendered['progress'] = round(progress, 1)
+            # 更新进度条
+            row['progress_var'].set(progress)
+
+        # 更新任务、百分比、大小、速度和剩余时间标签
+        title = f"#{record.index:02d} {record.filename[:50]}..."
+        if record.status == 'failed':
+            title += " [失败]"
+        elif record.control is not None and record.control.is_paused:
+            title += " [已暂停]"
+        set_text('task_label', title)
+        set_text('percent_label', f"{progress:.1f}%")
+        set_text('size_label', size_text)
+        set_text('speed_label', speed_text)
+        set_text('eta_label', eta_text)
+
+        # 更新任务标签颜色
+        if record.status == 'failed':
+            color = COLORS['danger']
+        elif progress >= 100:
+            color = COLORS['success']
+        elif progress > 75:
+            color = COLORS['warning']
+        elif progress > 0:
+            color = COLORS['primary']
+        else:
+            color = COLORS['text']
+        if rendered.get('color') != color:
+            rendered['color'] = color
+            row['task_label'].config(fg=color)
+
+        # 已结束的任务不能再暂停或取消
+        finished = record.status in ('done', 'failed') or record.control is None
+        buttons_state = (tk.DISABLED if finished else tk.NORMAL,
+                         "继续" if record.control is not None and record.control.paused else "暂停")
+        if rendered.get('buttons') != buttons_state:
+            rendered['buttons'] = buttons_state
+            row['pause_button'].config(state=buttons_state[0], text=buttons_state[1])
+            row['cancel_button'].config(state=buttons_state[0])
+
+
+class LogPanel:
+    """日志面板：显示内存缓冲中最近的日志，可按级别过滤"""
+
+    REFRESH_MS = 500
+    LEVEL_FILTERS = {"全部": logging.DEBUG, "信息": logging.INFO, "警告": logging.WARNING, "错误": logging.ERROR}
+    LEVEL_COLORS = {logging.ERROR: COLORS['danger'], logging.WARNING: COLORS['warning']}
+
+    def __init__(self, parent, buffer):
+        self.buffer = buffer
+        self.formatter = ConsoleLogFormatter()
+        self.last_sequence = 0
+        self.line_count = 0
+
+        self.window = tk.Toplevel(parent)
+        self.window.title("日志")
+        self.window.geometry("800x450")
+        self.window.configure(bg=COLORS['bg_light'])
+
+        toolbar = tk.Frame(self.window, bg=COLORS['bg_light'])
+        toolbar.pack(fill=tk.X, padx=10, pady=(10, 5))
+        tk.Label(toolbar, text="级别:", font=("Microsoft YaHei", 10),
+                 fg=COLORS['text'], bg=COLORS['bg_light']).pack(side=tk.LEFT)
+        self.level_var = tk.StringVar(value="信息")
+        level_box = ttk.Combobox(toolbar, textvariable=self.level_var, values=list(self.LEVEL_FILTERS),
+                                 state="readonly", width=8)
+        level_box.pack(side=tk.LEFT, padx=(5, 0))
+        level_box.bind("<<ComboboxSelected>>", lambda e: self.reload())
+
+        self.text = scrolledtext.ScrolledText(self.window, font=("Consolas", 9), wrap=tk.WORD,
+                                              bg=COLORS['bg_light'], fg=COLORS['text'], state=tk.DISABLED)
+        self.text.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+
+        self.refresh()
+
+    def reload(self):
+        """级别变化后重新显示全部缓冲记录"""
+        self.text.config(state=tk.NORMAL)
+        self.text.delete("1.0", tk.END)
+        self.text.config(state=tk.DISABLED)
+        self.last_sequence = 0
+        self.line_count = 0
+        self.append_new()
+
+    def refresh(self):
+        """定时追加新日志，窗口关闭后停止"""
+        if not self.window.winfo_exists():
+            return
+        self.append_new()
+        self.window.after(self.REFRESH_MS, self.refresh)
+
+    def append_new(self):
+        items = self.buffer.since(self.last_sequence)
+        if not items:
+            return
+        self.last_sequence = items[-1][0]
+        min_level = self.LEVEL_FILTERS.get(self.level_var.get(), logging.INFO)
+
+        at_bottom = self.text.yview()[1] >= 0.999
+        self.text.config(state=tk.NORMAL)
+        for _, record in items:
+            if record.levelno < min_level:
+                continue
+            color = getattr(record, 'color', None)
+            if not (isinstance(color, str) and color.startswith('#')):
+                color = self.LEVEL_COLORS.get(record.levelno, COLORS['text'])
+            self.text.tag_configure(color, foreground=color)
+            self.text.insert(tk.END, self.formatter.format(record) + "\n", color)
+            self.line_count += 1
+
+        # 只保留缓冲容量内的行数
+        overflow = self.line_count - self.buffer.records.maxlen
+        if overflow > 0:
+            self.text.delete("1.0", f"{overflow + 1}.0")
+            self.line_count -= overflow
+        self.text.config(state=tk.DISABLED)
+        if at_bottom:
+            self.text.see(tk.END)
+
+
 class UpdateDialog:
     """更新弹窗"""
 
-    def __init__(self, parent, update_info, download_callback, skip_callback):
+    def __init__(self, parent, update_info, download_callback, skip_callback, ui_call=None):
         self.parent = parent
         self.update_info = update_info
         self.download_callback = download_callback
         self.skip_callback = skip_callback
+        # 下载线程通过 ui_call 在界面线程修改控件
+        self.ui_call = ui_call or (lambda func, *args, **kwargs: func(*args, **kwargs))
+        self.progress_pending = False
 
         self.downloaded_file = None
         self.is_downloading = False
@@ -486,37 +978,46 @@ class UpdateDialog:
             # 创建更新检查器实例
             update_checker = UpdateChecker(None)
 
-            # 下载回调函数
+            # 下载回调函数：上一次进度尚未显示时不再重复排队
             def progress_callback(tracker):
-                # 更新进度条
-                self.progress_var.set(tracker.progress)
-                self.progress_label.config(text=f"{tracker.get_progress_text()} - {tracker.format_speed()}")
-
-                # 更新UI
-                self.dialog.update_idletasks()
+                if not self.progress_pending:
+                    self.progress_pending = True
+                    self.ui_call(self.show_progress, tracker)
 
             # 开始下载
             filepath, success = update_checker.download_update(download_url, progress_callback)
 
             if success:
                 self.downloaded_file = filepath
-                self.progress_label.config(text="下载完成!", fg=COLORS['success'])
-                self.progress_var.set(100)
-
-                # 下载完成后显示安装按钮
-                self.download_button.config(state=tk.NORMAL,
-                                            text="立即安装",
-                                            command=self.prompt_installation,
-                                            bg=COLORS['success'])
+                self.ui_call(self.show_download_done)
             else:
                 raise Exception("下载失败")
 
         except Exception as e:
-            self.progress_label.config(text=f"下载失败: {str(e)}", fg=COLORS['danger'])
-            self.download_button.config(state=tk.NORMAL,
-                                        text="重试下载",
-                                        command=self.start_download)
-            self.is_downloading = False
+            self.ui_call(self.show_download_failed, e)
+
+    def show_progress(self, tracker):
+        """显示下载进度（界面线程）"""
+        self.progress_pending = False
+        self.progress_var.set(tracker.progress)
+        self.progress_label.config(text=f"{tracker.get_progress_text()} - {tracker.format_speed()}")
+
+    def show_download_done(self):
+        """下载完成后显示安装按钮（界面线程）"""
+        self.progress_label.config(text="下载完成!", fg=COLORS['success'])
+        self.progress_var.set(100)
+        self.download_button.config(state=tk.NORMAL,
+                                    text="立即安装",
+                                    command=self.prompt_installation,
+                                    bg=COLORS['success'])
+
+    def show_download_failed(self, error):
+        """显示下载失败并允许重试（界面线程）"""
+        self.progress_label.config(text=f"下载失败: {str(error)}", fg=COLORS['danger'])
+        self.download_button.config(state=tk.NORMAL,
+                                    text="重试下载",
+                                    command=self.start_download)
+        self.is_downloading = False
 
     def prompt_installation(self):
         """提示安装"""
@@ -553,6 +1054,8 @@ class UpdateDialog:
 
     def create_install_script(self, old_file, new_file):
         """创建安装脚本（用于替换旧版本）"""
+        import subprocess
+
         script_content = f"""
 @echo off
 echo 正在安装更新...
@@ -594,8 +1097,11 @@ del "%~f0" 2>nul
 
 
 class MusicDownloaderApp:
-    def __init__(self, root):
+    def __init__(self, root, startup_timer=None, daemon_url=None, daemon_token=None, track_cache=None,
+                 quality_policy=None, schedule_windows=()):
         self.root = root
+        self.startup_timer = startup_timer  # 启动耗时记录（--startup-report）
+        self.daemon_url = daemon_url  # 作为守护进程的瘦客户端运行时的地址
         self.root.title("无损音乐下载器 v3.2")
         # 调整窗口高度，移除底部状态栏
         self.root.geometry("950x982")
@@ -603,29 +1109,33 @@ class MusicDownloaderApp:
         # 设置窗口背景
         self.root.configure(bg=COLORS['bg_dark'])
 
-        # 存储会话信息的变量
-        self.sl_session = None
-        self.sl_jwt_session = None
         self.is_initialized = False
 
         # 存储搜索结果
         self.search_results = []
-        self.selected_songs = {}  # 改为字典，键为歌曲ID，值为歌曲信息，用于存储所有已选择的歌曲
+        self.search_live_ids = set()  # 当前页中来自在线来源（而非本地索引）的歌曲ID
+        self.duplicate_clusters = DuplicateClusterer()  # 当前关键词跨页的重复歌曲分组
+        self.selection = SongSelectionModel()  # 按歌曲ID维护所有已选择的歌曲（跨页）
 
-        # 添加用于存储每页歌曲ID的列表
+        # 当前页显示的歌曲（Treeview 的行ID即歌曲ID）
         self.current_page_songs = []  # 当前页显示的歌曲ID列表
+        self.current_page_index = {}  # 歌曲ID -> 歌曲信息
 
         # 下载状态
         self.is_downloading = False
-        self.download_queue = []
-        self.downloaded_count = 0
-        self.total_to_download = 0
 
-        # 下载进度跟踪器字典
-        self.progress_trackers = {}
+        # 下载任务数据模型（界面只为可见行创建控件）
+        self.task_model = DownloadTaskModel()
+
+        # 当前批次的暂停/取消控制
+        self.batch_control = TaskControl()
+
+        self.stream_stops = set()  # 正在产出歌曲的"下载全部"/歌单导入任务的停止标记
+        self.shown_totals = None
 
-        # 下载任务框架字典
-        self.download_frames = {}
+        # 下载进度共享表，由界面定时器按固定帧率渲染
+        self.progress_board = ProgressBoard()
+        self.progress_fps = PROGRESS_RENDER_FPS
 
         # 分页相关变量
         self.current_page = 1
@@ -633,23 +1143,80 @@ class MusicDownloaderApp:
         self.total_results = 0
         self.current_keywords = ""
 
-        # 创建会话对象
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36'
-        })
+        # 搜索代次：每次发起搜索递增，过期的搜索结果不再写入界面
+        self.search_generation = 0
+        self.search_lock = threading.Lock()
+        self.pending_search = None  # 等待执行的最新搜索 (关键词, 页码, 代次)
+        self.active_search_token = None  # 正在进行的搜索请求
+        self.shown_search = None  # 已显示出来的搜索 (请求, 页码)，晚到的来源结果只追加到这一页
+        self.late_search_results = []  # 本页显示之前到达的晚到结果 [(请求, 页码, 歌曲列表)]
+        self.search_worker_running = False
+        self.search_debounce_id = None
+
+        # 本地歌曲索引（记录所有出现过的搜索结果）
+        try:
+            self.song_index = SongIndex(SONG_INDEX_PATH)
+        except Exception as e:
+            self.song_index = None
+            self.log(f"本地歌曲索引不可用: {e}", level=logging.WARNING)
+
+        # 关注的歌手（定期同步新歌），首次用到时再打开，不拖慢启动
+        self.watch_list = None
+        self.watch_syncing = False
+        self.watch_check_id = None
+
+        # 站点客户端（会话在后台初始化，不阻塞主窗口显示）和常驻下载服务（下载过程中也可继续加入歌曲）；
+        # 连接守护进程时，搜索和下载都由守护进程执行
+        if daemon_url:
+            from flac_music_daemon import RemoteDownloadService, RemoteMusicClient
+
+            self.client = RemoteMusicClient(daemon_url, daemon_token, self.song_index, self.log)
+            self.download_service = RemoteDownloadService(self.client, prepare_job=self.prepare_download_job,
+                                                          on_start=self.on_downloads_started,
+                                                          on_idle=self.on_downloads_finished,
+                                                          on_state=self.on_remote_job_state,
+                                                          on_progress=self.on_remote_job_progress,
+                                                          on_finish=self.on_remote_job_finished)
+        else:
+            self.client = MusicClient(self.song_index, self.log)
+            self.client.track_cache = track_cache
+            self.download_service = DownloadService(self.run_download_job, DOWNLOAD_WORKERS,
+                                                    prepare_job=self.prepare_download_job,
+                                                    on_start=self.on_downloads_started,
+                                                    on_idle=self.on_downloads_finished)
+        # 批次的音质策略（只在本机下载时使用），剩余歌曲数按下载队列中尚未开始的任务计算
+        self.quality_policy = quality_policy if not daemon_url else None
+        if self.quality_policy is not None:
+            self.quality_policy.remaining = lambda: sum(self.download_service.totals()['pending'].values())
+        # 下载时段（只在本机下载时使用，连接守护进程时由守护进程按自己的时段下载）
+        self.scheduler = None
+        if schedule_windows and not daemon_url:
+            self.scheduler = DownloadScheduler(self.download_service, schedule_windows)
+            self.scheduler.start()
+        self.update_check_scheduled = False
+        self.log_panel = None
+
+        # 诊断模式（采样分析、内存快照、线程堆栈）
+        self.diagnostics = Diagnostics()
+
+        # 工作线程对界面的修改统一经由调度队列在界面线程执行；心跳监视界面延迟
+        self.ui_dispatcher = UiDispatcher(self.root)
+        self.lag_monitor = EventLoopMonitor(self.root, self.ui_dispatcher)
 
         # 创建样式
         self.create_styles()
 
         # 创建界面
         self.create_widgets()
+        self.mark_startup('widgets')
 
-        # 在后台初始化会话和检查更新
-        self.init_session_async()
+        # 启动界面调度队列、延迟监视和下载进度渲染定时器
+        self.ui_dispatcher.start()
+        self.lag_monitor.start()
+        self.render_download_progress()
 
-        # 启动更新检查（延迟2秒，等待主窗口显示）
-        self.root.after(2000, self.check_update_on_start)
+        # 在后台初始化会话，完成后空闲时再检查更新
+        self.init_session_async()
 
         # 绑定窗口大小变化事件
         self.root.bind('<Configure>', self.on_window_resize)
@@ -657,9 +1224,38 @@ class MusicDownloaderApp:
         # 更新检查器
         self.update_checker = UpdateChecker(self)
 
+        # 首次绘制：布局和控件绘制都在空闲回调中完成
+        self.root.after_idle(lambda: self.root.after_idle(lambda: self.mark_startup('first_paint')))
+
+    def ui_call(self, func, *args, **kwargs):
+        """在界面线程执行界面修改（工作线程中调用时放入调度队列）"""
+        self.ui_dispatcher.call(func, *args, **kwargs)
+
+    def mark_startup(self, phase):
+        """记录启动阶段耗时（仅在 --startup-report 时）"""
+        if self.startup_timer is not None:
+            self.startup_timer.mark(phase)
+
+    def report_startup(self):
+        """输出启动耗时报告（只输出一次）"""
+        timer = self.startup_timer
+        if timer is None or timer.reported:
+            return
+        timer.reported = True
+        report = timer.report()
+        print(report, flush=True)
+        self.log(report)
+
+    def schedule_update_check(self):
+        """会话初始化结束后，等界面空闲时再检查更新（只检查一次）"""
+        if self.update_check_scheduled:
+            return
+        self.update_check_scheduled = True
+        self.root.after_idle(self.check_update_on_start)
+
     def check_update_on_start(self):
         """启动时检查更新"""
-        thread = threading.Thread(target=self.perform_update_check)
+        thread = threading.Thread(target=self.perform_update_check, name="update-check")
         thread.daemon = True
         thread.start()
 
@@ -670,7 +1266,7 @@ class MusicDownloaderApp:
 
             if has_update:
                 # 在主线程中显示更新弹窗
-                self.root.after(0, lambda: self.show_update_dialog(update_info))
+                self.ui_call(self.show_update_dialog, update_info)
             else:
                 self.log("当前已是最新版本", "GREEN")
 
@@ -695,7 +1291,7 @@ class MusicDownloaderApp:
                 self.root.destroy()
 
         # 创建更新弹窗
-        self.update_dialog = UpdateDialog(self.root, update_info, download_callback, skip_callback)
+        self.update_dialog = UpdateDialog(self.root, update_info, download_callback, skip_callback, self.ui_call)
 
     def manual_check_update(self):
         """手动检查更新"""
@@ -714,17 +1310,17 @@ class MusicDownloaderApp:
 
             if has_update:
                 # 在主线程中显示更新弹窗
-                self.root.after(0, lambda: self.show_update_dialog(update_info))
-                self.root.after(0, lambda: self.status_label.config(text="✅ 发现新版本!", fg=COLORS['success']))
+                self.ui_call(self.show_update_dialog, update_info)
+                self.ui_call(self.status_label.config, text="✅ 发现新版本!", fg=COLORS['success'])
             else:
-                self.root.after(0, lambda: self.status_label.config(text="✅ 当前已是最新版本", fg=COLORS['success']))
-                self.root.after(0, lambda: messagebox.showinfo("检查更新", "当前已是最新版本!"))
+                self.ui_call(self.status_label.config, text="✅ 当前已是最新版本", fg=COLORS['success'])
+                self.ui_call(messagebox.showinfo, "检查更新", "当前已是最新版本!")
                 self.log("当前已是最新版本", "GREEN")
 
         except Exception as e:
-            self.root.after(0, lambda: self.status_label.config(text="❌ 更新检查失败", fg=COLORS['danger']))
+            self.ui_call(self.status_label.config, text="❌ 更新检查失败", fg=COLORS['danger'])
             self.log(f"手动检查更新失败: {str(e)}", "RED")
-            self.root.after(0, lambda: messagebox.showerror("检查更新失败", f"检查更新失败: {str(e)}"))
+            self.ui_call(messagebox.showerror, "检查更新失败", f"检查更新失败: {str(e)}")
 
     def create_styles(self):
         """创建自定义样式"""
@@ -805,6 +1401,26 @@ class MusicDownloaderApp:
                                                 pady=4)
         self.update_check_button.pack(side=tk.RIGHT, padx=(0, 5))
 
+        # 日志面板按钮
+        self.log_button = ModernButton(status_frame,
+                                       text="日志",
+                                       command=self.show_log_panel,
+                                       bg=COLORS['text_light'],
+                                       font=('Microsoft YaHei', 9),
+                                       padx=8,
+                                       pady=4)
+        self.log_button.pack(side=tk.RIGHT, padx=(0, 5))
+
+        # 诊断菜单按钮
+        self.diagnostics_button = ModernButton(status_frame,
+                                               text="诊断",
+                                               command=self.show_diagnostics_menu,
+                                               bg=COLORS['text_light'],
+                                               font=('Microsoft YaHei', 9),
+                                               padx=8,
+                                               pady=4)
+        self.diagnostics_button.pack(side=tk.RIGHT, padx=(0, 5))
+
         # 合并的搜索和保存设置区域
         combined_frame = tk.LabelFrame(main_frame,
                                        font=("Microsoft YaHei", 12, "bold"),
@@ -832,6 +1448,9 @@ class MusicDownloaderApp:
         # 添加默认搜索词
         self.keyword_entry.insert(0, "旅人")
 
+        # 边输入边搜索（防抖）
+        self.keyword_entry.bind('<KeyRelease>', self.on_keyword_changed)
+
         tk.Label(search_row_frame, text="结果数量:", font=("Microsoft YaHei", 9, "bold"),
                  bg=COLORS['bg_light'], fg=COLORS['text']).pack(side=tk.LEFT, padx=(15, 10))
         self.count_var = tk.StringVar(value="10")
@@ -858,7 +1477,17 @@ class MusicDownloaderApp:
         self.clear_button = ModernButton(button_frame, text="清空",
                                          command=self.clear_results, bg=COLORS['gray'],
                                          padx=10, pady=5)  # 减小按钮大小
-        self.clear_button.pack(side=tk.LEFT)
+        self.clear_button.pack(side=tk.LEFT, padx=(0, 5))
+
+        self.import_button = ModernButton(button_frame, text="导入歌单",
+                                          command=self.import_playlist, bg=COLORS['secondary'],
+                                          padx=10, pady=5)
+        self.import_button.pack(side=tk.LEFT, padx=(0, 5))
+
+        self.watch_button = ModernButton(button_frame, text="关注歌手",
+                                         command=self.show_watch_list, bg=COLORS['secondary'],
+                                         padx=10, pady=5)
+        self.watch_button.pack(side=tk.LEFT)
 
         # 保存位置设置行框架
         save_row_frame = tk.Frame(combined_frame, bg=COLORS['bg_light'])
@@ -868,7 +1497,10 @@ class MusicDownloaderApp:
                  font=("Microsoft YaHei", 9, "bold"),
                  bg=COLORS['bg_light'], fg=COLORS['text']).pack(side=tk.LEFT, padx=(0, 10))
 
-        self.download_dir = tk.StringVar(value=os.path.join(os.path.expanduser("~"), "MusicDownloads"))
+        self.download_dir = tk.StringVar(value=DEFAULT_DOWNLOAD_DIR)
+        # 工作线程读取的下载目录副本（Tk 变量只在界面线程读取）
+        self.download_dir_path = self.download_dir.get()
+        self.download_dir.trace_add('write', self.on_download_dir_changed)
         dir_entry = ModernEntry(save_row_frame, textvariable=self.download_dir, width=45)
         dir_entry.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
 
@@ -943,6 +1575,10 @@ class MusicDownloaderApp:
         self.result_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         tree_scroll.pack(side=tk.RIGHT, fill=tk.Y)
 
+        # 仅来自本地索引（尚未在线确认）的结果以浅色显示，重复版本以灰色显示
+        self.result_tree.tag_configure('local', foreground=COLORS['text_light'])
+        self.result_tree.tag_configure('duplicate', foreground=COLORS['gray'])
+
         # 为Treeview绑定单击事件，实现单独选择功能
         self.result_tree.bind("<ButtonRelease-1>", self.on_treeview_click)
 
@@ -1005,6 +1641,15 @@ class MusicDownloaderApp:
                                             padx=8, pady=4)  # 减小按钮大小
         self.download_button.pack(side=tk.RIGHT)
 
+        # 下载全部按钮（遍历当前关键词的所有页面）
+        self.download_all_button = ModernButton(pagination_frame, text="下载全部",
+                                                command=self.download_all_results,
+                                                state=tk.DISABLED,
+                                                bg=COLORS['success'],
+                                                font=('Microsoft YaHei', 9, 'bold'),
+                                                padx=8, pady=4)
+        self.download_all_button.pack(side=tk.RIGHT, padx=(0, 5))
+
         # 总结果数显示
         self.total_results_label = tk.Label(pagination_frame,
                                             text="共 0 条结果",
@@ -1024,10 +1669,30 @@ class MusicDownloaderApp:
                                             style="Custom.Horizontal.TProgressbar")
         self.progress_bar.pack(fill=tk.X, pady=(0, 5))
 
-        self.progress_label = tk.Label(progress_frame, text="等待下载...",
+        progress_info_frame = tk.Frame(progress_frame, bg=COLORS['bg_dark'])
+        progress_info_frame.pack(fill=tk.X)
+
+        # 整批下载的暂停/继续、取消按钮
+        self.cancel_all_button = ModernButton(progress_info_frame, text="取消全部",
+                                              command=self.cancel_all_downloads,
+                                              state=tk.DISABLED,
+                                              bg=COLORS['danger'],
+                                              font=('Microsoft YaHei', 9),
+                                              padx=8, pady=2)
+        self.cancel_all_button.pack(side=tk.RIGHT)
+
+        self.pause_all_button = ModernButton(progress_info_frame, text="暂停全部",
+                                             command=self.toggle_pause_all,
+                                             state=tk.DISABLED,
+                                             bg=COLORS['warning'],
+                                             font=('Microsoft YaHei', 9),
+                                             padx=8, pady=2)
+        self.pause_all_button.pack(side=tk.RIGHT, padx=(0, 5))
+
+        self.progress_label = tk.Label(progress_info_frame, text="等待下载...",
                                        font=("Microsoft YaHei", 9),
                                        fg=COLORS['text_light'], bg=COLORS['bg_dark'])
-        self.progress_label.pack()
+        self.progress_label.pack(side=tk.LEFT, expand=True)
 
         # 下载任务进度显示区域 - 增加高度，填充底部空间
         download_tasks_frame = tk.LabelFrame(main_frame, text="下载任务",
@@ -1038,30 +1703,8 @@ class MusicDownloaderApp:
         download_tasks_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 0))  # 没有底部边距，直接到底部
         download_tasks_frame.pack_propagate(False)
 
-        # 添加滚动区域用于显示多个下载任务
-        self.download_canvas = tk.Canvas(download_tasks_frame,
-                                         bg=COLORS['bg_light'],
-                                         highlightthickness=0)
-        scrollbar = ttk.Scrollbar(download_tasks_frame, orient="vertical",
-                                  command=self.download_canvas.yview,
-                                  style="Custom.Vertical.TScrollbar")
-        self.download_scrollable_frame = tk.Frame(self.download_canvas,
-                                                  bg=COLORS['bg_light'])
-
-        self.download_scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.download_canvas.configure(
-                scrollregion=self.download_canvas.bbox("all")
-            )
-        )
-
-        self.download_canvas.create_window((0, 0),
-                                           window=self.download_scrollable_frame,
-                                           anchor="nw")
-        self.download_canvas.configure(yscrollcommand=scrollbar.set)
-
-        self.download_canvas.pack(side="left", fill="both", expand=True, padx=(0, 5))
-        scrollbar.pack(side="right", fill="y")
+        # 虚拟化的任务列表，只为可见行创建控件
+        self.task_view = VirtualTaskList(download_tasks_frame, self.task_model)
 
     def on_window_resize(self, event):
         """处理窗口大小变化事件，动态调整输入框宽度"""
@@ -1079,140 +1722,53 @@ class MusicDownloaderApp:
                 self.entry_width = new_width
 
     def create_download_task_frame(self, filename, song_index):
-        """为每个下载任务创建进度显示框架"""
-        frame = tk.Frame(self.download_scrollable_frame,
-                         relief=tk.RIDGE,
-                         bd=1,
-                         padx=10,
-                         pady=8,
-                         bg=COLORS['bg_light'])
-        frame.pack(fill=tk.X, pady=3, padx=2)
-
-        # 任务信息标签
-        task_label = tk.Label(frame,
-                              text=f"#{song_index:02d} {filename[:50]}...",
-                              font=("Microsoft YaHei", 9, "bold"),
-                              anchor="w",
-                              bg=COLORS['bg_light'],
-                              fg=COLORS['text'])
-        task_label.pack(fill=tk.X)
-
-        # 进度条
-        progress_var = tk.DoubleVar()
-        progress_bar = ttk.Progressbar(frame,
-                                       variable=progress_var,
-                                       maximum=100,
-                                       length=970,
-                                       style="Custom.Horizontal.TProgressbar")
-        progress_bar.pack(fill=tk.X, pady=(5, 2))
-
-        # 进度信息框架
-        info_frame = tk.Frame(frame, bg=COLORS['bg_light'])
-        info_frame.pack(fill=tk.X)
-
-        # 进度百分比标签
-        percent_label = tk.Label(info_frame,
-                                 text="0%",
-                                 font=("Microsoft YaHei", 9, "bold"),
-                                 width=6,
-                                 anchor="w",
-                                 bg=COLORS['bg_light'],
-                                 fg=COLORS['primary'])
-        percent_label.pack(side=tk.LEFT, padx=(0, 15))
-
-        # 大小标签
-        size_label = tk.Label(info_frame,
-                              text="0B / 0B",
-                              font=("Microsoft YaHei", 9),
-                              width=25,
-                              anchor="w",
-                              bg=COLORS['bg_light'],
-                              fg=COLORS['text'])
-        size_label.pack(side=tk.LEFT, padx=(0, 15))
-
-        # 速度标签
-        speed_label = tk.Label(info_frame,
-                               text="速度: 0B/s",
-                               font=("Microsoft YaHei", 9),
-                               width=15,
-                               anchor="w",
-                               bg=COLORS['bg_light'],
-                               fg=COLORS['text'])
-        speed_label.pack(side=tk.LEFT, padx=(0, 15))
-
-        # 剩余时间标签
-        eta_label = tk.Label(info_frame,
-                             text="剩余: 计算中...",
-                             font=("Microsoft YaHei", 9),
-                             width=15,
-                             anchor="w",
-                             bg=COLORS['bg_light'],
-                             fg=COLORS['text'])
-        eta_label.pack(side=tk.LEFT)
-
-        # 存储控件引用
-        self.download_frames[filename] = {
-            'frame': frame,
-            'progress_var': progress_var,
-            'percent_label': percent_label,
-            'size_label': size_label,
-            'speed_label': speed_label,
-            'eta_label': eta_label,
-            'task_label': task_label
-        }
-
-        return frame
-
-    def update_download_task_progress(self, filename, progress_tracker):
-        """更新下载任务进度显示"""
-        if filename not in self.download_frames:
+        """登记下载任务（按任务序号区分，文件名仅用于显示），由渲染定时器在可见时创建显示"""
+        return self.task_model.add(song_index, song_index, TaskControl(self.batch_control), filename)
+
+    def update_download_task_progress(self, task_index, progress_tracker):
+        """登记下载任务进度变化，由渲染定时器统一刷新界面"""
+        record = self.task_model.get(task_index)
+        if record is not None:
+            record.tracker = progress_tracker
+            if record.status == 'waiting':
+                record.status = 'downloading'
+            self.progress_board.publish(task_index, progress_tracker)
+
+    def render_download_progress(self):
+        """按固定帧率渲染任务列表的变化（仅在主线程运行）"""
+        # 先处理任务增删，再刷新进度发生变化的可见行
+        self.task_view.refresh()
+        for task_index, _ in self.progress_board.take_dirty():
+            self.task_view.render_key(task_index)
+        self.render_download_totals()
+
+        self.root.after(max(1, int(1000 / self.progress_fps)), self.render_download_progress)
+
+    def render_download_totals(self):
+        """刷新下载总进度，任务随时加入时总数实时变化"""
+        totals = self.download_service.totals()
+        if totals['total'] == 0 or totals == self.shown_totals:
             return
-
-        frame_info = self.download_frames[filename]
-
-        # 在主线程中更新UI
-        def update_ui():
-            # 更新进度条
-            frame_info['progress_var'].set(progress_tracker.progress)
-
-            # 更新百分比标签
-            frame_info['percent_label'].config(text=f"{progress_tracker.progress:.1f}%")
-
-            # 更新大小标签
-            frame_info['size_label'].config(text=progress_tracker.get_progress_text())
-
-            # 更新速度标签
-            frame_info['speed_label'].config(text=f"速度: {progress_tracker.format_speed()}")
-
-            # 更新剩余时间标签
-            frame_info['eta_label'].config(text=f"剩余: {progress_tracker.eta}")
-
-            # 更新任务标签颜色
-            if progress_tracker.progress >= 100:
-                frame_info['task_label'].config(fg=COLORS['success'])
-            elif progress_tracker.progress > 75:
-                frame_info['task_label'].config(fg=COLORS['warning'])
-            elif progress_tracker.progress > 0:
-                frame_info['task_label'].config(fg=COLORS['primary'])
-            else:
-                frame_info['task_label'].config(fg=COLORS['text'])
-
-        # 使用线程安全的方式更新UI
-        self.root.after(0, update_ui)
-
-    def remove_download_task_frame(self, filename):
-        """移除下载任务框架"""
-        if filename in self.download_frames:
-            def remove():
-                self.download_frames[filename]['frame'].destroy()
-                del self.download_frames[filename]
-
-            self.root.after(0, remove)
+        self.shown_totals = totals
+
+        self.progress_var.set(totals['done'] / totals['total'] * 100)
+        pending = totals['pending']
+        text = (f"已完成 {totals['done']}/{totals['total']}，下载中 {totals['running']}，"
+                f"排队 {pending[LANE_INTERACTIVE] + pending[LANE_BULK]}")
+        if pending[LANE_BULK]:
+            text += f"（批量 {pending[LANE_BULK]}）"
+        if totals['paused']:
+            text += f"，暂停 {totals['paused']}"
+        self.progress_label.config(text=text, fg=COLORS['text_light'])
+
+    def remove_download_task_frame(self, task_index):
+        """移除下载任务"""
+        self.progress_board.discard(task_index)
+        self.task_model.remove(task_index)
 
     def clear_all_download_tasks(self):
         """清除所有下载任务显示"""
-        for filename in list(self.download_frames.keys()):
-            self.remove_download_task_frame(filename)
+        self.task_model.clear()
 
     def on_treeview_click(self, event):
         """处理Treeview的点击事件，实现单独选择功能"""
@@ -1222,130 +1778,142 @@ class MusicDownloaderApp:
             column = self.result_tree.identify_column(event.x)
             item = self.result_tree.identify_row(event.y)
 
-            # 如果是点击了第一列（选择列）
-            if column == "#1" and item:
-                values = list(self.result_tree.item(item, 'values'))
-                # 获取歌曲索引
-                index = int(values[1]) - 1  # 转换为0-based索引
-
-                # 检查索引是否在有效范围内
-                if 0 <= index < len(self.current_page_songs):
-                    song_id = self.current_page_songs[index]
+            # 如果是点击了第一列（选择列），行ID即歌曲ID
+            song = self.current_page_index.get(item)
+            if column == "#1" and song is not None:
+                # 切换选择状态
+                if item in self.selection:
+                    self.selection.deselect(item)
+                else:
+                    self.selection.select(song)
 
-                    # 切换选择状态
-                    if values[0] == "✓":
-                        values[0] = ""
-                        # 从已选择歌曲中移除
-                        if song_id in self.selected_songs:
-                            del self.selected_songs[song_id]
-                    else:
-                        values[0] = "✓"
-                        # 添加到已选择歌曲中
-                        if index < len(self.search_results):
-                            self.selected_songs[song_id] = self.search_results[index]
+                self.render_selection([item])
 
-                    self.result_tree.item(item, values=values)
+    def render_selection(self, song_ids):
+        """只刷新选择状态发生变化的行，并更新计数和全选复选框"""
+        for song_id in song_ids:
+            if self.result_tree.exists(song_id):
+                self.result_tree.set(song_id, "选择", "✓" if song_id in self.selection else "")
 
-                    # 更新全选复选框的状态
-                    self.update_select_all_checkbox()
+        # 更新全选复选框的状态
+        self.update_select_all_checkbox()
 
-                    # 更新已选择数量
-                    self.update_selected_count()
+        # 更新已选择数量
+        self.update_selected_count()
 
     def update_selected_count(self):
         """更新已选择歌曲数量"""
-        count = len(self.selected_songs)
+        count = len(self.selection)
         self.selected_count_label.config(text=f"已选择: {count} 首")
 
     def update_select_all_checkbox(self):
         """更新全选复选框的状态"""
-        all_items = self.result_tree.get_children()
-        if not all_items:
-            self.select_all_var.set(False)
-            return
-
-        # 检查是否所有项目都被选中
-        all_selected = True
-        for item in all_items:
-            values = self.result_tree.item(item, 'values')
-            if values and values[0] != "✓":
-                all_selected = False
-                break
+        all_selected = self.selection.is_page_all_selected(self.current_page)
 
         # 更新复选框状态（不触发command回调）
         self.select_all_cb.config(command=lambda: None)  # 临时禁用command
         self.select_all_var.set(all_selected)
         self.select_all_cb.config(command=self.toggle_select_all)  # 重新启用command
 
-    def log(self, message, color=None):
-        """添加日志信息到控制台，不显示在界面上"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-
-        # 确定颜色
-        if not color:
-            if "错误" in message or "失败" in message:
-                color = "RED"
-            elif "成功" in message or "完成" in message:
-                color = "GREEN"
-            elif "警告" in message:
-                color = "YELLOW"
-            else:
-                color = "WHITE"
+    def log(self, message, color=None, level=None, **fields):
+        """记录日志（不等待输出），参数同 log_message"""
+        log_message(message, color, level, **fields)
 
-        # 只打印到控制台，不显示在界面上
-        print(f"[{timestamp}] {message}")
+    def show_log_panel(self):
+        """打开日志面板（已打开时前置）"""
+        if self.log_panel is not None and self.log_panel.window.winfo_exists():
+            self.log_panel.window.lift()
+            return
+        self.log_panel = LogPanel(self.root, log_buffer)
+
+    def show_diagnostics_menu(self):
+        """弹出诊断菜单"""
+        menu = tk.Menu(self.root, tearoff=0)
+        menu.add_command(label="停止诊断并保存" if self.diagnostics.active else "开始诊断",
+                         command=self.toggle_diagnostics)
+        menu.add_command(label="转储线程堆栈", command=lambda: self.run_diagnostics_action(
+            self.diagnostics.dump_threads, "线程堆栈已保存"))
+        menu.add_command(label="内存快照", command=lambda: self.run_diagnostics_action(
+            self.diagnostics.snapshot_memory, "内存快照已保存"),
+                         state=tk.NORMAL if self.diagnostics.active else tk.DISABLED)
+        menu.add_command(label="界面延迟统计", command=self.log_ui_responsiveness)
+        menu.add_separator()
+        menu.add_command(label="打开诊断目录", command=self.open_diagnostics_dir)
+        button = self.diagnostics_button
+        menu.tk_popup(button.winfo_rootx(), button.winfo_rooty() + button.winfo_height())
+
+    def toggle_diagnostics(self):
+        """开启或关闭诊断模式"""
+        if self.diagnostics.active:
+            self.diagnostics_button.config(text="诊断")
+            self.run_diagnostics_action(self.diagnostics.stop, "诊断已停止，结果保存在")
+        else:
+            directory = self.diagnostics.start()
+            self.diagnostics_button.config(text="诊断中")
+            self.log(f"诊断已开启，输出目录: {directory}", COLORS['warning'])
+
+    def log_ui_responsiveness(self):
+        """记录界面延迟统计和调度队列统计"""
+        dispatcher = self.ui_dispatcher
+        self.log(self.lag_monitor.summary())
+        self.log(f"界面调度队列: 执行 {dispatcher.executed} 个回调，{dispatcher.batches} 批，"
+                 f"最大积压 {dispatcher.max_backlog} 个")
+
+    def run_diagnostics_action(self, action, message):
+        """在后台线程执行诊断操作（写快照可能较慢），完成后记录输出路径"""
+        def run():
+            try:
+                path = action()
+                if path:
+                    self.log(f"{message}: {path}")
+            except Exception as e:
+                self.log(f"诊断操作失败: {e}", level=logging.ERROR)
+
+        threading.Thread(target=run, name="diagnostics", daemon=True).start()
+
+    def open_diagnostics_dir(self):
+        """在文件管理器中打开诊断目录"""
+        os.makedirs(DIAGNOSTICS_DIR, exist_ok=True)
+        if sys.platform == 'win32':
+            os.startfile(DIAGNOSTICS_DIR)
+        else:
+            self.log(f"诊断目录: {DIAGNOSTICS_DIR}")
 
     def browse_directory(self):
-        """选择下载目录 - 优化版本，使用异步方式防止卡顿"""
+        """选择下载目录（对话框在界面线程中运行，期间界面照常刷新）"""
+        directory = filedialog.askdirectory(initialdir=self.download_dir.get())
+        if directory:
+            self.download_dir.set(directory)
+            self.log(f"下载目录已更改为: {directory}")
 
-        def async_browse():
-            directory = filedialog.askdirectory(initialdir=self.download_dir.get())
-            if directory:
-                # 在主线程中更新UI
-                self.root.after(0, lambda: self.download_dir.set(directory))
-                self.log(f"下载目录已更改为: {directory}")
-
-        # 启动新线程执行文件夹选择操作
-        thread = threading.Thread(target=async_browse)
-        thread.daemon = True
-        thread.start()
+    def on_download_dir_changed(self, *args):
+        """同步下载目录副本"""
+        self.download_dir_path = self.download_dir.get()
 
     def toggle_select_all(self):
         """全选/取消全选当前页"""
-        select_all = self.select_all_var.get()
-
-        for item in self.result_tree.get_children():
-            values = list(self.result_tree.item(item, 'values'))
-            index = int(values[1]) - 1  # 转换为0-based索引
-
-            # 检查索引是否在有效范围内
-            if 0 <= index < len(self.current_page_songs) and index < len(self.search_results):
-                song_id = self.current_page_songs[index]
-                song = self.search_results[index]
-
-                if select_all:
-                    values[0] = "✓"
-                    # 添加到已选择歌曲中
-                    self.selected_songs[song_id] = song
-                else:
-                    values[0] = ""
-                    # 从已选择歌曲中移除
-                    if song_id in self.selected_songs:
-                        del self.selected_songs[song_id]
+        if self.select_all_var.get():
+            # 全选时每组重复歌曲只自动选择首选版本
+            picked = self.duplicate_clusters.pick_for_selection(
+                self.search_results, self.selection.selected.keys())
+            changed = self.selection.set_many(picked, True)
+        else:
+            changed = self.selection.set_many(self.search_results, False)
 
-                self.result_tree.item(item, values=values)
-
-        # 更新已选择数量
-        self.update_selected_count()
+        # 只刷新状态变化的行
+        self.render_selection(changed)
 
     def clear_results(self):
         """清空搜索结果"""
         self.result_tree.delete(*self.result_tree.get_children())
         self.search_results = []
-        self.selected_songs = {}  # 清空已选择歌曲
+        self.duplicate_clusters = DuplicateClusterer()
+        self.selection.clear()  # 清空已选择歌曲
         self.current_page_songs = []  # 清空当前页歌曲ID列表
+        self.current_page_index = {}
         self.select_all_var.set(False)
         self.download_button.config(state=tk.DISABLED)
+        self.download_all_button.config(state=tk.DISABLED)
         self.selected_count_label.config(text="已选择: 0 首")
         self.log("已清空搜索结果")
 
@@ -1366,42 +1934,47 @@ class MusicDownloaderApp:
             else:
                 self.progress_label.config(text="下载完成!", fg=COLORS['success'])
 
-            self.root.update_idletasks()
-
     def init_session_async(self):
         """异步初始化会话"""
         self.log("开始初始化会话...")
         self.init_indicator.config(fg=COLORS['warning'])
-        thread = threading.Thread(target=self.init_session)
+        thread = threading.Thread(target=self.init_session, name="session-init")
         thread.daemon = True
         thread.start()
 
     def init_session(self):
         """初始化会话"""
         try:
-            self.sl_session, self.sl_jwt_session = self.get_jwt_data()
-
-            if self.sl_session and self.sl_jwt_session:
+            if self.client.init_session():
                 self.is_initialized = True
-                self.status_label.config(text="✅ 初始化成功!", fg=COLORS['success'])
-                self.init_indicator.config(fg=COLORS['success'])
-                self.search_button.config(state=tk.NORMAL)
+                self.mark_startup('search_ready')
+                self.ui_call(self.show_init_status, "✅ 初始化成功!", COLORS['success'], search_enabled=True)
                 self.log("会话初始化成功!")
+                self.ui_call(self.check_watch_list)
             else:
-                self.status_label.config(text="❌ 初始化失败!", fg=COLORS['danger'])
-                self.init_indicator.config(fg=COLORS['danger'])
-                self.log("会话初始化失败!")
+                self.ui_call(self.show_init_status, "❌ 初始化失败!", COLORS['danger'])
+                self.log("会话初始化失败!", level=logging.ERROR, phase='init')
         except Exception as e:
-            self.status_label.config(text=f"❌ 初始化出错: {str(e)[:50]}", fg=COLORS['danger'])
-            self.init_indicator.config(fg=COLORS['danger'])
+            self.ui_call(self.show_init_status, f"❌ 初始化出错: {str(e)[:50]}", COLORS['danger'])
             self.log(f"初始化出错: {str(e)}", COLORS['danger'])
             self.log(traceback.format_exc())
+        finally:
+            self.ui_call(self.report_startup)
+            self.ui_call(self.schedule_update_check)
+
+    def show_init_status(self, text, color, search_enabled=False):
+        """显示会话初始化结果"""
+        self.status_label.config(text=text, fg=color)
+        self.init_indicator.config(fg=color)
+        if search_enabled:
+            self.search_button.config(state=tk.NORMAL)
 
     def reinit_session(self):
         """重新初始化会话"""
         self.is_initialized = False
         self.search_button.config(state=tk.DISABLED)
         self.download_button.config(state=tk.DISABLED)
+        self.download_all_button.config(state=tk.DISABLED)
         self.status_label.config(text="正在重新初始化...", fg=COLORS['warning'])
         self.init_indicator.config(fg=COLORS['warning'])
         self.log("重新初始化...")
@@ -1409,7 +1982,7 @@ class MusicDownloaderApp:
 
     def search_music(self):
         """搜索音乐"""
-        if not self.is_initialized:
+        if not self.is_initialized and self.song_index is None:
             messagebox.showerror("错误", "未初始化，请先初始化!")
             return
 
@@ -1418,6 +1991,8 @@ class MusicDownloaderApp:
             messagebox.showwarning("警告", "请输入搜索关键词!")
             return
 
+        self.cancel_search_debounce()
+
         # 清空结果
         self.clear_results()
 
@@ -1425,75 +2000,243 @@ class MusicDownloaderApp:
         self.current_keywords = keywords
 
         # 异步搜索
-        thread = threading.Thread(target=self.do_search, args=(keywords,))
+        self.start_search(keywords)
+
+    def on_keyword_changed(self, event=None):
+        """关键词输入变化时，防抖后自动搜索"""
+        self.cancel_search_debounce()
+        self.search_debounce_id = self.root.after(SEARCH_DEBOUNCE_MS, self.search_as_you_type)
+
+    def cancel_search_debounce(self):
+        """取消尚未触发的防抖搜索"""
+        if self.search_debounce_id is not None:
+            self.root.after_cancel(self.search_debounce_id)
+            self.search_debounce_id = None
+
+    def search_as_you_type(self):
+        """防抖到期后执行的增量搜索，不弹出提示框"""
+        self.search_debounce_id = None
+        if not self.is_initialized and self.song_index is None:
+            return
+
+        keywords = self.keyword_entry.get().strip()
+        if not keywords or keywords == self.current_keywords:
+            return
+
+        self.clear_results()
+        self.current_keywords = keywords
+        self.start_search(keywords)
+
+    def start_search(self, keywords, page=1):
+        """发起新的搜索，取代所有尚未完成的旧搜索"""
+        count = int(self.count_var.get())
+        with self.search_lock:
+            self.search_generation += 1
+            self.pending_search = (keywords, page, count, self.search_generation)
+
+            # 中止正在进行的旧搜索
+            if self.active_search_token is not None:
+                self.active_search_token.cancel()
+
+            # 同一时间只有一个搜索线程，新请求只替换待执行的搜索，不会排队堆积
+            if self.search_worker_running:
+                return
+            self.search_worker_running = True
+
+        thread = threading.Thread(target=self.run_search_worker, name="search")
         thread.daemon = True
         thread.start()
 
-    def do_search(self, keywords, page=1):
-        """执行搜索"""
+    def run_search_worker(self):
+        """搜索线程：依次执行最新的待执行搜索，直到没有新的请求"""
+        while True:
+            with self.search_lock:
+                if self.pending_search is None:
+                    self.search_worker_running = False
+                    self.active_search_token = None
+                    return
+                keywords, page, count, generation = self.pending_search
+                self.pending_search = None
+                token = SearchCancelToken(generation)
+                self.active_search_token = token
+
+            self.do_search(keywords, page, token, count)
+
+    def is_search_current(self, token):
+        """判断搜索是否仍是最新的一次"""
+        return token is None or (not token.cancelled and token.generation == self.search_generation)
+
+    def do_search(self, keywords, page=1, token=None, count=10):
+        """执行搜索（搜索线程）：先显示本地索引中的匹配结果，在线结果到达后合并显示；
+        界面修改经由调度队列在界面线程执行"""
         try:
             self.log(f"开始搜索: {keywords} - 第 {page} 页")
-            count = int(self.count_var.get())
 
             # 显示搜索状态
-            self.status_label.config(text=f"正在搜索: {keywords} (第 {page} 页)", fg=COLORS['primary'])
-
-            # 使用已有的会话信息搜索
-            song_list, total_count = self.search_music_with_session(
-                keywords, self.sl_session, self.sl_jwt_session, page, count
-            )
-
-            # 存储搜索结果
-            self.search_results = song_list
-
-            # 清空当前页歌曲ID列表
-            self.current_page_songs = []
-
-            # 显示结果
-            for i, song in enumerate(song_list, 1):
-                song_id = song.get('id', '')
-                self.current_page_songs.append(song_id)  # 添加歌曲ID到当前页列表
-
-                # 检查歌曲是否已经在已选择列表中
-                is_selected = song_id in self.selected_songs
-
-                self.result_tree.insert("", tk.END, values=(
-                    "✓" if is_selected else "",  # 选择框
-                    i,  # 序号
-                    song.get('name', '未知'),
-                    song.get('artist', '未知'),
-                    song.get('album_name', '未知'),
-                    song.get('duration', '未知'),
-                    song.get('format', 'flac')
-                ))
-
-            # 更新分页信息
-            self.current_page = page
-            self.total_results = total_count
-
-            # 确保每页数量不为0，避免除零错误
-            if count > 0:
-                self.total_pages = max(1, math.ceil(total_count / count))
+            self.ui_call(self.status_label.config, text=f"正在搜索: {keywords} (第 {page} 页)", fg=COLORS['primary'])
+
+            # 本地索引即时结果（离线时也可用）
+            local_songs = []
+            if page == 1 and self.song_index is not None:
+                local_songs = self.song_index.search(keywords, limit=count)
+                if local_songs:
+                    self.ui_call(self.show_local_results, token, local_songs, page)
+
+            # 超过截止时间的来源结果晚到时追加到本页（回调可能在搜索线程中同步执行，不能阻塞，
+            # 本页还没显示时先由界面线程暂存）
+            def on_late(songs):
+                self.ui_call(self.append_search_results, token, page, songs)
+
+            if self.is_initialized:
+                # 使用已有的会话信息搜索（多个来源并行）
+                song_list, total_count = self.client.search_music_with_session(
+                    keywords, self.client.sl_session, self.client.sl_jwt_session, page, count, cancel_token=token,
+                    on_late=on_late
+                )
             else:
-                self.total_pages = 1
+                song_list, total_count = [], 0
 
-            # 更新分页UI
-            self.update_pagination_ui()
+            # 已被更新的搜索取代，丢弃结果
+            if not self.is_search_current(token):
+                self.log(f"丢弃过期的搜索结果: {keywords} - 第 {page} 页")
+                return
 
-            # 启用下载按钮
-            if song_list:
-                self.download_button.config(state=tk.NORMAL)
-                self.status_label.config(text=f"✅ 找到 {total_count} 首歌曲 (第 {page}/{self.total_pages} 页)",
-                                         fg=COLORS['success'])
-                self.log(f"搜索成功，找到 {total_count} 首歌曲", COLORS['success'])
-            else:
-                self.status_label.config(text="未找到相关歌曲", fg=COLORS['warning'])
-                self.log("未找到相关歌曲", COLORS['warning'])
+            # 合并在线结果与本地结果（在线结果优先）
+            live_ids = {song.id for song in song_list}
+            merged_list = song_list + [song for song in local_songs if song.id not in live_ids]
+            self.ui_call(self.finish_search, token, page, count, song_list, merged_list, live_ids, total_count)
 
+        except SearchCancelled:
+            self.log(f"已取消过期的搜索: {keywords} - 第 {page} 页")
         except Exception as e:
-            self.status_label.config(text="❌ 搜索失败", fg=COLORS['danger'])
+            if not self.is_search_current(token):
+                return
             self.log(f"搜索出错: {str(e)}", COLORS['danger'])
-            messagebox.showerror("错误", f"搜索失败: {str(e)}")
+            self.ui_call(self.show_search_error, token, e)
+
+    def show_local_results(self, token, local_songs, page):
+        """显示本地索引的即时结果（界面线程）"""
+        if self.is_search_current(token):
+            self.show_search_results(local_songs, set(), page)
+
+    def append_search_results(self, token, page, songs):
+        """把晚到来源的结果追加到当前页，本页还没显示时先暂存（界面线程）"""
+        if not self.is_search_current(token):
+            return
+        if self.shown_search != (token, page):
+            self.late_search_results.append((token, page, songs))
+            return
+        songs = [song for song in songs if song.id not in self.current_page_index]
+        if not songs:
+            return
+        self.search_live_ids |= {song.id for song in songs}
+        self.show_search_results(self.search_results + songs, self.search_live_ids, page)
+        self.log(f"其他来源追加 {len(songs)} 首结果")
+
+    def finish_search(self, token, page, count, song_list, merged_list, live_ids, total_count):
+        """显示合并后的搜索结果并更新分页（界面线程）"""
+        # 结果排队期间又发起了新的搜索
+        if not self.is_search_current(token):
+            return
+
+        self.show_search_results(merged_list, live_ids, page)
+        self.shown_search = (token, page)
+
+        # 追加本页显示之前就已到达的晚到结果
+        late, self.late_search_results = self.late_search_results, []
+        for late_token, late_page, songs in late:
+            if (late_token, late_page) == self.shown_search:
+                self.append_search_results(late_token, late_page, songs)
+
+        # 更新分页信息
+        self.current_page = page
+        self.total_results = max(total_count, len(merged_list))
+
+        # 确保每页数量不为0，避免除零错误
+        if count > 0:
+            self.total_pages = max(1, math.ceil(self.total_results / count))
+        else:
+            self.total_pages = 1
+
+        # 更新分页UI
+        self.update_pagination_ui()
+
+        # 启用下载按钮
+        if song_list:
+            self.download_button.config(state=tk.NORMAL)
+            self.download_all_button.config(state=tk.NORMAL)
+            self.status_label.config(text=f"✅ 找到 {total_count} 首歌曲 (第 {page}/{self.total_pages} 页)",
+                                     fg=COLORS['success'])
+            self.log(f"搜索成功，找到 {total_count} 首歌曲", COLORS['success'])
+        elif merged_list:
+            if self.is_initialized:
+                self.download_button.config(state=tk.NORMAL)
+            self.status_label.config(text=f"⚠ 在线搜索无结果，显示本地索引中的 {len(merged_list)} 首歌曲",
+                                     fg=COLORS['warning'])
+            self.log(f"在线搜索无结果，本地索引找到 {len(merged_list)} 首歌曲", COLORS['warning'])
+        else:
+            self.status_label.config(text="未找到相关歌曲", fg=COLORS['warning'])
+            self.log("未找到相关歌曲", COLORS['warning'])
+
+    def show_search_error(self, token, error):
+        """显示搜索失败（界面线程）"""
+        if not self.is_search_current(token):
+            return
+        self.status_label.config(text="❌ 搜索失败", fg=COLORS['danger'])
+        messagebox.showerror("错误", f"搜索失败: {str(error)}")
+
+    def show_search_results(self, song_list, live_ids, page):
+        """在结果列表中显示一页歌曲，仅存在于本地索引的歌曲和重复版本以灰色显示"""
+        self.result_tree.delete(*self.result_tree.get_children())
+
+        # 跨页归并重复歌曲
+        self.duplicate_clusters.add_songs(song_list)
+
+        # 存储搜索结果
+        self.search_results = song_list
+        self.search_live_ids = set(live_ids)
+        self.current_page = page
+
+        # 清空当前页歌曲ID列表
+        self.current_page_songs = []
+        self.current_page_index = {}
+
+        # 显示结果，行ID使用歌曲ID，选择状态与页面位置无关
+        for i, song in enumerate(song_list, 1):
+            song_id = song.id
+            if not song_id or song_id in self.current_page_index:
+                continue
+            self.current_page_songs.append(song_id)  # 添加歌曲ID到当前页列表
+            self.current_page_index[song_id] = song
+
+            # 检查歌曲是否已经在已选择列表中
+            is_selected = song_id in self.selection
+
+            self.result_tree.insert("", tk.END, iid=song_id, values=(
+                "✓" if is_selected else "",  # 选择框
+                i,  # 序号
+                song.name,
+                song.artist,
+                song.album_name,
+                song.duration or '未知',
+                song.format
+            ), tags=self.result_row_tags(song_id, live_ids))
+
+        # 登记本页歌曲，非首选的重复版本不参与全选判断
+        self.selection.register_page(
+            page, self.current_page_songs,
+            [song_id for song_id in self.current_page_songs if self.duplicate_clusters.is_preferred(song_id)])
+        self.update_select_all_checkbox()
+        self.update_selected_count()
+
+    def result_row_tags(self, song_id, live_ids):
+        """结果行的显示标签"""
+        tags = []
+        if song_id not in live_ids:
+            tags.append('local')
+        if not self.duplicate_clusters.is_preferred(song_id):
+            tags.append('duplicate')
+        return tuple(tags)
 
     def update_pagination_ui(self):
         """更新分页UI状态"""
@@ -1544,23 +2287,19 @@ class MusicDownloaderApp:
         self.result_tree.delete(*self.result_tree.get_children())
         self.search_results = []
         self.current_page_songs = []  # 清空当前页歌曲ID列表
+        self.current_page_index = {}
         self.select_all_var.set(False)
         self.download_button.config(state=tk.DISABLED)
-        self.selected_count_label.config(text="已选择: 0 首")
+        self.download_all_button.config(state=tk.DISABLED)
+        self.update_selected_count()  # 已选择的歌曲跨页保留
 
         # 异步加载页面
-        thread = threading.Thread(target=self.do_search, args=(self.current_keywords, page))
-        thread.daemon = True
-        thread.start()
+        self.start_search(self.current_keywords, page)
 
     def download_selected_music(self):
-        """下载选中的音乐"""
-        if self.is_downloading:
-            messagebox.showwarning("警告", "当前正在下载中，请稍候...")
-            return
-
-        # 获取选中的歌曲（从self.selected_songs字典中获取）
-        selected_items = list(self.selected_songs.values())
+        """下载选中的音乐（下载过程中也可继续加入）"""
+        # 获取选中的歌曲（跨页）
+        selected_items = self.selection.songs()
 
         if not selected_items:
             messagebox.showwarning("警告", "请先选择要下载的歌曲!")
@@ -1570,509 +2309,476 @@ class MusicDownloaderApp:
         if not messagebox.askyesno("确认下载", f"确定要下载选中的 {len(selected_items)} 首歌曲吗？"):
             return
 
-        # 异步下载
-        thread = threading.Thread(target=self.do_download_batch, args=(selected_items,))
-        thread.daemon = True
-        thread.start()
-
-    def do_download_batch(self, songs_to_download):
-        """批量下载歌曲"""
         try:
-            self.is_downloading = True
-            self.downloaded_count = 0
-            self.total_to_download = len(songs_to_download)
-
-            # 禁用按钮
-            self.root.after(0, lambda: self.download_button.config(state=tk.DISABLED))
-            self.root.after(0, lambda: self.search_button.config(state=tk.DISABLED))
+            jobs = self.enqueue_downloads(selected_items)
+        except Exception as e:
+            self.log(f"❌ 加入下载队列出错: {str(e)}", COLORS['danger'])
+            messagebox.showerror("错误", f"下载失败: {str(e)}")
+            return
 
-            # 清除之前的下载任务显示
-            self.clear_all_download_tasks()
+        skipped = len(selected_items) - len(jobs)
+        self.log(f"加入下载队列 {len(jobs)} 首歌曲" + (f"，{skipped} 首已在队列中" if skipped else ""))
 
-            # 创建下载目录
-            download_dir = self.download_dir.get()
+    def enqueue_downloads(self, songs, remove_when_done=False, lane=LANE_INTERACTIVE):
+        """将歌曲加入下载服务的指定优先级通道，返回实际加入的任务"""
+        download_dir = self.download_dir_path
+        if not self.daemon_url:
             os.makedirs(download_dir, exist_ok=True)
+        return self.download_service.submit(songs, download_dir, remove_when_done, lane)
+
+    def prepare_download_job(self, job):
+        """任务入队前登记到任务列表，等待中的任务也可以单独暂停或取消"""
+        job.record = self.create_download_task_frame(self.client.song_filename(job.song), job.index)
+        job.control = job.record.control
+
+    def run_download_job(self, job):
+        """下载服务工作线程执行一项任务"""
+        def throttle(nbytes):
+            self.download_service.throttle(job, nbytes)
+
+        return self.download_single_song(job.song, job.index, job.download_dir, job.remove_when_done, job.record,
+                                         throttle)
+
+    def on_remote_job_state(self, job, state):
+        """守护进程中的任务状态变化（等待/下载中/暂停）"""
+        self.task_model.set_status(job.record.key, state)
+
+    def on_remote_job_progress(self, job, tracker):
+        """守护进程中的任务进度"""
+        self.update_download_task_progress(job.record.key, tracker)
+
+    def on_remote_job_finished(self, job, status, data):
+        """守护进程中的任务结束：done / failed / cancelled"""
+        key = job.record.key
+        filename = job.record.filename
+        if status == 'done':
+            self.log(f"✅ 下载完成: {filename}", COLORS['success'], task_id=job.index, song_id=job.song.id,
+                     phase='download', bytes=data.get('bytes'))
+            self.task_model.set_status(key, 'done')
+            if job.remove_when_done:
+                self.remove_download_task_frame(key)
+        elif status == 'failed':
+            self.task_model.set_status(key, 'failed')
+            self.log(f"❌ 下载失败 {filename}: {data.get('error', '')}", COLORS['danger'], task_id=job.index,
+                     song_id=job.song.id, phase='download')
+        else:
+            self.log(f"已取消: {filename}", task_id=job.index, song_id=job.song.id, phase='download')
+            self.remove_download_task_frame(key)
 
-            self.log(f"开始批量下载，共 {len(songs_to_download)} 首歌曲")
-            self.log(f"保存目录: {download_dir}")
-
-            # 重置进度条
-            self.progress_var.set(0)
-            self.progress_label.config(text="开始下载...", fg=COLORS['text_light'])
-
-            # 下载每首歌曲
-            for i, song in enumerate(songs_to_download, 1):
-                try:
-                    self.update_progress(i - 1, self.total_to_download,
-                                         f"正在下载第 {i} 首:")
-
-                    song_id = song.get('id')
-                    song_name = song.get('name', '未知歌曲')
-                    artist = song.get('artist', '未知歌手')
-                    format_type = song.get('format', 'flac')
-                    # 获取歌曲的sign值和time值
-                    song_sign = song.get('sign', '')
-                    song_time = song.get('time', '')
-
-                    self.log(f"正在下载: {song_name} - {artist} (sign: {song_sign[:20]}..., time: {song_time})")
-
-                    # 获取下载链接 - 传入sign值和time值
-                    song_url, _ = self.get_music_download_url_with_session(
-                        song_id, self.sl_session, self.sl_jwt_session, song_sign, song_time
-                    )
-
-                    # 生成文件名：歌曲名-艺术家.格式
-                    filename = f"{song_name} - {artist}.{format_type}"
-                    # 清理文件名中的非法字符
-                    filename = self.clean_filename(filename)
-
-                    # 为当前任务创建进度显示框架
-                    self.create_download_task_frame(filename, i)
-
-                    # 下载文件
-                    success = self.download_file(song_url, download_dir, filename, i)
-
-                    if success:
-                        self.downloaded_count += 1
-                        self.log(f"✅ 下载完成: {filename}", COLORS['success'])
-                        # 下载完成后更新任务状态
-                        if filename in self.progress_trackers:
-                            tracker = self.progress_trackers[filename]
-                            tracker.progress = 100
-                            self.update_download_task_progress(filename, tracker)
-                    else:
-                        self.log(f"❌ 下载失败: {filename}", COLORS['danger'])
-
-                except Exception as e:
-                    self.log(f"❌ 下载失败 {song_name}: {str(e)}", COLORS['danger'])
-                    continue
-
-            # 更新进度条完成
-            self.update_progress(self.total_to_download, self.total_to_download,
-                                 "下载完成")
-
-            # 显示完成消息
-            messagebox.showinfo("完成",
-                                f"下载完成!\n成功: {self.downloaded_count}/{self.total_to_download}")
-
-        except Exception as e:
-            self.log(f"❌ 批量下载出错: {str(e)}", COLORS['danger'])
-            messagebox.showerror("错误", f"下载失败: {str(e)}")
-        finally:
-            self.is_downloading = False
-            # 重新启用按钮
-            self.root.after(0, lambda: self.download_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.search_button.config(state=tk.NORMAL))
-
-    def clean_filename(self, filename):
-        """清理文件名中的非法字符"""
-        # 替换Windows文件名中不允许的字符
-        illegal_chars = r'[<>:"/\\|?*]'
-        filename = re.sub(illegal_chars, '_', filename)
+    def on_downloads_started(self):
+        """下载服务从空闲进入新一轮下载"""
+        self.is_downloading = True
+        self.batch_control = TaskControl()
+        if self.quality_policy is not None:
+            self.quality_policy.begin()
 
-        # 移除开头和结尾的空格和点
-        filename = filename.strip('. ')
+        # 清除上一轮的下载任务显示
+        self.clear_all_download_tasks()
+        self.progress_board.reset_stats()
+        self.shown_totals = None
 
-        # 如果文件名太长，截断
-        if len(filename) > 200:
-            name, ext = os.path.splitext(filename)
-            filename = name[:200 - len(ext)] + ext
+        target = f"守护进程 {self.daemon_url}" if self.daemon_url else self.download_dir_path
+        self.log(f"开始下载，保存目录: {target}")
+        self.set_batch_controls_active(True)
 
-        return filename
+    def on_downloads_finished(self, totals):
+        """下载服务中的全部任务结束"""
+        self.is_downloading = False
+        self.set_batch_controls_active(False)
+
+        self.log(self.progress_board.stats_text())
+        self.log(self.lane_wait_text())
+
+        # 在界面线程更新进度并显示完成消息，不占用下载工作线程
+        def show_done():
+            self.update_progress(totals['total'], totals['total'], "下载完成")
+            messagebox.showinfo("完成", f"下载完成!\n成功: {totals['succeeded']}/{totals['total']}")
+
+        self.ui_call(show_done)
+
+    def lane_wait_text(self):
+        """各优先级通道的排队等待统计"""
+        parts = []
+        for lane, summary in self.download_service.wait_summary().items():
+            if summary['count']:
+                parts.append(f"{LANE_NAMES[lane]} {summary['count']} 首，平均 {summary['avg']:.1f}s，"
+                             f"p95 {summary['p95']:.1f}s，最长 {summary['max']:.1f}s")
+        return "排队等待: " + ("；".join(parts) if parts else "无")
+
+    def set_batch_controls_active(self, active):
+        """下载进行中才能暂停或取消整批"""
+        state = tk.NORMAL if active else tk.DISABLED
+
+        def apply():
+            self.pause_all_button.config(state=state, text="暂停全部")
+            self.cancel_all_button.config(state=state)
+
+        self.ui_call(apply)
+
+    def toggle_pause_all(self):
+        """暂停或继续整批下载"""
+        if self.batch_control.paused:
+            self.batch_control.resume()
+            self.pause_all_button.config(text="暂停全部")
+            self.log("继续全部下载")
+        else:
+            self.batch_control.pause()
+            self.pause_all_button.config(text="继续全部")
+            self.log("已暂停全部下载")
 
-    def download_file(self, url, save_dir, filename, task_index):
-        """下载文件并保存，显示进度信息"""
+    def cancel_all_downloads(self):
+        """取消全部下载任务，之后加入的任务不受影响"""
+        if not messagebox.askyesno("取消下载", "确定要取消全部下载任务吗？"):
+            return
+        self.batch_control.cancel()
+        self.batch_control = TaskControl()
+        self.pause_all_button.config(text="暂停全部")
+
+        # 停止仍在产出歌曲的任务，排队和暂停中的任务直接移除
+        for stop_event in list(self.stream_stops):
+            stop_event.set()
+        for job in self.download_service.discard_cancelled():
+            self.client.remove_partial_file(job.record.resume_state and job.record.resume_state['part_path'])
+        self.task_model.clear()
+        self.log("正在取消全部下载...")
+
+    def download_single_song(self, song, task_index, download_dir, remove_when_done=False, record=None,
+                             throttle=None):
+        """下载单首歌曲，返回是否成功；任务被暂停时返回 None"""
+        song_id = song.id
+        filename = self.client.song_filename(song)
         try:
-            filepath = os.path.join(save_dir, filename)
-
-            # 如果文件已存在，添加序号
-            counter = 1
-            original_filepath = filepath
-            base_name, ext = os.path.splitext(filename)
-            while os.path.exists(filepath):
-                filepath = os.path.join(save_dir, f"{base_name}_{counter}{ext}")
-                counter += 1
+            # 为当前任务登记显示和控制
+            if record is None:
+                record = self.create_download_task_frame(filename, task_index)
+            control = record.control
+
+            # 等待中就被取消的任务直接跳过，已暂停的任务先搁置
+            control.check()
+            if control.is_paused:
+                raise DownloadPaused(record.resume_state)
+
+            self.log(f"正在下载: {song.display_name()}", level=logging.INFO, task_id=task_index, song_id=song_id,
+                     phase='download')
+            started = time.monotonic()
+
+            # 曲目缓存、来源回退、音质档位和断点续传都由客户端处理，这里只更新任务显示
+            self.task_model.set_status(task_index, 'downloading')
+            path = self.client.download_song(
+                song, download_dir, filename, task_index, control, record.resume_state, throttle,
+                functools.partial(self.update_download_task_progress, task_index), self.quality_policy)
+            record.resume_state = None
+            record.filename = filename = os.path.basename(path)
+
+            self.log(f"✅ 下载完成: {filename}", COLORS['success'], task_id=task_index, song_id=song_id,
+                     phase='download', bytes=record.tracker.downloaded if record.tracker else None,
+                     duration=round(time.monotonic() - started, 3))
+            # 下载完成后更新任务状态
+            self.task_model.set_status(task_index, 'done')
+            # 流式下载时及时移除已完成的任务，任务列表不随结果数增长
+            if remove_when_done:
+                self.remove_download_task_frame(task_index)
+            return True
 
-            # 下载文件
-            response = self.session.get(url, stream=True, verify=False, timeout=30)
-            response.raise_for_status()
+        except DownloadPaused as e:
+            # 暂停的任务让出位置，继续后从断点下载
+            record.resume_state = e.resume_state
+            self.task_model.set_status(task_index, 'paused')
+            return None
+        except DownloadCancelled:
+            # 取消的任务立即从列表移除，暂停时留下的断点文件一并删除
+            self.log(f"已取消: {filename}", task_id=task_index, song_id=song_id, phase='download')
+            self.remove_download_task_frame(task_index)
+            if record is not None and record.resume_state:
+                self.client.remove_partial_file(record.resume_state['part_path'])
+                record.resume_state = None
+            return False
+        except Exception as e:
+            self.task_model.set_status(task_index, 'failed')
+            self.log(f"❌ 下载失败 {song.name}: {str(e)}", COLORS['danger'], task_id=task_index, song_id=song_id,
+                     phase='download')
+            return False
 
-            # 获取文件大小
-            total_size = int(response.headers.get('content-length', 0))
+    def download_all_results(self):
+        """下载当前关键词的全部搜索结果（所有页面）"""
+        if not self.is_initialized:
+            messagebox.showerror("错误", "未初始化，请先初始化!")
+            return
 
-            # 创建进度跟踪器
-            tracker = DownloadProgressTracker(filename, total_size)
-            self.progress_trackers[filename] = tracker
+        keywords = self.current_keywords
+        if not keywords:
+            messagebox.showwarning("警告", "请先搜索歌曲!")
+            return
 
-            # 打开文件进行写入
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        # 更新进度
-                        tracker.update(len(chunk))
-                        # 更新UI显示
-                        self.update_download_task_progress(filename, tracker)
+        if not messagebox.askyesno("确认下载",
+                                   f"确定要下载“{keywords}”的全部 {self.total_results} 条结果吗？"):
+            return
 
-            # 下载完成后移除进度跟踪器
-            if filename in self.progress_trackers:
-                del self.progress_trackers[filename]
+        thread = threading.Thread(target=self.do_download_all, args=(keywords,), name="download-all")
+        thread.daemon = True
+        thread.start()
 
-            return True
+    def do_download_all(self, keywords):
+        """流式下载全部结果：边翻页边加入下载服务，第一页到达后即开始下载"""
+        self.run_download_stream(f"下载全部结果: {keywords}", self.enumerate_all_pages, (keywords,))
 
+    def run_download_stream(self, description, producer, producer_args):
+        """流式加入下载：producer 逐首产出歌曲，加入常驻下载服务"""
+        stop_event = threading.Event()
+        self.stream_stops.add(stop_event)
+        # 产出期间即使队列暂时为空也不算下载结束
+        self.download_service.hold()
+        try:
+            self.log(f"开始{description}")
+            producer(*producer_args, stop_event)
+            if stop_event.is_set():
+                self.log(f"已取消{description}")
         except Exception as e:
-            # 如果下载失败，更新任务状态为失败
-            if filename in self.download_frames:
-                frame_info = self.download_frames[filename]
-
-                def mark_failed():
-                    frame_info['task_label'].config(fg=COLORS['danger'],
-                                                    text=f"#{task_index:02d} {filename[:50]}... [失败]")
+            self.log(f"❌ {description}出错: {str(e)}", COLORS['danger'])
+        finally:
+            self.stream_stops.discard(stop_event)
+            self.download_service.release()
+
+    def stream_put(self, song, stop_event):
+        """向下载服务加入一首歌，排队任务过多时等待，取消后放弃"""
+        if not self.download_service.wait_for_room(DOWNLOAD_ALL_QUEUE_SIZE, stop_event):
+            return False
+        self.enqueue_downloads([song], remove_when_done=True, lane=LANE_BULK)
+        return True
+
+    def enumerate_all_pages(self, keywords, stop_event):
+        """并发获取所有页面，并将去重后的歌曲逐首加入下载服务"""
+        # 只保存歌曲ID和去重键用于去重，不保存歌曲信息
+        seen_ids = set()
+        seen_keys = set()
+        clusterer = DuplicateClusterer()
+
+        def put_songs(song_list):
+            for song in song_list:
+                song_id = song.id
+                if not song_id or song_id in seen_ids:
+                    continue
+                seen_ids.add(song_id)
 
-                self.root.after(0, mark_failed)
-            raise Exception(f"文件下载失败: {str(e)}")
+                # 同一录音的其他版本（歌名/歌手/时长相近）只下载第一次出现的
+                key = clusterer.compute_key(song)
+                if any(candidate in seen_keys for candidate in clusterer.candidate_keys(key)):
+                    continue
+                seen_keys.add(key)
+                if not self.stream_put(song, stop_event):
+                    return
 
-    # 以下是网络请求函数（保持不变）
-    def get_sl_session(self):
-        """获取sl_session"""
-        try:
-            response = self.session.get('https://flac.music.hi.cn/', verify=False, timeout=10)
-            sl_session_cookie = response.cookies.get('sl-session')
-            print(sl_session_cookie)
-            return sl_session_cookie
-        except Exception as e:
-            self.log(f"获取sl_session失败: {e}")
-            return None
+        def fetch_page(page):
+            song_list, _ = self.client.search_music_with_session(
+                keywords, self.client.sl_session, self.client.sl_jwt_session, page, DOWNLOAD_ALL_PAGE_SIZE
+            )
+            return song_list
 
-    def get_clientId(self):
-        """获取客户端ID"""
         try:
-            url = "https://flac.music.hi.cn/"
-            response = self.session.get(url, verify=False, timeout=30)
-            text = response.text
-            pattern = r'SafeLineChallenge\("([^"]+)"'
-            match = re.search(pattern, text)
-            print(match.group(1))
-            return match.group(1) if match else None
-        except Exception as e:
-            self.log(f"获取clientId失败: {e}")
-            return None
+            # 先获取第一页以得到总页数，并让下载立即开始
+            song_list, total_count = self.client.search_music_with_session(
+                keywords, self.client.sl_session, self.client.sl_jwt_session, 1, DOWNLOAD_ALL_PAGE_SIZE
+            )
+            total_pages = max(1, math.ceil(total_count / DOWNLOAD_ALL_PAGE_SIZE))
+            self.log(f"共 {total_count} 条结果，{total_pages} 页")
+            put_songs(song_list)
 
-    def get_issueId(self):
-        """获取issueId"""
-        try:
-            clientId = self.get_clientId()
-            if not clientId:
-                self.log("ERROR: clientId 获取失败")
-                return None, None
-
-            # self.log(f"DEBUG: 获取到的 clientId: {clientId}")
-
-            url = "https://challenge.rivers.chaitin.cn/challenge/v2/api/issue"
-            payload = json.dumps({"client_id": clientId, "level": 1})
-
-            # self.log(f"DEBUG: 请求URL: {url}")
-            # self.log(f"DEBUG: 请求payload: {payload}")
-
-            # 添加更完整的请求头
-            headers = {
-                'Host': 'challenge.rivers.chaitin.cn',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36',
-                'Content-Type': 'application/json',
-                'Accept': '*/*',
-                'Accept-Language': 'zh-CN,zh;q=0.9',
-                'sec-ch-ua-platform': '"Windows"',
-                'sec-ch-ua': '"Chromium";v="142", "Google Chrome";v="142", "Not_A Brand";v="99"',
-                'sec-ch-ua-mobile': '?0',
-                'Origin': 'https://flac.music.hi.cn',
-                'Sec-Fetch-Site': 'cross-site',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Dest': 'empty',
-                'Referer': 'https://flac.music.hi.cn/'
-            }
-
-            max_retries = 3
-            for attempt in range(max_retries):
+            # 滑动窗口：同时最多只有 DOWNLOAD_ALL_PAGE_CONCURRENCY 个页面请求在途
+            for page, future in bounded_map(fetch_page, range(2, total_pages + 1),
+                                            DOWNLOAD_ALL_PAGE_CONCURRENCY, stop_event):
                 try:
-                    self.log(f"尝试获取issueId (第{attempt + 1}次)...")
-                    response = self.session.post(url,
-                                                 headers=headers,
-                                                 data=payload,
-                                                 verify=False,
-                                                 timeout=15)
-
-                    # self.log(f"DEBUG: 响应状态码: {response.status_code}")
-                    # self.log(f"DEBUG: 响应头: {dict(response.headers)}")
-
-                    if response.status_code == 200:
-                        result = response.json()
-                        # self.log(f"DEBUG: 响应JSON: {json.dumps(result, ensure_ascii=False)[:300]}")
-
-                        if 'data' in result:
-                            data_org = result['data'].get('data')
-                            issue_id = result['data'].get('issue_id')
-
-                            # self.log(f"DEBUG: data_org: {data_org}")
-                            # self.log(f"DEBUG: issue_id: {issue_id}")
-
-                            if data_org and issue_id:
-                                self.log(f"获取issueId成功: {issue_id}")
-                                return data_org, issue_id
-                            else:
-                                self.log(f"WARN: data_org或issue_id为空")
-                        else:
-                            self.log(f"WARN: 响应中没有data字段")
-                    else:
-                        self.log(f"ERROR: 响应状态码异常: {response.status_code}")
-                        self.log(f"ERROR: 响应文本: {response.text[:500]}")
-
-                except json.JSONDecodeError as e:
-                    self.log(f"ERROR: JSON解析失败: {e}")
-                    self.log(f"ERROR: 响应内容: {response.text[:500]}")
-                    if attempt < max_retries - 1:
-                        time.sleep(1)
-                    else:
-                        raise
+                    put_songs(future.result())
                 except Exception as e:
-                    self.log(f"ERROR: 请求异常: {e}")
-                    if attempt < max_retries - 1:
-                        time.sleep(1)
-                    else:
-                        raise
-
-            self.log("ERROR: 所有重试都失败")
-            return None, None
+                    self.log(f"获取第 {page} 页失败: {e}", level=logging.WARNING, phase='search')
 
-        except Exception as e:
-            self.log(f"获取issueId失败: {e}")
-            self.log(traceback.format_exc())
-            return None, None
+            self.log(f"全部页面获取完成，共 {len(seen_ids)} 首歌曲，去除重复版本后 {len(seen_keys)} 首")
 
-    def f(self):
-        """计算函数"""
-        try:
-            data_org, issue_id = self.get_issueId()
-            if not data_org or not issue_id:
-                return None, None
-
-            t = 1
-            n = sum(data_org)
-            r = (6 + len(data_org) + n) % 6 + 6
-
-            for _ in range(r):
-                t *= 6
-
-            if t < 6666:
-                t *= len(data_org)
-            if t > 0x3f940aa:
-                t = t // len(data_org)
-
-            for o in range(len(data_org)):
-                t += data_org[o] ** 3
-                t ^= o
-                t ^= data_org[o] + o
-
-            f_result = []
-            while t > 0:
-                f_result.insert(0, 63 & t)
-                t >>= 6
-
-            print(f_result, issue_id)
-            return f_result, issue_id
         except Exception as e:
-            self.log(f"计算函数f失败: {e}")
-            return None, None
-
-    def get_sl_challenge_jwt(self):
-        """获取sl_challenge_jwt"""
-        try:
-            clientId = self.get_clientId()
-            if not clientId:
-                return None
-
-            f_result, issue_id = self.f()
-            if not f_result or not issue_id:
-                return None
-
-            url = "https://challenge.rivers.chaitin.cn/challenge/v2/api/verify"
-            payload = json.dumps({
-                "issue_id": issue_id,
-                "result": f_result,
-                "serials": [],
-                "client": {
-                    "userAgent": self.session.headers['User-Agent'],
-                    "platform": "Win32",
-                    "language": "zh-CN,zh",
-                    "vendor": "Google Inc.",
-                    "screen": [1920, 1080],
-                    "visitorId": clientId,
-                    "score": 0,
-                    "target": []
-                }
-            })
-            headers = {
-                'Host': 'challenge.rivers.chaitin.cn',
-                'sec-ch-ua-platform': '"Windows"',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36',
-                'sec-ch-ua': '"Chromium";v="142", "Google Chrome";v="142", "Not_A Brand";v="99"',
-                'Content-Type': 'application/json',
-                'sec-ch-ua-mobile': '?0',
-                'Accept': '*/*',
-                'Origin': 'https://flac.music.hi.cn',
-                'Sec-Fetch-Site': 'cross-site',
-                'Sec-Fetch-Mode': 'cors',
-                'Sec-Fetch-Dest': 'empty',
-                'Referer': 'https://flac.music.hi.cn/',
-                'Accept-Language': 'zh-CN,zh;q=0.9'
-            }
-
-            response = self.session.post(url, headers=headers, data=payload, verify=False, timeout=30)
-            result = response.json()
-            print(result['data']['jwt'])
-            return result['data']['jwt'] if 'data' in result else None
-
-        except Exception as e:
-            self.log(f"获取sl_challenge_jwt失败: {e}")
-            return None
+            self.log(f"获取全部结果失败: {e}", level=logging.ERROR, phase='search')
 
-    def get_jwt_data(self):
-        """获取完整的JWT数据"""
-        try:
-            sl_session = self.get_sl_session()
-            if not sl_session:
-                return None, None
+    def import_playlist(self):
+        """导入歌单文件（文本/CSV/M3U），逐行搜索匹配并下载"""
+        if not self.is_initialized:
+            messagebox.showerror("错误", "未初始化，请先初始化!")
+            return
 
-            sl_challenge_jwt = self.get_sl_challenge_jwt()
-            if not sl_challenge_jwt:
-                return None, None
+        path = filedialog.askopenfilename(
+            title="选择歌单文件",
+            filetypes=[("歌单文件", "*.txt *.csv *.m3u *.m3u8"), ("所有文件", "*.*")])
+        if not path:
+            return
 
-            cookie = f'sl-session={sl_session}; sl-challenge-server=cloud; sl-challenge-jwt={sl_challenge_jwt}'
-            url = "https://flac.music.hi.cn"
+        thread = threading.Thread(target=self.run_download_stream,
+                                  args=(f"导入歌单: {os.path.basename(path)}", self.resolve_playlist, (path,)),
+                                  name="playlist-import")
+        thread.daemon = True
+        thread.start()
 
-            headers = {'Cookie': cookie}
-            response = self.session.get(url, headers=headers, verify=False, timeout=30)
-            sl_jwt_session = response.cookies.get('sl_jwt_session')
-            print(sl_session, sl_jwt_session)
+    def open_watch_list(self):
+        """打开关注列表（界面线程中调用），不可用时返回 None"""
+        if self.watch_list is None:
+            from flac_music_watch import WATCHLIST_PATH, ArtistWatchList
 
-            return sl_session, sl_jwt_session
+            try:
+                self.watch_list = ArtistWatchList(WATCHLIST_PATH)
+            except Exception as e:
+                self.log(f"关注列表不可用: {e}", level=logging.WARNING)
+        return self.watch_list
+
+    def show_watch_list(self):
+        """打开关注歌手窗口"""
+        watch_list = self.open_watch_list()
+        if watch_list is None:
+            messagebox.showerror("错误", "关注列表不可用!")
+            return
+        WatchListPanel(self.root, watch_list, self.sync_watch_list)
+
+    def check_watch_list(self):
+        """定时检查：有到了同步时间的关注歌手时在后台同步（重连后会重复调度，只保留一个定时器）"""
+        from flac_music_watch import WATCH_SYNC_INTERVAL
+
+        if self.watch_check_id is not None:
+            self.root.after_cancel(self.watch_check_id)
+        self.watch_check_id = self.root.after(WATCH_CHECK_MS, self.check_watch_list)
+        watch_list = self.open_watch_list()
+        if watch_list is not None and self.is_initialized:
+            names = watch_list.due(WATCH_SYNC_INTERVAL)
+            if names:
+                self.sync_watch_list(names)
+
+    def sync_watch_list(self, names=None):
+        """同步关注的歌手（默认全部），新歌加入批量下载通道"""
+        if not self.is_initialized:
+            messagebox.showerror("错误", "未初始化，请先初始化!")
+            return
+        if self.watch_syncing:
+            return
+        self.watch_syncing = True
+        thread = threading.Thread(target=self.run_download_stream,
+                                  args=("同步关注的歌手", self.run_watch_sync, (names,)), name="watch-sync")
+        thread.daemon = True
+        thread.start()
 
-        except Exception as e:
-            self.log(f"获取JWT数据失败: {e}")
-            return None, None
+    def run_watch_sync(self, names, stop_event):
+        """逐位歌手增量同步，新歌逐首加入下载服务"""
+        from flac_music_watch import WatchSyncer
 
-    def search_music_with_session(self, keywords, sl_session, sl_jwt_session, page=1, page_size=10):
-        """使用已有的会话信息搜索音乐"""
         try:
-            url = "https://flac.music.hi.cn/ajax.php?act=search"
-            payload = f'keyword={keywords}&page={page}&size={page_size}'
-
-            headers = {
-                'Cookie': f'sl-session={sl_session}; sl_jwt_session={sl_jwt_session}; sl_jwt_sign=',
-                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                'X-Requested-With': 'XMLHttpRequest'
-            }
-
-            response = self.session.post(url, headers=headers, data=payload,
-                                         verify=False, timeout=30)
-            result = response.json()
-
-            if 'data' not in result:
-                return [], 0
+            syncer = WatchSyncer(self.client, self.watch_list, self.download_dir_path, log=self.log)
+            found = requests = 0
+            for result in syncer.sync(names, stop_event):
+                requests += result['requests']
+                found += len(result['new'])
+                if result['new']:
+                    self.log(f"关注的歌手 {result['artist']} 有 {len(result['new'])} 首新歌")
+                for song in result['new']:
+                    if not self.stream_put(song, stop_event):
+                        return
+            self.log(f"关注的歌手同步完成: 新歌 {found} 首，搜索请求 {requests} 次")
+        finally:
+            self.watch_syncing = False
 
-            # 获取总结果数并转换为整数
-            total_count = result['data'].get('total', 0)
-            try:
-                total_count = int(total_count)
-            except (ValueError, TypeError):
-                total_count = 0
+    def resolve_playlist(self, path, stop_event):
+        """解析歌单并将匹配到的歌曲逐首加入下载服务，最后写出未匹配/歧义报告"""
+        def search(keywords, page_size):
+            song_list, _ = self.client.search_music_with_session(
+                keywords, self.client.sl_session, self.client.sl_jwt_session, 1, page_size
+            )
+            return song_list
 
-            if 'list' not in result['data']:
-                return [], total_count
+        importer = PlaylistImporter(search, self.song_index, IMPORT_CONCURRENCY, IMPORT_RATE_LIMIT, self.log)
+        counts = {'matched': 0, 'ambiguous': 0, 'unmatched': 0, 'error': 0, 'cached': 0}
+        report_rows = []
+        seen_ids = set()
 
-            song_list = result['data']['list']
-            formatted_list = []
+        try:
+            entries = importer.parse_file(path)
+            self.log(f"歌单共 {len(entries)} 行待匹配")
 
-            for song in song_list:
-                formatted_list.append({
-                    'id': song.get('id', ''),
-                    'name': song.get('name', '未知'),
-                    'artist': song.get('artist', '未知'),
-                    'album_name': song.get('album_name', '未知'),
-                    'duration': self.format_duration(song.get('duration', 0)),
-                    'format': 'flac',  # 默认格式
-                    'sign': song.get('sign', ''),  # 保存sign值
-                    'time': song.get('time', '')  # 保存time值
-                })
-
-            return formatted_list, total_count
+            for result in importer.resolve(entries, stop_event):
+                counts[result['status']] += 1
+                if result.get('cached'):
+                    counts['cached'] += 1
 
-        except Exception as e:
-            self.log(f"搜索音乐失败: {e}")
-            return [], 0
+                if result['status'] != 'matched':
+                    report_rows.append(result)
+                    continue
 
-    def format_duration(self, seconds):
-        """格式化时长（秒 → MM:SS）"""
-        try:
-            minutes = int(seconds) // 60
-            secs = int(seconds) % 60
-            return f"{minutes:02d}:{secs:02d}"
-        except:
-            return "00:00"
+                song = result['song']
+                if song.id in seen_ids:
+                    continue
+                seen_ids.add(song.id)
+                if not self.stream_put(song, stop_event):
+                    break
 
-    def get_music_download_url_with_session(self, song_id, sl_session, sl_jwt_session, sign='', time=''):
-        """使用已有的会话信息获取音乐下载链接，带上sign值和time值"""
-        try:
-            url = "https://flac.music.hi.cn/ajax.php?act=getUrl"
-            quality = 'format=flac&bitrate=2000'
-
-            # 构建请求参数，包含sign值和time值
-            params = [f'songid={song_id}', quality]
-            if sign:
-                params.append(f'sign={sign}')
-            if time:
-                params.append(f'time={time}')
-
-            payload = '&'.join(params)
-
-            headers = {
-                'Cookie': f'sl-session={sl_session}; sl_jwt_session={sl_jwt_session}; sl_jwt_sign=',
-                'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                'X-Requested-With': 'XMLHttpRequest'
-            }
-
-            self.log(f"获取下载链接: song_id={song_id}, sign={sign[:20]}..., time={time}")
-
-            response = self.session.post(url, headers=headers, data=payload,
-                                         verify=False, timeout=60)
-            result = response.json()
-
-            if 'data' not in result:
-                raise Exception("下载链接获取失败")
-
-            song_info = result['data']
-            song_url = song_info['url']
-
-            # 从URL中提取文件名
-            if 'song_name' in song_info and 'artist' in song_info:
-                song_name = song_info['song_name']
-                artist = song_info['artist']
-                music_format = song_info.get('format', 'flac')
-                filename = f"{song_name} - {artist}.{music_format}"
-            else:
-                # 如果没有歌曲信息，使用当前时间作为文件名
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"song_{timestamp}.flac"
+            self.log(f"歌单匹配完成: 匹配 {counts['matched']}，歧义 {counts['ambiguous']}，"
+                     f"未匹配 {counts['unmatched']}，出错 {counts['error']}（缓存命中 {counts['cached']}）")
 
-            return song_url, filename
+            if report_rows:
+                report_path = importer.report_path(path)
+                importer.write_report(report_path, report_rows)
+                self.log(f"未匹配/歧义报告已保存: {report_path}")
 
         except Exception as e:
-            self.log(f"获取下载链接失败: {e}")
-            raise
+            self.log(f"导入歌单失败: {e}", level=logging.ERROR, phase='import')
 
 
 def main():
+    import argparse
+
+    from flac_music_cache import add_cache_arguments, track_cache_from_args
+
+    parser = argparse.ArgumentParser(description="无损音乐下载器")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="输出启动耗时报告（模块导入、界面构建、首次绘制、可以搜索）")
+    parser.add_argument('--diagnostics', action='store_true',
+                        help="启动时开启诊断模式（采样分析和内存跟踪，退出时保存）")
+    parser.add_argument('--daemon', metavar='URL',
+                        help="作为守护进程的瘦客户端运行（如 http://127.0.0.1:8765），搜索和下载由守护进程执行")
+    parser.add_argument('--daemon-token', default=os.environ.get('FLAC_DAEMON_TOKEN'),
+                        help="守护进程的访问令牌（也可用环境变量 FLAC_DAEMON_TOKEN）")
+    add_cache_arguments(parser)
+    add_quality_arguments(parser)
+    add_schedule_arguments(parser)
+    parser.add_argument('--benchmark-memory', action='store_true',
+                        help="比较 1万/10万/100万 首歌曲用字典和 SongRecord 保存的内存占用后退出")
+    args = parser.parse_args()
+    try:
+        quality_policy = quality_policy_from_args(args)
+        schedule_windows = schedule_windows_from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.benchmark_memory:
+        print_song_memory_benchmark()
+        return
+
+    setup_logging()
+
+    # 定期导出指标
+    metrics.set('flac_info', 1, mode='thin-client' if args.daemon else 'gui')
+    try:
+        MetricsExporter(metrics).start()
+    except OSError as e:
+        logger.warning(f"指标导出不可用: {e}")
+
+    startup_timer = None
+    if args.startup_report:
+        startup_timer = StartupTimer(STARTUP_STARTED)
+        startup_timer.mark('import')
+
+    # 曲目缓存只在本机下载时使用（连接守护进程时由守护进程下载）
+    track_cache = None
+    if args.cache and not args.daemon:
+        track_cache = track_cache_from_args(args)
+
     root = tk.Tk()
-    app = MusicDownloaderApp(root)
+    app = MusicDownloaderApp(root, startup_timer, args.daemon, args.daemon_token, track_cache, quality_policy,
+                             schedule_windows)
+    if args.diagnostics:
+        app.toggle_diagnostics()
+    # 退出时保存仍在进行的诊断
+    atexit.register(app.diagnostics.stop)
     root.mainloop()
 
 
@@ -0,0 +1,388 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from flac_music_cache import add_cache_arguments, track_cache_from_args
+from flac_music_cli import EXIT_INCOMPLETE, EXIT_INTERRUPTED, EXIT_OK, EXIT_SESSION_FAILED, HeadlessDownloader, \
+    JsonLinesWriter, song_fields
+from flac_music_core import (
+    APP_DATA_DIR, DEFAULT_DOWNLOAD_DIR, DOWNLOAD_WORKERS, QUALITY_TIERS, SONG_INDEX_PATH, DuplicateClusterer,
+    MetricsExporter, MusicClient, RateLimiter, SongIndex, add_quality_arguments, add_schedule_arguments,
+    bounded_map, default_source_providers, log_message, logger, metrics, quality_policy_from_args,
+    schedule_windows_from_args, setup_logging,
+)
+
+# 关注的歌手列表和每位歌手已见过的歌曲ID
+WATCHLIST_PATH = os.path.join(APP_DATA_DIR, "watchlist.db")
+
+# 同步：每页数量、每位歌手每次最多翻的页数、首次同步（建立基线）最多翻的页数
+WATCH_PAGE_SIZE = 20
+WATCH_MAX_PAGES = 5
+WATCH_BASELINE_PAGES = 25
+
+# 同时同步的歌手数和每秒最多搜索次数（200 位歌手每次同步通常只需每人一两次请求）
+WATCH_CONCURRENCY = 3
+WATCH_SEARCH_RATE = 2
+
+# 定期同步的间隔（秒）
+WATCH_SYNC_INTERVAL = 6 * 3600
+
+
+class ArtistWatchList:
+    """关注的歌手列表：记录每位歌手上次同步时的结果总数和已见过的歌曲ID，供增量同步判断哪些是新歌"""
+
+    def __init__(self, db_path=WATCHLIST_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.create_schema()
+
+    def create_schema(self):
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS artists (
+                    name TEXT PRIMARY KEY,
+                    added_at REAL,
+                    last_sync REAL,
+                    last_total INTEGER,
+                    resume_page INTEGER
+                )
+            """)
+            # matched: 歌手名相符（其余是同一搜索中出现的其他歌手的歌，只用于判断翻页何时停止）
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS artist_songs (
+                    artist TEXT NOT NULL,
+                    song_id TEXT NOT NULL,
+                    matched INTEGER,
+                    first_seen REAL,
+                    PRIMARY KEY (artist, song_id)
+                ) WITHOUT ROWID
+            """)
+
+    def add(self, name):
+        """关注歌手，已关注时返回 False"""
+        with self.lock, self.conn:
+            cursor = self.conn.execute("INSERT OR IGNORE INTO artists (name, added_at) VALUES (?, ?)",
+                                       (name, time.time()))
+        return cursor.rowcount > 0
+
+    def remove(self, name):
+        """取消关注并删除已见过的歌曲记录，未关注时返回 False"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM artist_songs WHERE artist = ?", (name,))
+            cursor = self.conn.execute("DELETE FROM artists WHERE name = ?", (name,))
+        return cursor.rowcount > 0
+
+    def artists(self):
+        """全部关注的歌手：名称、上次同步时间、上次结果总数和已见过的相符歌曲数"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT a.name, a.last_sync, a.last_total, "
+                "(SELECT COUNT(*) FROM artist_songs s WHERE s.artist = a.name AND s.matched) "
+                "FROM artists a ORDER BY a.added_at, a.name").fetchall()
+        return [{'name': name, 'last_sync': last_sync, 'last_total': last_total, 'songs': songs}
+                for name, last_sync, last_total, songs in rows]
+
+    def get(self, name):
+        """歌手的 (上次同步时间, 上次结果总数, 上次没翻完时停下的页码)，未关注时返回 None"""
+        with self.lock:
+            return self.conn.execute("SELECT last_sync, last_total, resume_page FROM artists WHERE name = ?",
+                                     (name,)).fetchone()
+
+    def known_ids(self, name):
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT song_id FROM artist_songs WHERE artist = ?",
+                                                        (name,))}
+
+    def due(self, interval):
+        """距上次同步超过 interval 秒（或从未同步）的歌手"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT name FROM artists WHERE last_sync IS NULL OR last_sync <= ? ORDER BY added_at, name",
+                (time.time() - interval,))]
+
+    def record_sync(self, name, total, seen, resume_page=None):
+        """保存同步结果：结果总数、本次新见到的歌曲 [(歌曲ID, 是否相符)] 和下次接着翻的页码"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO artist_songs (artist, song_id, matched, first_seen) VALUES (?, ?, ?, ?)",
+                [(name, song_id, int(matched), now) for song_id, matched in seen])
+            self.conn.execute("UPDATE artists SET last_sync = ?, last_total = ?, resume_page = ? WHERE name = ?",
+                              (now, total, resume_page, name))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class WatchSyncer:
+    """增量同步关注的歌手：按歌手名搜索，跳过已见过的歌曲和本地已有的歌曲，只返回新歌
+
+    站点结果大致按发布时间排列，新歌出现在前几页：翻到已见过的歌曲、且本次见到的新结果数不少于
+    结果总数的增长时停止翻页，每位歌手通常只需一次请求；翻页数用完时记下页码，下次同步从那里继续。
+    首次同步只记录现有歌曲作为基线（backfill 时也返回本地没有的歌曲）。
+    """
+
+    def __init__(self, client, watch_list, output_dir, page_size=WATCH_PAGE_SIZE, max_pages=WATCH_MAX_PAGES,
+                 baseline_pages=WATCH_BASELINE_PAGES, concurrency=WATCH_CONCURRENCY, search_rate=WATCH_SEARCH_RATE,
+                 backfill=False, log=log_message):
+        self.client = client
+        self.watch_list = watch_list
+        self.output_dir = output_dir
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.baseline_pages = baseline_pages
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(search_rate)
+        self.backfill = backfill
+        self.log = log
+        self.clusterer = DuplicateClusterer()
+
+    def matches_artist(self, song, name):
+        """歌曲的歌手（拆分合唱后）之一与关注的歌手相同"""
+        wanted = self.clusterer.normalize_text(name)
+        return wanted in self.clusterer.normalize_artist(song.artist).split('|')
+
+    def in_library(self, song):
+        """本地索引有下载记录且文件仍在，或下载目录中已有同名文件（任一音质档位的格式）"""
+        song_index = self.client.song_index
+        if song_index is not None:
+            download = song_index.get_download(song.id)
+            if download and download[3] and os.path.exists(download[3]):
+                return True
+        stem = os.path.splitext(self.client.song_filename(song))[0]
+        formats = {song.format} | {tier.format for tier in QUALITY_TIERS}
+        return any(os.path.exists(os.path.join(self.output_dir, f"{stem}.{fmt}")) for fmt in formats)
+
+    def search(self, name, page):
+        self.limiter.acquire()
+        return self.client.search_music_with_session(name, self.client.sl_session, self.client.sl_jwt_session,
+                                                     page, self.page_size)
+
+    def sync_artist(self, name, stop_event=None):
+        """同步一位歌手，返回 {'artist', 'requests', 'total', 'new': [新歌], 'in_library', 'baseline'}"""
+        state = self.watch_list.get(name)
+        last_sync, last_total, resume_page = state if state else (None, None, None)
+        baseline = last_sync is None
+        known = self.watch_list.known_ids(name)
+        max_pages = self.baseline_pages if baseline else self.max_pages
+        expected = 0  # 结果总数比上次增加的数量，由第一页的总数确定
+
+        result = {'artist': name, 'requests': 0, 'total': 0, 'new': [], 'in_library': 0, 'baseline': baseline}
+        seen = []
+        page = 1
+        next_page = None  # 翻页数用完时下次同步接着翻的页码
+        while not (stop_event and stop_event.is_set()):
+            if result['requests'] >= max_pages:
+                next_page = None if baseline else page
+                break
+            songs, total = self.search(name, page)
+            result['requests'] += 1
+            if page == 1:
+                if not songs and last_total:
+                    # 之前有结果这次却为空，多半是搜索失败，不更新记录
+                    raise Exception("搜索没有返回结果")
+                result['total'] = total
+                expected = max(0, total - (last_total or 0))
+
+            fresh = [song for song in songs if song.id and song.id not in known]
+            for song in fresh:
+                known.add(song.id)
+                matched = self.matches_artist(song, name)
+                seen.append((song.id, matched))
+                if not matched or (baseline and not self.backfill):
+                    continue
+                if self.in_library(song):
+                    result['in_library'] += 1
+                else:
+                    result['new'].append(song)
+
+            if len(songs) < self.page_size or page * self.page_size >= result['total']:
+                break
+            # 翻到了见过的结果，且新结果数已不少于总数的增长：新歌都已找到，上次没翻完时跳到上次停下的页
+            if not baseline and len(fresh) < len(songs) and len(seen) >= expected:
+                if resume_page and resume_page > page:
+                    page, resume_page = resume_page, None
+                    continue
+                break
+            page += 1
+
+        if stop_event and stop_event.is_set():
+            # 中途停止时不记录，新歌留到下次同步
+            return result
+        if next_page:
+            self.log(f"关注的歌手 {name} 翻了 {max_pages} 页仍有新结果，下次同步从第 {next_page} 页继续",
+                     level=logging.INFO, phase='watch')
+        self.watch_list.record_sync(name, result['total'], seen, next_page)
+        metrics.inc('flac_watch_requests_total', result['requests'])
+        metrics.inc('flac_watch_new_songs_total', len(result['new']))
+        return result
+
+    def sync(self, names=None, stop_event=None):
+        """并发同步指定（默认全部）歌手，按完成顺序产出每位歌手的结果；出错的歌手结果中带 'error'"""
+        if names is None:
+            names = [artist['name'] for artist in self.watch_list.artists()]
+        for name, future in bounded_map(lambda name: self.sync_artist(name, stop_event), names,
+                                        self.concurrency, stop_event):
+            try:
+                yield future.result()
+            except Exception as e:
+                self.log(f"同步关注的歌手 {name} 失败: {e}", level=logging.WARNING, phase='watch')
+                yield {'artist': name, 'requests': 0, 'total': 0, 'new': [], 'in_library': 0, 'baseline': False,
+                       'error': str(e)}
+
+
+def result_fields(result):
+    """事件中的同步结果（不含歌曲列表）"""
+    return {**result, 'new': len(result['new'])}
+
+
+def command_add(args, events):
+    watch_list = ArtistWatchList(args.watchlist)
+    for name in args.artists:
+        events.emit('watch_added', artist=name, added=watch_list.add(name))
+    return EXIT_OK
+
+
+def command_remove(args, events):
+    watch_list = ArtistWatchList(args.watchlist)
+    missing = 0
+    for name in args.artists:
+        removed = watch_list.remove(name)
+        missing += not removed
+        events.emit('watch_removed', artist=name, removed=removed)
+    return EXIT_OK if missing == 0 else EXIT_INCOMPLETE
+
+
+def command_list(args, events):
+    for artist in ArtistWatchList(args.watchlist).artists():
+        events.emit('watch', **artist)
+    return EXIT_OK
+
+
+def command_sync(args, events):
+    try:
+        MetricsExporter(metrics).start()
+    except OSError as e:
+        logger.warning(f"指标导出不可用: {e}")
+
+    song_index = None
+    if not args.no_index:
+        try:
+            song_index = SongIndex(SONG_INDEX_PATH)
+        except Exception as e:
+            logger.warning(f"本地歌曲索引不可用: {e}")
+
+    client = MusicClient(song_index, providers=default_source_providers(directories=args.source_dirs))
+    client.track_cache = track_cache_from_args(args)
+    if not client.init_session():
+        events.emit('session', status='failed')
+        return EXIT_SESSION_FAILED
+    events.emit('session', status='ok')
+
+    output_dir = os.path.abspath(os.path.expanduser(args.output))
+    watch_list = ArtistWatchList(args.watchlist)
+    syncer = WatchSyncer(client, watch_list, output_dir, max_pages=args.max_pages, search_rate=args.search_rate,
+                         backfill=args.backfill)
+    stop_event = threading.Event()
+    while True:
+        names = watch_list.due(args.every * 3600) if args.every else None
+        if names == []:
+            # 没有到期的歌手，每小时检查一次
+            try:
+                time.sleep(min(3600, args.every * 3600))
+            except KeyboardInterrupt:
+                events.emit('interrupted', queued=0)
+                return EXIT_INTERRUPTED
+            continue
+        downloader = HeadlessDownloader(client, output_dir, args.concurrency, int(args.rate_limit * 1024), events,
+                                        args.quality_policy, args.schedule_windows)
+
+        def new_songs():
+            # 每位歌手同步完成即开始下载其新歌
+            for result in syncer.sync(names, stop_event):
+                events.emit('synced', **result_fields(result))
+                for song in result['new']:
+                    events.emit('new_song', artist=result['artist'], **song_fields(song))
+                    yield song
+
+        try:
+            code = downloader.run(songs=new_songs(), song_source='watch')
+        except KeyboardInterrupt:
+            stop_event.set()
+            downloader.cancel()
+            events.emit('interrupted', queued=downloader.queued)
+            return EXIT_INTERRUPTED
+        if not args.every:
+            return code
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="无损音乐下载器（关注歌手）：定期按歌手名搜索，只下载上次同步以来出现的新歌")
+    parser.add_argument('--watchlist', default=WATCHLIST_PATH, help="关注列表文件（默认 %(default)s）")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('add', help="关注歌手（下次同步时只记录现有歌曲，不下载）")
+    add.add_argument('artists', nargs='+', metavar='ARTIST')
+    remove = commands.add_parser('remove', help="取消关注")
+    remove.add_argument('artists', nargs='+', metavar='ARTIST')
+    commands.add_parser('list', help="列出关注的歌手")
+
+    sync = commands.add_parser('sync', help="同步全部关注的歌手并下载新歌")
+    sync.add_argument('-o', '--output', default=DEFAULT_DOWNLOAD_DIR, help="下载目录（默认 %(default)s）")
+    sync.add_argument('-j', '--concurrency', type=int, default=DOWNLOAD_WORKERS,
+                      help="并发下载数（默认 %(default)s）")
+    sync.add_argument('--rate-limit', type=float, default=0, metavar='KBPS',
+                      help="全部下载合计的带宽上限（KB/s，0 表示不限制）")
+    sync.add_argument('--every', type=float, default=0, metavar='HOURS',
+                      help="常驻运行，每位歌手每隔指定小时数同步一次（默认只同步一次后退出）")
+    sync.add_argument('--max-pages', type=int, default=WATCH_MAX_PAGES,
+                      help="每位歌手每次最多翻的页数（默认 %(default)s）")
+    sync.add_argument('--search-rate', type=float, default=WATCH_SEARCH_RATE,
+                      help="每秒最多搜索次数（默认 %(default)s）")
+    sync.add_argument('--backfill', action='store_true', help="首次同步的歌手也下载本地没有的现有歌曲")
+    sync.add_argument('--no-index', action='store_true', help="不读写本地歌曲索引")
+    sync.add_argument('--source-dir', dest='source_dirs', action='append', default=[], metavar='DIR',
+                      help="额外的本地目录来源（可重复，也可用环境变量 FLAC_SOURCE_DIRS）")
+    add_cache_arguments(sync)
+    add_quality_arguments(sync)
+    add_schedule_arguments(sync)
+    parser.add_argument('-q', '--quiet', action='store_true', help="标准错误只输出警告和错误日志")
+
+    args = parser.parse_args(argv)
+    if args.command == 'sync':
+        if args.concurrency < 1:
+            sync.error("--concurrency 至少为 1")
+        if args.max_pages < 1:
+            sync.error("--max-pages 至少为 1")
+        try:
+            args.quality_policy = quality_policy_from_args(args)
+            args.schedule_windows = schedule_windows_from_args(args)
+        except ValueError as e:
+            sync.error(str(e))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(level=logging.WARNING if args.quiet else logging.INFO, stream=sys.stderr)
+    metrics.set('flac_info', 1, mode=f'watch-{args.command}')
+    events = JsonLinesWriter()
+    commands = {'add': command_add, 'remove': command_remove, 'list': command_list, 'sync': command_sync}
+    try:
+        return commands[args.command](args, events)
+    except sqlite3.Error as e:
+        logger.error(f"关注列表不可用: {e}")
+        return EXIT_INCOMPLETE
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""测试共用的假来源"""
+import os
+
+from flac_music_core import QUALITY_TIERS, LocalFileSession, SourceProvider
+
+
+class FakeProvider(SourceProvider):
+    """内存中的来源：search 可以等待 release 事件，resolve 可以固定失败"""
+
+    def __init__(self, name, songs, deadline=1.0, release=None, resolve_error=None):
+        super().__init__()
+        self.name = name
+        self.songs = songs
+        self.deadline = deadline
+        self.release = release
+        self.resolve_error = resolve_error
+
+    def init_session(self):
+        return True
+
+    def search(self, keywords, page=1, page_size=10, cancel_token=None):
+        if self.release is not None:
+            self.release.wait(5)
+        return self.songs, len(self.songs)
+
+    def resolve(self, song, tier=None):
+        if self.resolve_error:
+            raise Exception(self.resolve_error)
+        return f"http://{self.name}/{song.id}", f"{song.display_name()}.flac"
+
+
+class TieredProvider(SourceProvider):
+    """提供多个音质档位的本地来源：每个档位对应 root 下的一个文件，内容为 contents[档位名]"""
+
+    quality_tiers = QUALITY_TIERS
+
+    def __init__(self, root, contents, name='flac'):
+        super().__init__()
+        self.name = name
+        self.root = root
+        self.session = LocalFileSession()
+        self.resolved = []  # 获取过下载链接的档位名
+        for tier in self.quality_tiers:
+            with open(os.path.join(root, f"{tier.name}.{tier.format}"), 'wb') as f:
+                f.write(contents[tier.name])
+
+    def init_session(self):
+        return True
+
+    def search(self, keywords, page=1, page_size=10, cancel_token=None):
+        return [], 0
+
+    def resolve(self, song, tier=None):
+        tier = tier or self.quality_tiers[0]
+        self.resolved.append(tier.name)
+        return os.path.join(self.root, f"{tier.name}.{tier.format}"), f"{song.display_name()}.{tier.format}"
@@ -0,0 +1,51 @@
+"""曲目缓存取出到下载目录"""
+import threading
+
+import pytest
+
+import flac_music_cache
+from flac_music_cache import RemoteTrackCache, TrackCache, make_cache_server
+
+
+@pytest.fixture
+def cache(tmp_path):
+    source = tmp_path / 'song.flac'
+    source.write_bytes(b'cached flac')
+    cache = TrackCache(str(tmp_path / 'cache'))
+    cache.put('1', str(source), '晴天 - 周杰伦.flac')
+    return cache
+
+
+@pytest.fixture
+def remote(cache):
+    server = make_cache_server(cache, '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield RemoteTrackCache(f"http://127.0.0.1:{server.server_address[1]}")
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('which', ['cache', 'remote'])
+def test_fetch_does_not_overwrite_existing_file(request, tmp_path, which):
+    track_cache = request.getfixturevalue(which)
+    save_dir = tmp_path / 'out'
+    save_dir.mkdir()
+    (save_dir / '晴天 - 周杰伦.flac').write_bytes(b'mine')
+
+    path = track_cache.fetch('1', str(save_dir))
+    assert path == str(save_dir / '晴天 - 周杰伦_1.flac')
+    assert (save_dir / '晴天 - 周杰伦.flac').read_bytes() == b'mine'
+    assert (save_dir / '晴天 - 周杰伦_1.flac').read_bytes() == b'cached flac'
+
+
+def test_failed_local_fetch_removes_partial_file(cache, tmp_path, monkeypatch):
+    def disk_full(source, target):
+        target.write(b'cach')
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(flac_music_cache, 'copy_with_hash', disk_full)
+    save_dir = tmp_path / 'out'
+    save_dir.mkdir()
+    with pytest.raises(OSError):
+        cache.fetch('1', str(save_dir), 'a.flac')
+    assert list(save_dir.iterdir()) == []
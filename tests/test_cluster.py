@@ -0,0 +1,66 @@
+"""多个工作节点共用一个队列：被杀死的节点的任务在租约过期后由其他节点收回"""
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+CLUSTER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flac_music_cluster.py')
+SONG_SIZE = 150000
+
+
+def cluster(env, *args, **kwargs):
+    return subprocess.Popen([sys.executable, CLUSTER, *args], env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, **kwargs)
+
+
+def start_worker(env, queue, output, worker_id, *args):
+    return cluster(env, 'work', queue, '--no-index', '-q', '-o', output, '--lease', '2', '--worker-id', worker_id,
+                   *args)
+
+
+def jobs(queue):
+    conn = sqlite3.connect(queue)
+    try:
+        return conn.execute("SELECT song_id, status, worker FROM jobs ORDER BY seq").fetchall()
+    finally:
+        conn.close()
+
+
+def test_killed_worker_jobs_are_reclaimed(tmp_path):
+    library = tmp_path / 'library'
+    library.mkdir()
+    song_ids = []
+    for i in range(6):
+        (library / f"song{i} - artist.flac").write_bytes(bytes([i]) * SONG_SIZE)
+        song_ids.append(f"dir1:song{i} - artist.flac")
+    # 本地目录作为来源，应用数据（指标等）写到临时目录
+    env = dict(os.environ, HOME=str(tmp_path / 'home'), FLAC_SOURCE_DIRS=str(library))
+    env.pop('FLAC_TRACK_CACHE', None)
+    queue, output = str(tmp_path / 'queue.db'), str(tmp_path / 'out')
+
+    add_args = ['add', queue, '--no-index']
+    for song_id in song_ids:
+        add_args += ['--id', song_id]
+    assert cluster(env, *add_args).wait(30) == 0
+
+    # 限速的节点领到任务后还在下载中就被杀死，租约留在队列里
+    victim = start_worker(env, queue, output, 'victim', '-j', '3', '--rate-limit', '16')
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        taken = [song_id for song_id, status, worker in jobs(queue) if worker == 'victim' and status == 'leased']
+        if len(taken) == 3:
+            break
+        time.sleep(0.1)
+    assert len(taken) == 3
+    victim.kill()
+    victim.wait(10)
+
+    survivors = [start_worker(env, queue, output, f"survivor{i}") for i in range(2)]
+    assert [survivor.wait(60) for survivor in survivors] == [0, 0]
+
+    rows = {song_id: (status, worker) for song_id, status, worker in jobs(queue)}
+    assert all(status == 'done' for status, _ in rows.values())
+    assert all(rows[song_id][1] != 'victim' for song_id in taken)
+    for i in range(6):
+        assert (tmp_path / 'out' / f"song{i} - artist.flac").read_bytes() == bytes([i]) * SONG_SIZE
@@ -0,0 +1,81 @@
+"""图形界面经 RemoteMusicClient 使用守护进程"""
+import threading
+import time
+
+import pytest
+
+from flac_music_core import DirectoryProvider, SearchCancelToken, SongRecord
+from flac_music_daemon import DaemonEngine, RemoteMusicClient, make_server
+from helpers import FakeProvider
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    """本机端口上的守护进程，来源为内存中的假来源"""
+    engine = DaemonEngine(str(tmp_path / 'out'))
+    release = threading.Event()
+    engine.client.providers = [
+        FakeProvider('flac', [SongRecord('1', '晴天', '周杰伦', duration='04:29')]),
+        FakeProvider('slow', [SongRecord('slow:2', '夜曲', '周杰伦')], deadline=0.1, release=release),
+    ]
+    server = make_server(engine, '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_gui_search_call_through_remote_client(daemon):
+    client = RemoteMusicClient(daemon)
+    assert client.init_session()
+    late = []
+
+    # 与图形界面 do_search 相同的调用方式
+    songs, total = client.search_music_with_session('周杰伦', client.sl_session, client.sl_jwt_session, 1, 10,
+                                                    cancel_token=SearchCancelToken(1), on_late=late.append)
+    assert [song.id for song in songs] == ['1']
+    assert total == 1
+    # 守护进程不转发晚到的来源结果
+    assert late == []
+
+
+class BlockingDirectory(DirectoryProvider):
+    """获取下载链接时等待 release 事件，让任务停在下载中"""
+
+    def __init__(self, root, release):
+        super().__init__(root, 'flac')
+        self.release = release
+
+    def resolve(self, song, tier=None):
+        self.release.wait(5)
+        return super().resolve(song, tier)
+
+
+def wait_finished(engine, count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        tasks = engine.tasks()
+        if len(tasks) == count and all(task['status'] in ('done', 'failed', 'cancelled') for task in tasks):
+            return {task['song']['id']: task['status'] for task in tasks}
+        time.sleep(0.05)
+    raise AssertionError(f"任务未结束: {engine.tasks()}")
+
+
+def test_songs_added_after_cancel_all_are_not_cancelled(tmp_path):
+    library = tmp_path / 'library'
+    library.mkdir()
+    for name in ('a', 'b'):
+        (library / f"{name} - x.flac").write_bytes(name.encode() * 1000)
+    release = threading.Event()
+    engine = DaemonEngine(str(tmp_path / 'out'))
+    engine.client.providers = [BlockingDirectory(str(library), release)]
+    assert engine.init_session()
+
+    engine.enqueue([SongRecord('flac:a - x.flac', 'a', 'x')])
+    engine.control('cancel')
+    # 被取消的任务还在收尾时加入新的歌曲
+    engine.enqueue([SongRecord('flac:b - x.flac', 'b', 'x')])
+    release.set()
+
+    assert wait_finished(engine, 2) == {'flac:a - x.flac': 'cancelled', 'flac:b - x.flac': 'done'}
@@ -0,0 +1,89 @@
+"""跨页重复歌曲的归组和首选版本"""
+import pytest
+
+from flac_music_core import DuplicateClusterer, SongRecord
+
+
+@pytest.mark.parametrize('first, second', [
+    # 全角、大小写、空白和标点
+    (('晴天', '周杰伦', '04:29'), ('晴天！', '周杰伦 ', '04:29')),
+    (('ＡＢＣ Song', 'Band', ''), ('abc-song', 'BAND', '')),
+    # 合唱歌手的顺序和分隔符
+    (('告白气球', '周杰伦/费玉清', '03:35'), ('告白气球', '费玉清 & 周杰伦', '03:35')),
+    (('Love', 'A feat. B', '03:00'), ('Love', 'B, A', '03:00')),
+    (('Love', 'A ft B', '03:00'), ('Love', 'B；A', '03:00')),
+])
+def test_compute_key_normalizes_titles_and_artists(first, second):
+    clusterer = DuplicateClusterer()
+    assert clusterer.compute_key(SongRecord('1', *first)) == clusterer.compute_key(SongRecord('2', *second))
+
+
+@pytest.mark.parametrize('duration, bucket', [('04:29', 89), ('04:30', 90), ('00:00', None), ('', None),
+                                              ('未知', None)])
+def test_compute_key_duration_bucket(duration, bucket):
+    assert DuplicateClusterer().compute_key(SongRecord('1', '晴天', '周杰伦', duration=duration))[2] == bucket
+
+
+def test_candidate_keys_include_neighbouring_buckets():
+    clusterer = DuplicateClusterer()
+    assert clusterer.candidate_keys(('t', 'a', 10)) == [('t', 'a', 10), ('t', 'a', 9), ('t', 'a', 11)]
+    assert clusterer.candidate_keys(('t', 'a', None)) == [('t', 'a', None)]
+
+
+def cluster_of(clusterer, song_id):
+    return clusterer.song_clusters[song_id]
+
+
+@pytest.mark.parametrize('first, second, same', [
+    # 相邻时长分桶视为同一录音
+    ('04:29', '04:31', True),
+    ('04:29', '04:29', True),
+    ('04:29', '04:40', False),
+    # 时长未知的只和同样未知的归为一组
+    ('', '', True),
+    ('', '04:29', False),
+])
+def test_near_duplicate_durations(first, second, same):
+    clusterer = DuplicateClusterer()
+    clusterer.add_songs([SongRecord('1', '晴天', '周杰伦', duration=first),
+                         SongRecord('2', '晴天', '周杰伦', duration=second)])
+    assert (cluster_of(clusterer, '1') == cluster_of(clusterer, '2')) is same
+    assert clusterer.is_duplicate('1') is same
+
+
+def test_different_titles_or_artists_are_not_grouped():
+    clusterer = DuplicateClusterer()
+    clusterer.add_songs([SongRecord('1', '晴天', '周杰伦', duration='04:29'),
+                         SongRecord('2', '晴天 Live', '周杰伦', duration='04:29'),
+                         SongRecord('3', '晴天', '五月天', duration='04:29')])
+    assert len({cluster_of(clusterer, song_id) for song_id in '123'}) == 3
+    assert clusterer.duplicate_count() == 0
+
+
+def test_preferred_variant_across_pages():
+    clusterer = DuplicateClusterer()
+    clusterer.add_songs([SongRecord('1', '晴天', '周杰伦', duration='04:29')])
+    assert clusterer.is_preferred('1')
+    # 后一页的版本有专辑信息和签名，成为首选
+    clusterer.add_songs([SongRecord('2', '晴天', '周杰伦', '叶惠美', '04:30', sign='abc'),
+                         SongRecord('3', '晴天', '周杰伦', '叶惠美', '04:29')])
+    assert [clusterer.is_preferred(song_id) for song_id in '123'] == [False, True, False]
+    assert clusterer.duplicate_count() == 2
+
+    # 同一首歌重复加入不改变分组
+    clusterer.add_songs([SongRecord('1', '晴天', '周杰伦', duration='04:29')])
+    assert clusterer.clusters[cluster_of(clusterer, '1')]['size'] == 3
+
+
+def test_pick_for_selection_takes_one_variant_per_group():
+    clusterer = DuplicateClusterer()
+    songs = [SongRecord('1', '晴天', '周杰伦', duration='04:29'),
+             SongRecord('2', '晴天', '周杰伦', '叶惠美', '04:29'),
+             SongRecord('3', '稻香', '周杰伦', duration='03:43'),
+             SongRecord('4', '稻香', '周杰伦', duration='03:43')]
+    clusterer.add_songs(songs)
+    assert [song.id for song in clusterer.pick_for_selection(songs, set())] == ['2', '3']
+    # 已选中某个版本的分组跳过
+    assert [song.id for song in clusterer.pick_for_selection(songs, {'4'})] == ['2']
+    # 未归组的歌曲照常选中
+    assert [song.id for song in clusterer.pick_for_selection([SongRecord('9', 'x', 'y')], set())] == ['9']
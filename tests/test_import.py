@@ -0,0 +1,159 @@
+"""歌单导入：解析歌单文件、挑选最佳匹配和解析结果缓存"""
+import os
+import time
+
+import pytest
+
+from flac_music_core import PlaylistImporter, SongRecord
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fields(entries):
+    return [(entry['line'], entry['artist'], entry['title'], entry['duration']) for entry in entries]
+
+
+class FakeSearch:
+    """按关键词返回固定候选歌曲，记录搜索过的关键词"""
+
+    def __init__(self, results=None, error=None):
+        self.results = results or {}
+        self.error = error
+        self.queries = []
+
+    def __call__(self, keywords, page_size):
+        self.queries.append(keywords)
+        if self.error:
+            raise Exception(self.error)
+        return self.results.get(keywords, [])
+
+
+class MemoryIndex:
+    """内存中的本地索引，只实现导入用到的方法"""
+
+    def __init__(self, songs=()):
+        self.songs = {song.id: song for song in songs}
+        self.resolutions = {}
+
+    def get_song(self, song_id):
+        return self.songs.get(song_id)
+
+    def get_import_resolution(self, query_key):
+        return self.resolutions.get(query_key)
+
+    def save_import_resolution(self, query_key, status, song_id, score):
+        self.resolutions[query_key] = (status, song_id, score, time.time())
+
+
+def importer(search, song_index=None, log=None):
+    return PlaylistImporter(search, song_index, concurrency=2, rate_limit=0, log=log)
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('playlist.txt', [(2, '周杰伦', '晴天', None), (3, '陈奕迅', '十年', None), (5, '', '七里香', None)]),
+    ('playlist.csv', [(2, '周杰伦', '晴天', 269), (3, '陈奕迅', '十年', 205), (5, '周杰伦', '稻香', None)]),
+    ('playlist_noheader.csv', [(1, '周杰伦', '晴天', 269), (2, '陈奕迅', '十年', None)]),
+    ('playlist.m3u', [(2, '周杰伦', '晴天', 269), (4, '', '十年', None), (6, '林俊杰', '江南', None)]),
+])
+def test_parse_file(name, expected):
+    assert fields(importer(None).parse_file(os.path.join(FIXTURES, name))) == expected
+
+
+def test_parse_gbk_text(tmp_path):
+    path = tmp_path / 'gbk.txt'
+    path.write_bytes('周杰伦 - 晴天\n'.encode('gbk'))
+    assert fields(importer(None).parse_file(str(path))) == [(1, '周杰伦', '晴天', None)]
+
+
+@pytest.mark.parametrize('text, seconds', [('04:29', 269), ('1:02:03', 123), ('205', 205), ('0', None),
+                                           ('abc', None)])
+def test_parse_duration(text, seconds):
+    assert PlaylistImporter.parse_duration(text) == seconds
+
+
+def entry(title, artist='', duration=None):
+    return {'line': 1, 'raw': f"{artist} - {title}", 'artist': artist, 'title': title, 'duration': duration}
+
+
+@pytest.mark.parametrize('song, expected', [
+    (SongRecord('1', '晴天', '周杰伦', duration='04:29'), 1.0),
+    # 全角、大小写和标点不影响匹配
+    (SongRecord('1', '晴天！', '周杰伦', duration='04:30'), 1.0),
+    # 时长相差 60 秒扣 0.3
+    (SongRecord('1', '晴天', '周杰伦', duration='05:29'), 0.7),
+    (SongRecord('1', '晴天', '周杰伦'), 1.0),
+])
+def test_score(song, expected):
+    assert importer(None).score(entry('晴天', '周杰伦', 269), song) == pytest.approx(expected)
+
+
+def test_score_ignores_artist_order():
+    song = SongRecord('1', 'Say Love You', 'Jay Chou & Faye')
+    assert importer(None).score(entry('say love you', 'faye / jay chou'), song) == pytest.approx(1.0)
+
+
+def test_resolve_entry_classifies_results():
+    search = FakeSearch({
+        '周杰伦 晴天': [SongRecord('2', '晴天 (Live)', '周杰伦'), SongRecord('1', '晴天', '周杰伦', duration='04:29')],
+        # 同名同歌手、时长不同的两个录音得分相同
+        '周杰伦 七里香': [SongRecord('3', '七里香', '周杰伦', duration='04:59'),
+                    SongRecord('4', '七里香', '周杰伦', duration='05:40')],
+        # 同一录音的两个版本不算歧义
+        '周杰伦 稻香': [SongRecord('5', '稻香', '周杰伦', duration='03:43'),
+                   SongRecord('6', '稻香', '周杰伦', duration='03:44')],
+        '周杰伦 夜曲': [SongRecord('7', '夜的第七章', '周杰伦')],
+    })
+    resolve = importer(search).resolve_entry
+
+    matched = resolve(entry('晴天', '周杰伦'))
+    assert (matched['status'], matched['song'].id) == ('matched', '1')
+    assert resolve(entry('七里香', '周杰伦'))['status'] == 'ambiguous'
+    assert resolve(entry('稻香', '周杰伦'))['status'] == 'matched'
+
+    unmatched = resolve(entry('夜曲', '周杰伦'))
+    assert (unmatched['status'], unmatched['song']) == ('unmatched', None)
+    assert 0 < unmatched['score'] < PlaylistImporter.MATCH_THRESHOLD
+    assert unmatched['candidates'] == [f"夜的第七章 - 周杰伦 ({unmatched['score']:.2f})"]
+
+    empty = resolve(entry('不存在', '周杰伦'))
+    assert (empty['status'], empty['score'], empty['candidates']) == ('unmatched', 0.0, [])
+
+
+def test_resolve_reports_search_errors():
+    logged = []
+    results = list(importer(FakeSearch(error='站点不可用'), log=lambda *args, **kwargs: logged.append(args))
+                   .resolve([entry('晴天', '周杰伦')]))
+    assert [(result['status'], result['candidates']) for result in results] == [('error', ['站点不可用'])]
+    assert logged
+
+
+def test_resolution_cache():
+    song = SongRecord('1', '晴天', '周杰伦')
+    search = FakeSearch({'周杰伦 晴天': [song]})
+    index = MemoryIndex([song])
+    entries = [entry('晴天', '周杰伦'), entry('夜曲', '周杰伦')]
+
+    first = {result['entry']['title']: result for result in importer(search, index).resolve(entries)}
+    assert (first['晴天']['status'], first['夜曲']['status']) == ('matched', 'unmatched')
+    assert sorted(search.queries) == ['周杰伦 夜曲', '周杰伦 晴天']
+
+    # 再次导入时不再搜索，解析结果来自缓存
+    search.queries.clear()
+    second = {result['entry']['title']: result for result in importer(search, index).resolve(entries)}
+    assert search.queries == []
+    assert second['晴天']['song'] is song and second['晴天'].get('cached')
+    assert second['夜曲']['status'] == 'unmatched'
+
+    # 未匹配的结果过期后重新搜索，匹配到的歌曲已不在索引中时也重新搜索
+    for key, (status, song_id, score, _) in list(index.resolutions.items()):
+        if status == 'unmatched':
+            index.resolutions[key] = (status, song_id, score, time.time() - PlaylistImporter.UNMATCHED_CACHE_TTL - 1)
+    index.songs.clear()
+    list(importer(search, index).resolve(entries))
+    assert sorted(search.queries) == ['周杰伦 夜曲', '周杰伦 晴天']
+
+
+def test_entry_key_ignores_formatting():
+    keys = importer(None).entry_key
+    assert keys(entry('晴天', '周杰伦/费玉清')) == keys(entry('晴天！', '费玉清 & 周杰伦'))
+    assert keys(entry('晴天', '周杰伦', 269)) != keys(entry('晴天', '周杰伦'))
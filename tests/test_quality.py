@@ -0,0 +1,188 @@
+"""按批次音质策略挑选档位，以及与曲目缓存的配合"""
+import time
+
+import pytest
+
+from flac_music_cache import TrackCache
+from flac_music_core import QUALITY_BUDGET, QUALITY_CAP, QUALITY_TIERS, MusicClient, QualityPolicy, SongRecord
+from helpers import TieredProvider
+
+CONTENTS = {'hires': b'hires flac', 'lossless': b'lossless flac', 'mp3_320': b'ID3 320', 'mp3_128': b'ID3 mp3 data'}
+MB = 1000 * 1000
+# 预检得到的各档位大小
+SIZES = {'hires': 40 * MB, 'lossless': 21 * MB, 'mp3_320': 10 * MB, 'mp3_128': 4 * MB}
+SONG = SongRecord('1', '晴天', '周杰伦', duration='04:00')
+
+
+class FakeMeter:
+    """固定吞吐量的链路测速"""
+
+    def __init__(self, rate):
+        self.value = rate
+
+    def rate(self):
+        return self.value
+
+
+class FakeProbe:
+    """按 SIZES 返回预检大小，记录预检过的档位"""
+
+    def __init__(self, sizes=SIZES):
+        self.sizes = sizes
+        self.probed = []
+
+    def __call__(self, tier):
+        self.probed.append(tier.name)
+        return f"http://site/{tier.name}", f"晴天.{tier.format}", self.sizes.get(tier.name)
+
+
+def select(policy, song=SONG, sizes=SIZES):
+    probe = FakeProbe(sizes)
+    tier, url, _ = policy.select(song, QUALITY_TIERS, probe)
+    assert url == f"http://site/{tier.name}"
+    return tier.name, probe.probed
+
+
+def test_highest_always_takes_the_top_tier():
+    policy = QualityPolicy(meter=FakeMeter(1))
+    assert select(policy) == ('hires', ['hires'])
+    assert policy.chosen == {'hires': 1}
+
+
+def test_budget_takes_top_tier_when_it_fits():
+    # 1MB/s × 60 秒，没有其他歌曲
+    policy = QualityPolicy(QUALITY_BUDGET, deadline=60, meter=FakeMeter(MB))
+    assert select(policy) == ('hires', ['hires'])
+
+
+def test_budget_skips_tiers_whose_scaled_size_cannot_fit():
+    # 0.1MB/s × 60 秒分给两首，约 3MB：按最高档的实际大小估算，中间档位不预检，最后一档总会选中
+    policy = QualityPolicy(QUALITY_BUDGET, deadline=60, remaining=lambda: 1, meter=FakeMeter(MB / 10))
+    assert select(policy) == ('mp3_128', ['hires', 'mp3_128'])
+
+
+def test_budget_counts_songs_in_flight():
+    policy = QualityPolicy(QUALITY_BUDGET, deadline=60, meter=FakeMeter(MB))
+    assert select(policy)[0] == 'hires'
+    # 第一首还在下载中，剩下约 20MB：16位无损按比例估算放得下，预检的实际大小放不下
+    second = SongRecord('2', '七里香', '周杰伦', duration='04:00')
+    assert select(policy, second) == ('mp3_320', ['hires', 'lossless', 'mp3_320'])
+
+    # 第一首结束后不再占用预算
+    policy.finish(SONG.id)
+    policy.finish(second.id)
+    assert select(policy, SongRecord('3', '夜曲', '周杰伦'))[0] == 'hires'
+
+
+def test_budget_past_deadline_falls_to_the_last_tier():
+    policy = QualityPolicy(QUALITY_BUDGET, deadline=60, meter=FakeMeter(MB))
+    policy.started = time.monotonic() - 120
+    assert policy.allowance() <= 0
+    assert select(policy) == ('mp3_128', ['hires', 'mp3_128'])
+
+
+def test_budget_estimates_from_duration_when_probe_has_no_size():
+    # 4 分钟按码率估算：Hi-Res 约 69MB，16位无损约 27MB
+    policy = QualityPolicy(QUALITY_BUDGET, deadline=60, meter=FakeMeter(MB / 2))
+    assert select(policy, sizes={}) == ('lossless', ['hires', 'lossless'])
+
+
+def test_cap_by_tier_starts_from_max_tier():
+    policy = QualityPolicy(QUALITY_CAP, max_tier='lossless')
+    assert select(policy) == ('lossless', ['lossless'])
+
+
+def test_cap_by_bytes():
+    policy = QualityPolicy(QUALITY_CAP, max_track_bytes=12 * MB)
+    assert select(policy) == ('mp3_320', ['hires', 'mp3_320'])
+    assert policy.chosen == {'mp3_320': 1}
+
+
+def test_cap_by_tier_and_bytes():
+    policy = QualityPolicy(QUALITY_CAP, max_tier='lossless', max_track_bytes=5 * MB)
+    assert select(policy) == ('mp3_128', ['lossless', 'mp3_128'])
+
+
+@pytest.mark.parametrize('kwargs', [{'mode': 'fastest'}, {'mode': QUALITY_BUDGET}])
+def test_invalid_policy(kwargs):
+    with pytest.raises(ValueError):
+        QualityPolicy(**kwargs)
+
+
+@pytest.mark.parametrize('policy, expected', [
+    (QualityPolicy(), ['hires']),
+    (QualityPolicy(QUALITY_CAP, max_tier='mp3_320'), ['mp3_320']),
+    (QualityPolicy(QUALITY_CAP, max_track_bytes=10 * MB), ['hires', 'lossless', 'mp3_320']),
+    (QualityPolicy(QUALITY_BUDGET, deadline=60, meter=FakeMeter(MB)), ['hires', 'lossless']),
+])
+def test_cache_tiers_follow_the_policy(policy, expected):
+    assert [tier.name for tier in policy.cache_tiers(SONG, QUALITY_TIERS)] == expected
+
+
+class RecordingIndex:
+    """只记录 record_download 调用的本地索引"""
+
+    def __init__(self):
+        self.downloads = []
+
+    def record_download(self, song_id, source, quality, nbytes, path):
+        self.downloads.append((song_id, source, quality))
+
+
+@pytest.fixture
+def cached_client(tmp_path):
+    (tmp_path / 'site').mkdir()
+    provider = TieredProvider(str(tmp_path / 'site'), CONTENTS)
+    client = MusicClient(RecordingIndex(), log=lambda *args, **kwargs: None, providers=[provider])
+    assert client.init_session()
+    client.track_cache = TrackCache(str(tmp_path / 'cache'))
+    return client, provider
+
+
+def download(client, save_dir, policy):
+    song = SongRecord('1', '晴天', '周杰伦', duration='04:29')
+    save_dir.mkdir(exist_ok=True)
+    return client.download_song(song, str(save_dir), client.song_filename(song), 1, policy=policy)
+
+
+def test_downgraded_cache_entry_is_not_served_to_highest(cached_client, tmp_path):
+    client, provider = cached_client
+    path = download(client, tmp_path / 'capped', QualityPolicy(QUALITY_CAP, max_tier='mp3_128'))
+    assert path.endswith('晴天 - 周杰伦.mp3')
+
+    path = download(client, tmp_path / 'highest', QualityPolicy())
+    assert path.endswith('晴天 - 周杰伦.flac')
+    assert open(path, 'rb').read() == b'hires flac'
+    assert provider.resolved == ['mp3_128', 'hires']
+
+
+def test_cache_hit_uses_cached_tier_extension_and_records_choice(cached_client, tmp_path):
+    client, provider = cached_client
+    download(client, tmp_path / 'first', QualityPolicy(QUALITY_CAP, max_tier='mp3_128'))
+
+    policy = QualityPolicy(QUALITY_CAP, max_tier='mp3_128')
+    path = download(client, tmp_path / 'second', policy)
+    assert provider.resolved == ['mp3_128']
+    assert path.endswith('晴天 - 周杰伦.mp3')
+    assert open(path, 'rb').read() == b'ID3 mp3 data'
+    assert policy.chosen == {'mp3_128': 1}
+    assert client.song_index.downloads[-1] == ('1', 'flac', 'mp3_128')
+
+
+def test_cached_top_tier_is_not_served_to_a_lower_cap(cached_client, tmp_path):
+    client, provider = cached_client
+    download(client, tmp_path / 'highest', QualityPolicy())
+    path = download(client, tmp_path / 'capped', QualityPolicy(QUALITY_CAP, max_tier='mp3_320'))
+    assert open(path, 'rb').read() == b'ID3 320'
+    assert provider.resolved == ['hires', 'mp3_320']
+
+
+def test_byte_cap_serves_lower_cached_tier(cached_client, tmp_path):
+    client, provider = cached_client
+    download(client, tmp_path / 'first', QualityPolicy(QUALITY_CAP, max_tier='mp3_320'))
+    # 4分29秒的 Hi-Res 和 16位无损都估算超过 12MB，缓存中的 MP3 320k 直接使用
+    policy = QualityPolicy(QUALITY_CAP, max_track_bytes=12 * MB)
+    path = download(client, tmp_path / 'second', policy)
+    assert path.endswith('晴天 - 周杰伦.mp3')
+    assert provider.resolved == ['mp3_320']
+    assert policy.chosen == {'mp3_320': 1}
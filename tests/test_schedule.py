@@ -0,0 +1,98 @@
+"""下载时段的解析、匹配和按时段调整下载服务"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from flac_music_core import DownloadScheduler, ScheduleWindow
+
+MONDAY = datetime(2024, 1, 1)  # 周一
+DAYS = {name: i for i, name in enumerate(('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun'))}
+
+
+def at(day, clock):
+    """某个星期几的某个时刻"""
+    hour, minute = map(int, clock.split(':'))
+    return MONDAY + timedelta(days=DAYS[day], hours=hour, minutes=minute)
+
+
+@pytest.mark.parametrize('spec, days, start, end, workers, rate', [
+    ('mon-fri 09:00-18:00 1@2M', {0, 1, 2, 3, 4}, 9 * 60, 18 * 60, 1, 2 * 1024 * 1024),
+    ('18:00-09:00 8', None, 18 * 60, 9 * 60, 8, 0),
+    ('fri-mon 22:00-24:00 3@512K', {4, 5, 6, 0}, 22 * 60, 0, 3, 512 * 1024),
+    ('sat,sun 00:00-00:00 4@100', {5, 6}, 0, 0, 4, 100 * 1024),
+    ('00:00-24:00 2@1.5m', None, 0, 0, 2, int(1.5 * 1024 * 1024)),
+    ('SUN 7:05-8:00 1@64k', {6}, 7 * 60 + 5, 8 * 60, 1, 64 * 1024),
+])
+def test_parse(spec, days, start, end, workers, rate):
+    window = ScheduleWindow.parse(spec)
+    assert (window.days, window.start, window.end, window.workers, window.rate) == (days, start, end, workers, rate)
+    assert window.spec == spec
+
+
+@pytest.mark.parametrize('spec', [
+    '', '09:00-18:00', '9-18 2', 'mon-xyz 09:00-18:00 1', 'mon 09:00-18:00 1 2', '25:00-26:00 1',
+    '09:60-10:00 1', '09:00-24:01 1', '24:00-01:00 1', '09:00-18:00 0', '09:00-18:00 x', '09:00-18:00 1@2G',
+    '09:00-18:00 1@',
+])
+def test_parse_rejects(spec):
+    with pytest.raises(ValueError):
+        ScheduleWindow.parse(spec)
+
+
+@pytest.mark.parametrize('spec, moments', [
+    ('mon-fri 09:00-18:00 1', {('mon', '09:00'): True, ('mon', '08:59'): False, ('fri', '17:59'): True,
+                               ('mon', '18:00'): False, ('sat', '10:00'): False}),
+    # 跨午夜的时段按开始的那天算
+    ('fri 22:00-02:00 1', {('fri', '23:00'): True, ('sat', '01:59'): True, ('sat', '02:00'): False,
+                           ('sat', '23:00'): False, ('fri', '01:00'): False}),
+    ('sun 23:00-01:00 1', {('sun', '23:30'): True, ('mon', '00:30'): True, ('sun', '00:30'): False}),
+    # 星期范围可以跨周末
+    ('fri-mon 08:00-09:00 1', {('fri', '08:30'): True, ('sun', '08:30'): True, ('mon', '08:30'): True,
+                               ('tue', '08:30'): False, ('thu', '08:30'): False}),
+    ('22:00-24:00 1', {('wed', '23:59'): True, ('wed', '21:59'): False, ('thu', '00:00'): False}),
+    # 起止时间相同表示全天
+    ('sat,sun 00:00-24:00 1', {('sun', '12:00'): True, ('sat', '00:00'): True, ('mon', '00:00'): False}),
+    ('12:00-12:00 1', {('tue', '03:00'): True, ('sun', '23:59'): True}),
+])
+def test_contains(spec, moments):
+    window = ScheduleWindow.parse(spec)
+    assert {moment: window.contains(at(*moment)) for moment in moments} == moments
+
+
+class RecordingService:
+    """只记录 set_limits 调用的下载服务"""
+
+    def __init__(self):
+        self.limits = []
+
+    def set_limits(self, workers, rate):
+        self.limits.append((workers, rate))
+
+
+def test_scheduler_sets_limits_as_windows_change():
+    service = RecordingService()
+    now = [at('mon', '23:30')]
+    changes = []
+    windows = [ScheduleWindow.parse('mon-fri 09:00-18:00 1@2M'), ScheduleWindow.parse('18:00-23:00 6')]
+    scheduler = DownloadScheduler(service, windows, on_change=changes.append, clock=lambda: now[0])
+
+    # 第一次应用时即使不在任何时段内也要通知下载服务
+    assert scheduler.apply()
+    assert service.limits == [(0, 0)]
+    assert scheduler.status() == {'window': None, 'workers': 0, 'rate': 0}
+    assert not scheduler.apply()
+
+    now[0] = at('tue', '10:00')
+    assert scheduler.apply()
+    now[0] = at('tue', '17:59')
+    assert not scheduler.apply()
+    now[0] = at('tue', '18:00')
+    assert scheduler.apply()
+    assert scheduler.status() == {'window': '18:00-23:00 6', 'workers': 6, 'rate': 0}
+    now[0] = at('sat', '19:00')
+    assert not scheduler.apply()
+    now[0] = at('sat', '23:00')
+    assert scheduler.apply()
+
+    assert service.limits == [(0, 0), (1, 2 * 1024 * 1024), (6, 0), (0, 0)]
+    assert changes == [None, windows[0], windows[1], None]
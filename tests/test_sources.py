@@ -0,0 +1,129 @@
+"""多来源搜索、结果合并和下载回退"""
+import threading
+import time
+
+import pytest
+
+from flac_music_core import DirectoryProvider, DownloadPaused, MusicClient, SearchResultMerger, SongRecord, TaskControl
+from helpers import FakeProvider
+
+
+@pytest.fixture
+def library(tmp_path):
+    """本地目录来源：两首歌"""
+    root = tmp_path / 'library'
+    (root / 'Album').mkdir(parents=True)
+    (root / 'Album' / '晴天 - 周杰伦.flac').write_bytes(b'F' * 100000)
+    (root / '稻香 - 周杰伦.flac').write_bytes(b'G' * 5000)
+    return root
+
+
+def make_client(*providers):
+    client = MusicClient(providers=list(providers), log=lambda *args, **kwargs: None)
+    assert client.init_session()
+    return client
+
+
+def test_slow_provider_misses_deadline_and_arrives_late():
+    release = threading.Event()
+    fast = FakeProvider('flac', [SongRecord('1', '晴天', '周杰伦', duration='04:29')])
+    slow = FakeProvider('slow', [SongRecord('slow:1', '晴天', '周杰伦', duration='04:29'),
+                                 SongRecord('slow:2', '夜曲', '周杰伦')], deadline=0.1, release=release)
+    client = make_client(fast, slow)
+    late, arrived = [], threading.Event()
+
+    def on_late(songs):
+        late.append(songs)
+        arrived.set()
+
+    started = time.monotonic()
+    songs, total = client.search_music_with_session('周杰伦', on_late=on_late)
+    assert time.monotonic() - started < 1
+    assert [song.id for song in songs] == ['1']
+    assert total == 1
+    assert not late
+
+    release.set()
+    assert arrived.wait(5)
+    # 晚到结果中与已返回结果重复的歌曲被去掉
+    assert [[song.id for song in songs] for songs in late] == [['slow:2']]
+
+
+def test_merger_drops_same_song_from_other_sources():
+    merger = SearchResultMerger()
+    first = merger.add([SongRecord('1', '晴天', '周杰伦', duration='04:29'),
+                        SongRecord('2', '晴天', '周杰伦', duration='05:10')])
+    # 同一来源内的不同版本都保留
+    assert [song.id for song in first] == ['1', '2']
+
+    second = merger.add([SongRecord('dir:a', '晴天 ', '周杰伦', duration='04:29'),
+                         SongRecord('dir:b', '晴天', '周杰伦'),
+                         SongRecord('dir:c', '七里香', '周杰伦', duration='04:59'),
+                         SongRecord('1', '别的歌', '别人')])
+    # 时长相同、时长未知的同名歌曲和相同ID都视为重复
+    assert [song.id for song in second] == ['dir:c']
+
+
+def test_merger_untimed_song_hides_later_versions():
+    merger = SearchResultMerger()
+    merger.add([SongRecord('dir:a', '稻香', '周杰伦')])
+    assert merger.add([SongRecord('1', '稻香', '周杰伦', duration='03:43')]) == []
+
+
+def test_resolve_song_falls_back_to_next_provider(library):
+    site = FakeProvider('flac', [], resolve_error='站点不可用')
+    directory = DirectoryProvider(str(library), 'dir1')
+    client = make_client(site, directory)
+
+    song_url, filename, provider, _ = client.resolve_song(SongRecord('1', '晴天', '周杰伦'))
+    assert provider is directory
+    assert filename == '晴天 - 周杰伦.flac'
+    assert song_url == str(library / 'Album' / '晴天 - 周杰伦.flac')
+
+
+def test_resolve_song_reports_every_provider_when_all_fail(library):
+    client = make_client(FakeProvider('flac', [], resolve_error='站点不可用'), DirectoryProvider(str(library), 'dir1'))
+    with pytest.raises(Exception) as error:
+        client.resolve_song(SongRecord('1', '不存在的歌', '周杰伦'))
+    assert '站点不可用' in str(error.value)
+    assert 'dir1: 未找到' in str(error.value)
+
+
+def test_download_song_uses_fallback_provider(library, tmp_path):
+    client = make_client(FakeProvider('flac', [], resolve_error='站点不可用'), DirectoryProvider(str(library), 'dir1'))
+    song = SongRecord('1', '稻香', '周杰伦')
+    path = client.download_song(song, str(tmp_path), client.song_filename(song), 1)
+    assert open(path, 'rb').read() == b'G' * 5000
+
+
+def test_resume_uses_the_provider_that_started_the_download(library, tmp_path):
+    directory = DirectoryProvider(str(library), 'dir1')
+    client = make_client(FakeProvider('flac', [], resolve_error='站点不可用'), directory)
+    song = SongRecord('1', '晴天', '周杰伦')
+    control = TaskControl()
+
+    def pause_after_first_chunk(tracker):
+        control.pause()
+
+    with pytest.raises(DownloadPaused) as paused:
+        client.download_song(song, str(tmp_path), client.song_filename(song), 1, control,
+                             on_progress=pause_after_first_chunk)
+    resume_state = paused.value.resume_state
+    assert resume_state['provider'] == 'dir1'
+
+    control.resume()
+    path = client.download_song(song, str(tmp_path), client.song_filename(song), 1, control, resume_state)
+    assert open(path, 'rb').read() == b'F' * 100000
+
+
+def test_resume_restarts_when_original_provider_is_gone(library, tmp_path):
+    client = make_client(DirectoryProvider(str(library), 'dir1'))
+    part_path = tmp_path / '晴天 - 周杰伦.flac.part'
+    part_path.write_bytes(b'X' * 10)
+    resume_state = {'filepath': str(tmp_path / '晴天 - 周杰伦.flac'), 'part_path': str(part_path),
+                    'provider': 'gone', 'tier': None}
+
+    path = client.download_song(SongRecord('dir1:Album/晴天 - 周杰伦.flac', '晴天', '周杰伦'), str(tmp_path),
+                                '晴天 - 周杰伦.flac', 1, resume_state=resume_state)
+    assert open(path, 'rb').read() == b'F' * 100000
+    assert not part_path.exists()